@@ -0,0 +1,14 @@
+"""Reference implementation of the ``process_messages`` component."""
+
+from msgproc.errors import InputError
+
+__all__ = ["InputError", "Summary", "process"]
+
+
+def __getattr__(name):
+    # imported on first use: `python -m msgproc.client` does not need the pipeline
+    if name in ("Summary", "process"):
+        from msgproc import pipeline
+
+        return getattr(pipeline, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,5 @@
+import sys
+
+from msgproc.cli import main
+
+sys.exit(main())
@@ -0,0 +1,164 @@
+"""Bulk output formats: every message in one stream or archive.
+
+Writing one small file per message costs an inode, an open and a close per
+row. These formats keep the per-message documents of msgproc.writer but
+append them to a single file in `output_dir`:
+
+- ndjson: `messages.ndjson`, one JSON document per line;
+- tar: `messages.tar`, one `<key>.json` member per message;
+- zip: `messages.zip`, one `<key>.json` member per message.
+
+ndjson and tar streams can be compressed as a whole with gzip or lzma, zip
+archives compress each member instead. Spooled contents are streamed into
+every format: the size of a tar member is known from the size of the spooled
+content, zip members are written as zip64 entries of unknown size.
+
+The file is written under a temporary name and renamed once complete (see
+msgproc.durability): a failed run leaves the previous output untouched.
+"""
+
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import time
+import zipfile
+
+from msgproc.durability import commit, discard, temporary_path
+from msgproc.transform import Base64Stream
+from msgproc.writer import document_size, iter_document, serialize
+
+FORMATS = ("json", "ndjson", "tar", "zip")
+COMPRESSIONS = ("none", "gzip", "lzma")
+
+SUFFIXES = {"none": "", "gzip": ".gz", "lzma": ".xz"}
+ZIP_COMPRESSIONS = {"none": zipfile.ZIP_STORED, "gzip": zipfile.ZIP_DEFLATED, "lzma": zipfile.ZIP_LZMA}
+
+# Large buffered writes, a document is only a few hundred bytes.
+BUFFER_SIZE = 1 << 20
+
+
+def output_path(output_dir, fmt, compression="none"):
+    """Path of the single output file of a bulk format"""
+    if fmt == "zip":
+        return os.path.join(output_dir, "messages.zip")
+    return os.path.join(output_dir, f"messages.{fmt}{SUFFIXES[compression]}")
+
+
+def open_stream(path, compression):
+    f = open(path, "wb", buffering=BUFFER_SIZE)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6), f
+    if compression == "lzma":
+        return lzma.LZMAFile(f, "wb"), f
+    return f, f
+
+
+def write_ndjson(messages, stream):
+    # documents are appended to a reused buffer, written out every BUFFER_SIZE bytes
+    count = 0
+    buffer = bytearray()
+    for message in messages:
+        if isinstance(message.content, Base64Stream):
+            stream.write(buffer)
+            buffer.clear()
+            stream.writelines(iter_document(message))
+            stream.write(b"\n")
+        else:
+            buffer += serialize(message)
+            buffer += b"\n"
+            if len(buffer) >= BUFFER_SIZE:
+                stream.write(buffer)
+                buffer.clear()
+        count += 1
+    stream.write(buffer)
+    return count
+
+
+class DocumentReader(io.RawIOBase):
+    """Readable file over the pieces of iter_document(message), for tarfile"""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            piece = next(self.pieces, None)
+            if piece is None:
+                return 0
+            self.pending = memoryview(piece)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def write_tar(messages, stream):
+    count = 0
+    mtime = int(time.time())
+    with tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for message in messages:
+            info = tarfile.TarInfo(f"{message.key}.json")
+            info.mtime = mtime
+            if isinstance(message.content, Base64Stream):
+                info.size = document_size(message)
+                # tarfile reads full blocks of the member, buffered over the pieces
+                tar.addfile(info, io.BufferedReader(DocumentReader(iter_document(message)), BUFFER_SIZE))
+            else:
+                data = serialize(message)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            count += 1
+    return count
+
+
+def write_zip(messages, path, compression):
+    count = 0
+    date_time = time.localtime()[:6]
+    with zipfile.ZipFile(path, "w", ZIP_COMPRESSIONS[compression]) as archive:
+        for message in messages:
+            info = zipfile.ZipInfo(f"{message.key}.json", date_time)
+            info.compress_type = archive.compression
+            if isinstance(message.content, Base64Stream):
+                with archive.open(info, "w", force_zip64=True) as member:
+                    member.writelines(iter_document(message))
+            else:
+                archive.writestr(info, serialize(message))
+            count += 1
+    return count
+
+
+def write_bulk(messages, output_dir, fmt, compression="none", durability="none", metrics=None):
+    """Write every message to the single output file of `fmt` and return the count
+
+    The file is counted in `metrics`, if given, once complete.
+    """
+    path = output_path(output_dir, fmt, compression)
+    tmp = temporary_path(path)
+    try:
+        count = write_file(messages, tmp, fmt, compression)
+    except BaseException:
+        discard(tmp)
+        raise
+    commit(tmp, path, durability)
+    if metrics is not None:
+        metrics.wrote(count, os.path.getsize(path))
+    return count
+
+
+def write_file(messages, path, fmt, compression):
+    if fmt == "zip":
+        return write_zip(messages, path, compression)
+    stream, f = open_stream(path, compression)
+    try:
+        with stream:
+            if fmt == "tar":
+                return write_tar(messages, stream)
+            return write_ndjson(messages, stream)
+    finally:
+        f.close()
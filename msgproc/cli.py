@@ -0,0 +1,255 @@
+"""Command line interface, compatible with the `process_messages` binary."""
+
+import argparse
+import os
+import sys
+from contextlib import nullcontext
+
+from msgproc.bulk import COMPRESSIONS, FORMATS
+from msgproc.client import request
+from msgproc.contacts import DEFAULT_PARTITIONS, JOINS
+from msgproc.duplicates import DETECTORS, POLICIES
+from msgproc.durability import DURABILITIES, SYNC_FILES, SYNC_INTERVAL
+from msgproc.errors import InputError
+from msgproc.layout import DEFAULT_DEPTH, LAYOUTS, MAX_DEPTH
+from msgproc.metrics import METRICS_INTERVAL, Metrics
+from msgproc.pipeline import process
+from msgproc.profiling import PROFILE_INTERVAL, Sampler
+from msgproc.stream import STDIO
+from msgproc.validation import MODES
+from msgproc.writer import POOLS
+
+PROG = "process_messages"
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def build_parser(parser_class=argparse.ArgumentParser):
+    parser = parser_class(
+        prog=PROG,
+        description="Convert messages.csv rows into one <id>.json file per message.",
+    )
+    parser.add_argument("messages", help="path to messages.csv, - to read it from stdin")
+    parser.add_argument("contacts", help="path to contacts.csv")
+    parser.add_argument(
+        "output_dir", help="directory receiving the JSON files, - to write one document per line to stdout"
+    )
+    parser.add_argument(
+        "--workers", type=positive_int, default=1, metavar="N",
+        help="serialize and write output files on N workers (default: 1, serial), "
+        "--format json only",
+    )
+    parser.add_argument(
+        "--parse-workers", type=positive_int, default=1, metavar="N",
+        help="parse messages.csv on N processes, by byte ranges split at record "
+        "boundaries (default: 1, serial)",
+    )
+    parser.add_argument(
+        "--pool", choices=sorted(POOLS), default="thread",
+        help="worker pool used when --workers > 1 (default: thread)",
+    )
+    parser.add_argument(
+        "--join", choices=JOINS, default="index",
+        help="contact resolution: in-memory index, merge of inputs sorted by "
+        "contact, or hash join spilled to disk (default: index)",
+    )
+    parser.add_argument(
+        "--contacts-cache", metavar="DIR",
+        help="keep a binary snapshot of contacts.csv in DIR, memory-mapped by the "
+        "next runs and rebuilt when contacts.csv changes, --join index only",
+    )
+    parser.add_argument(
+        "--spill-partitions", type=positive_int, default=DEFAULT_PARTITIONS, metavar="K",
+        help=f"number of on-disk partitions for --join spill (default: {DEFAULT_PARTITIONS})",
+    )
+    parser.add_argument(
+        "--format", choices=FORMATS, default="json", dest="fmt",
+        help="one <id>.json file per message, or a single messages.ndjson, "
+        "messages.tar or messages.zip file (default: json)",
+    )
+    parser.add_argument(
+        "--compression", choices=COMPRESSIONS, default="none",
+        help="compression of the ndjson, tar or zip output (default: none)",
+    )
+    parser.add_argument(
+        "--layout", choices=LAYOUTS, default="flat",
+        help="all JSON files in output_dir, or spread over subdirectories named "
+        "after pairs of hex digits of their id, e.g. 1f/f8/<id>.json (default: flat)",
+    )
+    parser.add_argument(
+        "--shard-depth", type=positive_int, default=DEFAULT_DEPTH, metavar="N",
+        help=f"levels of subdirectories of --layout sharded, 1 to {MAX_DEPTH} (default: {DEFAULT_DEPTH})",
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="only write messages that changed since the last run, tracked in "
+        "output_dir/.manifest.json; files of removed messages are deleted",
+    )
+    parser.add_argument(
+        "--validation", choices=MODES, default="fail-fast",
+        help="stop at the first invalid row of messages.csv, or keep checking "
+        "and report every invalid row with its line number (default: fail-fast)",
+    )
+    parser.add_argument(
+        "--durability", choices=DURABILITIES, default="none",
+        help="output files are always written to a temporary name and renamed "
+        "once complete; none: no fsync, batch: fsync every --sync-files files or "
+        "--sync-interval ms, strict: fsync every file (default: none)",
+    )
+    parser.add_argument(
+        "--sync-files", type=positive_int, default=SYNC_FILES, metavar="N",
+        help=f"files written between two syncs with --durability batch (default: {SYNC_FILES})",
+    )
+    parser.add_argument(
+        "--sync-interval", type=positive_int, default=SYNC_INTERVAL, metavar="MS",
+        help=f"longest delay between two syncs with --durability batch, checked as files are "
+        f"written: files wait for the next one while the input stalls (default: {SYNC_INTERVAL})",
+    )
+    parser.add_argument(
+        "--duplicates", choices=POLICIES, default="rename",
+        help="messages repeating an earlier id: write them to <id>_<n>.json, "
+        "skip them (both reported, exit status 1), or stop (default: rename)",
+    )
+    parser.add_argument(
+        "--duplicate-detector", choices=DETECTORS, default="table", dest="detector",
+        help="table of every id seen, packed on 16 bytes, or a first pass "
+        "through a Bloom filter tracking only the suspected ids (default: table)",
+    )
+    parser.add_argument(
+        "--metrics-file", metavar="PATH",
+        help="rewrite live counters, throughput and per-stage latency histograms "
+        "to PATH while running, as JSON if PATH ends in .json, in the Prometheus "
+        "text format otherwise",
+    )
+    parser.add_argument(
+        "--metrics-interval", type=positive_int, default=METRICS_INTERVAL, metavar="MS",
+        help=f"delay between two updates of --metrics-file (default: {METRICS_INTERVAL})",
+    )
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="print the counters, throughput and per-stage latencies to stderr at exit",
+    )
+    parser.add_argument(
+        "--profile", metavar="PATH",
+        help="sample the stack of the pipeline every --profile-interval ms and "
+        "write the collapsed stacks to PATH, ready for flamegraph.pl or speedscope",
+    )
+    parser.add_argument(
+        "--profile-interval", type=positive_int, default=PROFILE_INTERVAL, metavar="MS",
+        help=f"delay between two samples of --profile (default: {PROFILE_INTERVAL})",
+    )
+    parser.add_argument(
+        "--daemon", metavar="SOCKET",
+        help="have the daemon listening on the Unix socket SOCKET process the "
+        "batch, with the contacts it keeps loaded (see python -m msgproc.daemon)",
+    )
+    return parser
+
+
+def error(text):
+    print(f"{PROG}: error: {text}", file=sys.stderr)
+
+
+def run(messages_path, contacts_path, output_dir, sampler=None, **options):
+    """Process one batch, return the exit status and the error messages to print
+
+    The batch is profiled by `sampler`, a msgproc.profiling.Sampler, if given.
+    """
+    try:
+        with nullcontext() if sampler is None else sampler:
+            summary = process(messages_path, contacts_path, output_dir, **options)
+    except InputError as exc:
+        return 1, [str(exc)]
+    except BrokenPipeError:
+        # the reader of stdout is gone, e.g. `| head`: nothing to report
+        return 1, []
+    except OSError as exc:
+        return 1, [f"cannot write output: {exc}"]
+    errors = [
+        f"duplicate message id {msg_id}, skipped" if key is None
+        else f"duplicate message id {msg_id}, written as {key}.json"
+        for msg_id, key in summary.duplicates
+    ]
+    return (1 if errors else 0), errors
+
+
+def parse_args(argv=None, parser=None):
+    parser = build_parser() if parser is None else parser
+    args = parser.parse_args(argv)
+    if args.fmt == "json" and args.compression != "none":
+        parser.error("--compression requires --format ndjson, tar or zip")
+    if args.fmt != "json" and args.workers > 1:
+        parser.error("--workers requires --format json")
+    if args.fmt != "json" and args.incremental:
+        parser.error("--incremental requires --format json")
+    if args.fmt != "json" and args.layout != "flat":
+        parser.error("--layout sharded requires --format json")
+    if args.shard_depth > MAX_DEPTH:
+        parser.error(f"--shard-depth must be at most {MAX_DEPTH}")
+    if args.stats and args.daemon is not None:
+        parser.error("--stats cannot be used with --daemon")
+    if args.messages == STDIO:
+        if args.parse_workers > 1:
+            parser.error("--parse-workers requires a messages.csv file, not stdin")
+        if args.detector == "bloom":
+            parser.error("--duplicate-detector bloom reads messages.csv twice, it cannot read stdin")
+    if args.output_dir == STDIO:
+        if (args.fmt != "json" or args.workers > 1 or args.incremental or args.layout != "flat"
+                or args.durability != "none"):
+            parser.error("--format, --workers, --incremental, --layout and --durability "
+                         "require an output directory, not stdout")
+    if STDIO in (args.messages, args.output_dir) and args.daemon is not None:
+        parser.error("--daemon cannot read stdin or write stdout")
+    return args
+
+
+def options(args):
+    """Keyword arguments of process() set by the command line"""
+    return dict(
+        workers=args.workers, pool=args.pool,
+        join=args.join, partitions=args.spill_partitions, contacts_cache=args.contacts_cache,
+        fmt=args.fmt, compression=args.compression,
+        incremental=args.incremental,
+        validation=args.validation,
+        durability=args.durability, sync_files=args.sync_files, sync_interval=args.sync_interval,
+        duplicates=args.duplicates, detector=args.detector,
+        parse_workers=args.parse_workers,
+        layout=args.layout, shard_depth=args.shard_depth,
+    )
+
+
+def new_metrics(args, cwd=""):
+    """Metrics requested by the command line, None if none, paths relative to `cwd`"""
+    if args.metrics_file is None and not args.stats:
+        return None
+    path = None if args.metrics_file is None else os.path.join(cwd, args.metrics_file)
+    return Metrics(path, args.metrics_interval)
+
+
+def new_sampler(args, cwd=""):
+    """Sampler requested by the command line, None if none, paths relative to `cwd`"""
+    if args.profile is None:
+        return None
+    return Sampler(os.path.join(cwd, args.profile), args.profile_interval)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.daemon is not None:
+        # the daemon parses the command line again, and ignores --daemon
+        status, errors = request(args.daemon, argv)
+    else:
+        metrics = new_metrics(args)
+        status, errors = run(args.messages, args.contacts, args.output_dir, sampler=new_sampler(args),
+                             metrics=metrics, **options(args))
+        if args.stats:
+            print(metrics.report(), file=sys.stderr)
+    for text in errors:
+        error(text)
+    return status
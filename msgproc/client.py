@@ -0,0 +1,53 @@
+"""Thin client of msgproc.daemon.
+
+    python -m msgproc.client SOCKET messages.csv contacts.csv output_dir [options]
+
+has the daemon listening on SOCKET run `process_messages messages.csv
+contacts.csv output_dir [options]`. Only the arguments and the working
+directory are sent, the daemon parses them: this module imports nothing
+but json and socket, the client starts as fast as Python does.
+`process_messages ... --daemon SOCKET` does the same from the full CLI.
+"""
+
+import json
+import os
+import socket
+import sys
+
+PROG = "process_messages-client"
+
+
+def request(socket_path, argv, cwd=None):
+    """Have the daemon listening on `socket_path` run the command line `argv`
+
+    Return the exit status and the error messages to print, as
+    msgproc.cli.run does.
+    """
+    payload = {"argv": list(argv), "cwd": os.getcwd() if cwd is None else cwd}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(payload).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+    except OSError as exc:
+        return 1, [f"cannot reach daemon at {socket_path}: {exc.strerror or exc}"]
+    if not line:
+        return 1, [f"daemon at {socket_path} closed the connection"]
+    response = json.loads(line)
+    return response["status"], response["errors"]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 1 or argv[0].startswith("-"):
+        print(f"usage: {PROG} SOCKET messages contacts output_dir [options]", file=sys.stderr)
+        return 2
+    status, errors = request(argv[0], argv[1:])
+    for text in errors:
+        print(f"process_messages: error: {text}", file=sys.stderr)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
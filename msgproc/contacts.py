@@ -0,0 +1,219 @@
+"""Contact book loading and resolution (F09, R05).
+
+Three join strategies resolve `messages.contact` against `contacts.id`:
+
+- index: contacts are packed into a ContactIndex held in memory;
+- merge: both files are sorted by contact id and read side by side;
+- spill: both inputs are hash-partitioned to disk, then joined one
+  partition at a time, for contact books that do not fit in memory.
+"""
+
+import csv
+import heapq
+import os
+import pickle
+import tempfile
+from array import array
+from bisect import bisect_right
+from itertools import chain, islice
+from operator import itemgetter
+
+from msgproc.errors import InputError
+from msgproc.reader import CONTACT_COLUMNS, iter_rows, parse_int
+
+JOINS = ("index", "merge", "spill")
+DEFAULT_PARTITIONS = 64
+# Contacts sorted in memory at a time when contacts.csv is not sorted by id
+SORT_RUN = 1 << 18
+# Contacts per pickled chunk of a sorted run
+RUN_CHUNK = 1024
+
+
+class ContactIndex:
+    """Contact book packed into flat arrays.
+
+    `ids` is sorted, the name of `ids[i]` is the UTF-8 slice
+    `names[offsets[i]:offsets[i + 1]]`. This costs about 16 bytes per
+    contact plus the name itself, against well over 100 for a dict of
+    Python ints and strings. The arrays may also be memoryviews over a
+    mapped snapshot (see msgproc.snapshot).
+    """
+
+    def __init__(self, ids, offsets, names):
+        self.ids = ids
+        self.offsets = offsets
+        self.names = names
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build an index from (id, name) pairs; on repeated ids the last one wins
+
+        Once a pair is out of order, the pairs read so far and the rest go
+        through sorted_pairs: the book is not held twice while it is sorted.
+        """
+        index = cls(array("q"), array("Q", [0]), bytearray())
+        pairs = iter(pairs)
+        for contact_id, name in pairs:
+            if index.ids and contact_id < index.ids[-1]:
+                unsorted = chain(index.items(), [(contact_id, name)], pairs)
+                index = cls(array("q"), array("Q", [0]), bytearray())
+                for contact_id, name in sorted_pairs(unsorted):
+                    index.append(contact_id, name)
+                return index
+            index.append(contact_id, name)
+        return index
+
+    def append(self, contact_id, name):
+        try:
+            self.ids.append(contact_id)
+        except OverflowError:
+            raise InputError(f"contact id out of range: {contact_id}") from None
+        self.names += name.encode("utf-8")
+        self.offsets.append(len(self.names))
+
+    def items(self):
+        """Yield the (id, name) pairs of the index"""
+        for i, contact_id in enumerate(self.ids):
+            yield contact_id, str(self.names[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, contact_id, default=None):
+        i = bisect_right(self.ids, contact_id) - 1
+        if i < 0 or self.ids[i] != contact_id:
+            return default
+        return str(self.names[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+
+def sorted_pairs(pairs):
+    """Yield (id, name) pairs sorted by id, keeping the input order of repeated ids
+
+    Runs of SORT_RUN pairs are sorted in memory and spilled to temporary
+    files, then merged: a list of 10M pairs would take over 1GB. Fewer
+    pairs are sorted in memory only.
+    """
+    pairs = iter(pairs)
+    run = sorted(islice(pairs, SORT_RUN), key=itemgetter(0))
+    if len(run) < SORT_RUN:
+        yield from run
+        return
+    with tempfile.TemporaryDirectory(prefix="msgproc-sort-") as tmp:
+        paths = []
+        while run:
+            paths.append(os.path.join(tmp, f"run-{len(paths)}.pickle"))
+            with open(paths[-1], "wb") as f:
+                for start in range(0, len(run), RUN_CHUNK):
+                    pickle.dump(run[start:start + RUN_CHUNK], f, pickle.HIGHEST_PROTOCOL)
+            run = sorted(islice(pairs, SORT_RUN), key=itemgetter(0))
+        files = [open(path, "rb") for path in paths]
+        try:
+            # runs are in input order and merge() is stable
+            runs = [chain.from_iterable(iter_pickled(f)) for f in files]
+            yield from heapq.merge(*runs, key=itemgetter(0))
+        finally:
+            for f in files:
+                f.close()
+
+
+def iter_contacts(path):
+    """Stream (contact id, name) pairs from contacts.csv"""
+    for line, (contact_id, name) in iter_rows(path, CONTACT_COLUMNS):
+        yield parse_int(contact_id, "id", f"{path}:{line}"), name
+
+
+def load_contacts(path):
+    """Load contacts.csv into a ContactIndex"""
+    return ContactIndex.from_pairs(iter_contacts(path))
+
+
+def unknown_contact(message):
+    return InputError(f"line {message.line}: unknown contact {message.contact}")
+
+
+def resolve_contacts(messages, contacts):
+    """Replace contact ids by contact names using an in-memory index"""
+    for message in messages:
+        name = contacts.get(message.contact)
+        if name is None:
+            raise unknown_contact(message)
+        yield message._replace(contact=name)
+
+
+def iter_sorted_contacts(path):
+    """Stream contacts sorted by id, keeping the last of repeated ids"""
+    previous = None
+    for contact_id, name in iter_contacts(path):
+        if previous is not None:
+            if contact_id < previous[0]:
+                raise InputError(f"{path}: not sorted by id (merge join), {contact_id} after {previous[0]}")
+            if contact_id != previous[0]:
+                yield previous
+        previous = (contact_id, name)
+    if previous is not None:
+        yield previous
+
+
+def merge_join(messages, contacts_path):
+    """Resolve contacts when both inputs are sorted by contact id.
+
+    Only the current contact is held in memory.
+    """
+    contacts = iter_sorted_contacts(contacts_path)
+    contact_id, name = next(contacts, (None, None))
+    previous = None
+    for message in messages:
+        if previous is not None and message.contact < previous:
+            raise InputError(
+                f"line {message.line}: messages not sorted by contact (merge join), "
+                f"{message.contact} after {previous}"
+            )
+        previous = message.contact
+        while contact_id is not None and contact_id < message.contact:
+            contact_id, name = next(contacts, (None, None))
+        if contact_id != message.contact:
+            raise unknown_contact(message)
+        yield message._replace(contact=name)
+
+
+def spill_join(messages, contacts_path, partitions=DEFAULT_PARTITIONS):
+    """Resolve contacts with a hash join partitioned on disk.
+
+    Contacts and messages are split into `partitions` temporary files by
+    contact id, then each partition is joined with its own ContactIndex.
+    Peak memory is that of the largest contacts partition. Messages are
+    emitted grouped by partition rather than in input order.
+    """
+    with tempfile.TemporaryDirectory(prefix="msgproc-join-") as tmp:
+        paths = [os.path.join(tmp, f"contacts-{p}.csv") for p in range(partitions)]
+        files = [open(path, "w", newline="", encoding="utf-8") for path in paths]
+        try:
+            writers = [csv.writer(f) for f in files]
+            for contact_id, name in iter_contacts(contacts_path):
+                writers[contact_id % partitions].writerow((contact_id, name))
+        finally:
+            for f in files:
+                f.close()
+
+        spills = [os.path.join(tmp, f"messages-{p}.pickle") for p in range(partitions)]
+        files = [open(path, "wb") for path in spills]
+        try:
+            for message in messages:
+                pickle.dump(message, files[message.contact % partitions], pickle.HIGHEST_PROTOCOL)
+        finally:
+            for f in files:
+                f.close()
+
+        for path, spill in zip(paths, spills):
+            with open(path, newline="", encoding="utf-8") as f:
+                index = ContactIndex.from_pairs((int(row[0]), row[1]) for row in csv.reader(f))
+            with open(spill, "rb") as f:
+                yield from resolve_contacts(iter_pickled(f), index)
+
+
+def iter_pickled(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
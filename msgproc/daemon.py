@@ -0,0 +1,219 @@
+"""Resident server keeping contacts.csv loaded across batches.
+
+    python -m msgproc.daemon SOCKET contacts.csv
+
+A `process_messages` run mostly pays for starting Python and loading the
+contact book. The daemon loads contacts.csv once into a ContactIndex and
+processes batches sent over the Unix domain socket SOCKET, on threads so
+that several clients are served at once:
+
+    process_messages messages.csv contacts.csv output_dir --daemon SOCKET
+    python -m msgproc.client SOCKET messages.csv contacts.csv output_dir
+
+Each request is a JSON line `{"argv", "cwd"}`: the command line of
+`process_messages` and the directory its paths are relative to. Each
+response is a JSON line `{"status", "errors"}` (see msgproc.cli.run). A
+connection may carry several requests. Only batches using the contacts.csv
+of the daemon are accepted.
+
+contacts.csv is watched: its inode, size and mtime are checked before
+every batch and every `--watch-interval` seconds, and the index is
+reloaded when they change. While the file is invalid, batches fail with
+its error.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+
+from msgproc import cli
+from msgproc.contacts import load_contacts
+from msgproc.errors import InputError
+
+PROG = "process_messages-daemon"
+WATCH_INTERVAL = 1.0
+
+
+def file_stamp(path):
+    """Inode, size and mtime of `path`, None if it cannot be read"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class ContactBook:
+    """ContactIndex of a contacts.csv, reloaded when the file changes"""
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        self.stamp = None
+        self.index = None
+        self.error = None
+        self.reloads = 0
+        self.lock = asyncio.Lock()
+
+    async def current(self):
+        """Return the index of the current file, or raise InputError"""
+        async with self.lock:
+            stamp = file_stamp(self.path)
+            if stamp is None or stamp != self.stamp:
+                self.stamp = stamp
+                try:
+                    self.index = await asyncio.to_thread(load_contacts, self.path)
+                    self.error = None
+                except InputError as exc:
+                    self.index = None
+                    self.error = str(exc)
+                self.reloads += 1
+            if self.error is not None:
+                raise InputError(self.error)
+            return self.index
+
+
+async def watch(book, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await book.current()
+        except InputError:
+            pass
+
+
+class RequestParser(argparse.ArgumentParser):
+    """Command line parser reporting errors to the client instead of exiting"""
+
+    def exit(self, status=0, message=None):
+        raise InputError((message or "invalid command line").strip())
+
+    def error(self, message):
+        self.exit(2, message)
+
+
+async def respond(book, line):
+    try:
+        payload = json.loads(line)
+        argv, cwd = [str(arg) for arg in payload["argv"]], str(payload["cwd"])
+    except (ValueError, KeyError, TypeError):
+        return 2, ["invalid request"]
+    try:
+        args = cli.parse_args(argv, cli.build_parser(RequestParser))
+    except InputError as exc:
+        return 2, [str(exc)]
+    if cli.STDIO in (args.messages, args.output_dir):
+        return 2, ["the daemon cannot read stdin or write stdout"]
+    if os.path.realpath(os.path.join(cwd, args.contacts)) != book.path:
+        return 1, [f"daemon serves {book.path}, not {args.contacts}"]
+    try:
+        index = await book.current()
+    except InputError as exc:
+        return 1, [str(exc)]
+    messages = os.path.join(cwd, args.messages)
+    output_dir = os.path.join(cwd, args.output_dir)
+    try:
+        return await asyncio.to_thread(
+            cli.run, messages, book.path, output_dir, contacts=index, sampler=cli.new_sampler(args, cwd),
+            metrics=cli.new_metrics(args, cwd), **cli.options(args)
+        )
+    except Exception as exc:  # a bad batch must not take the daemon down
+        print(f"{PROG}: error: {messages}: {exc!r}", file=sys.stderr)
+        return 1, [f"daemon failed: {exc!r}"]
+
+
+async def handle(book, reader, writer):
+    try:
+        while line := await reader.readline():
+            status, errors = await respond(book, line)
+            writer.write(json.dumps({"status": status, "errors": errors}).encode("utf-8") + b"\n")
+            await writer.drain()
+    except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+async def serve(socket_path, contacts_path, watch_interval=WATCH_INTERVAL, ready=None):
+    """Serve batches on `socket_path` until SIGTERM or SIGINT
+
+    `ready()`, if given, is called once the socket accepts connections.
+    """
+    book = ContactBook(contacts_path)
+    await book.current()
+    if os.path.exists(socket_path):
+        if is_listening(socket_path):
+            raise InputError(f"{socket_path}: a daemon is already listening")
+        # left over by a daemon that did not exit cleanly
+        os.remove(socket_path)
+    server = await asyncio.start_unix_server(lambda r, w: handle(book, r, w), path=socket_path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    watcher = asyncio.create_task(watch(book, watch_interval))
+    try:
+        async with server:
+            if ready is not None:
+                ready()
+            await stop.wait()
+    finally:
+        watcher.cancel()
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be positive, got {number}")
+    return number
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Keep contacts.csv loaded and process message batches sent over a Unix socket.",
+    )
+    parser.add_argument("socket", help="path of the Unix domain socket to listen on")
+    parser.add_argument("contacts", help="path to contacts.csv")
+    parser.add_argument(
+        "--watch-interval", type=positive_float, default=WATCH_INTERVAL, metavar="SECONDS",
+        help=f"how often contacts.csv is checked for changes between batches (default: {WATCH_INTERVAL})",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    def ready():
+        print(f"{PROG}: serving {args.contacts} on {args.socket}", flush=True)
+
+    try:
+        asyncio.run(serve(args.socket, args.contacts, args.watch_interval, ready))
+    except InputError as exc:
+        print(f"{PROG}: error: {exc}", file=sys.stderr)
+        return 1
+    except OSError as exc:
+        print(f"{PROG}: error: cannot listen on {args.socket}: {exc.strerror or exc}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
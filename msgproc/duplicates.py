@@ -0,0 +1,162 @@
+"""Memory-bounded detection of repeated message ids (R17).
+
+A set of the 36-character id strings costs well over 100 bytes per id.
+Two detectors keep this down:
+
+- table: every id seen, packed into 16 bytes, in an open-addressing hash
+  table (IdTable) kept between 3/8 and 3/4 full, 21 to 43 bytes per id;
+- bloom: a first pass over the id column of messages.csv feeds a Bloom
+  filter of BLOOM_BITS bits per row and keeps the ids it has already seen,
+  true duplicates and a few false positives. Only those suspects are then
+  tracked exactly while the messages are processed.
+
+Both are exact. Ids are compared as strings: ids that are not lower case
+are kept apart, as str, in a set of their own.
+"""
+
+import os
+import struct
+from hashlib import blake2b
+
+from msgproc.reader import iter_rows
+
+DETECTORS = ("table", "bloom")
+# what happens to the second and later messages with the same id
+POLICIES = ("rename", "skip", "fail")
+
+# Open-addressing table: 16-byte slots, grown past 3/4 full.
+INITIAL_SLOTS = 1 << 16
+EMPTY = bytes(16)
+SLOT = struct.Struct("16s")
+
+BLOOM_BITS = 10
+BLOOM_HASHES = 7
+# Smallest possible messages.csv row, bounds the number of rows of a file.
+MIN_ROW_SIZE = 45
+
+
+def pack_id(msg_id):
+    """16 bytes of a lower case UUID, None for ids that must stay strings"""
+    # ids with no letter at all are not lower case either, they are rare
+    if not msg_id.islower():
+        return None
+    try:
+        key = bytes.fromhex(msg_id.replace("-", ""))
+    except ValueError:
+        return None
+    # an all-zero key marks an empty slot, UUID v4 have a non-zero version nibble
+    return key if len(key) == 16 and key != EMPTY else None
+
+
+class IdTable:
+    """Set of ids, packed as 16-byte keys in a linear-probing hash table"""
+
+    def __init__(self, slots=INITIAL_SLOTS):
+        self.slots = bytearray(16 * slots)
+        self.mask = slots - 1
+        self.size = 0
+        self.others = set()
+
+    def __len__(self):
+        return self.size + len(self.others)
+
+    def add(self, msg_id):
+        """Add `msg_id`, return False if it was already there"""
+        key = pack_id(msg_id)
+        if key is None:
+            if msg_id in self.others:
+                return False
+            self.others.add(msg_id)
+            return True
+        if 4 * (self.size + 1) > 3 * (self.mask + 1):
+            self.grow()
+        return self.insert(key)
+
+    def insert(self, key):
+        # slots are compared in place, slicing would copy them
+        slots = self.slots
+        mask = self.mask
+        i = hash(key) & mask
+        while True:
+            offset = i << 4
+            if slots.startswith(EMPTY, offset):
+                slots[offset:offset + 16] = key
+                self.size += 1
+                return True
+            if slots.startswith(key, offset):
+                return False
+            i = (i + 1) & mask
+
+    def grow(self):
+        old = self.slots
+        self.slots = bytearray(2 * len(old))
+        self.mask = 2 * self.mask + 1
+        self.size = 0
+        for (key,) in SLOT.iter_unpack(old):
+            if key != EMPTY:
+                self.insert(key)
+
+    def memory(self):
+        """Bytes held by the table, strings of `others` excluded"""
+        return len(self.slots)
+
+
+class BloomFilter:
+    """Bloom filter of `bits` bits over byte strings"""
+
+    def __init__(self, bits, hashes=BLOOM_HASHES):
+        self.bits = max(bits, 64)
+        self.hashes = hashes
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def add(self, value):
+        """Add `value`, return True if it may have been added before"""
+        digest = blake2b(value, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        array = self.array
+        seen = True
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not array[byte] & mask:
+                array[byte] |= mask
+                seen = False
+        return seen
+
+
+def suspected_duplicates(path, spool=None):
+    """First pass over messages.csv: ids that may be repeated"""
+    try:
+        rows = max(os.path.getsize(path) // MIN_ROW_SIZE, 1)
+    except OSError:
+        rows = 1  # iter_rows reports the error
+    bloom = BloomFilter(rows * BLOOM_BITS)
+    suspects = set()
+    for _, (msg_id,) in iter_rows(path, ("id",), spool):
+        if bloom.add(msg_id.encode("utf-8")):
+            suspects.add(msg_id)
+    return suspects
+
+
+class SuspectSet:
+    """Ids seen so far, tracked only for the suspects of a Bloom filter pass"""
+
+    def __init__(self, suspects):
+        self.suspects = suspects
+        self.seen = set()
+
+    def add(self, msg_id):
+        if msg_id not in self.suspects:
+            return True
+        if msg_id in self.seen:
+            return False
+        self.seen.add(msg_id)
+        return True
+
+
+def new_detector(detector, messages_path, spool=None):
+    """Return an object whose add(id) tells whether an id is seen for the first time"""
+    if detector == "bloom":
+        return SuspectSet(suspected_duplicates(messages_path, spool))
+    return IdTable()
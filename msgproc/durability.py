@@ -0,0 +1,151 @@
+"""Crash-safe output files.
+
+Every output file is written under a hidden temporary name, `.<name>.tmp`
+in the same directory, and renamed once complete: neither a reader nor a
+run killed midway can leave a truncated `<key>.json` behind. A write that
+fails (ENOSPC, an unreadable spooled content) removes its temporary file.
+A killed run may leave temporary files, the next run writing the same keys
+replaces them.
+
+`durability` decides when the files reach the disk:
+
+- none: no fsync, files stay in the page cache until the kernel writes
+  them back, a power loss can lose the last ones written;
+- batch: files are renamed `sync_files` at a time, or every `sync_interval`
+  milliseconds, after an fdatasync of each, then the directory is synced
+  once. Back-to-back fdatasync calls share journal commits. The interval
+  is checked as each file is written: while the input stalls, the files
+  written before it wait for the next one, or the end of the run, however
+  long that takes;
+- strict: each file is synced, renamed and its directory synced before the
+  next one is written.
+"""
+
+import os
+import time
+
+DURABILITIES = ("none", "batch", "strict")
+SYNC_FILES = 256
+SYNC_INTERVAL = 1000
+
+
+def temporary_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.tmp")
+
+
+def fsync_directory(path):
+    """Persist the entries of a directory, renames included"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fdatasync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
+def discard(tmp):
+    """Remove the temporary file of a failed write, if it was created"""
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+
+
+def commit(tmp, path, durability="none"):
+    """Rename the complete file `tmp` to `path`, synced as per `durability`"""
+    if durability != "none":
+        fdatasync_path(tmp)
+    os.replace(tmp, path)
+    if durability != "none":
+        fsync_directory(os.path.dirname(path) or ".")
+
+
+class FileSink:
+    """Atomic writes of whole files to `directory`, see the module docstring
+
+    Names may hold subdirectories (see msgproc.layout), created on first use.
+    """
+
+    def __init__(self, directory, durability="none", sync_files=SYNC_FILES, sync_interval=SYNC_INTERVAL):
+        self.directory = directory
+        self.durability = durability
+        self.sync_files = sync_files
+        self.sync_interval = sync_interval / 1000
+        # (temporary path, final path) of the files awaiting the next sync, batch mode
+        self.pending = []
+        self.synced_at = time.monotonic()
+        # directories known to exist, `directory` as os.path.dirname spells it
+        self.directories = {os.path.dirname(os.path.join(directory, "_"))}
+
+    def write(self, name, pieces):
+        """Write the concatenation of the bytes `pieces` to the file `name`,
+        return its size"""
+        path = os.path.join(self.directory, name)
+        folder = os.path.dirname(path)
+        if folder not in self.directories:
+            self.make_directory(folder)
+        tmp = temporary_path(path)
+        try:
+            with open(tmp, "wb") as f:
+                f.writelines(pieces)
+                size = f.tell()
+                if self.durability == "strict":
+                    f.flush()
+                    os.fdatasync(f.fileno())
+            if self.durability != "batch":
+                os.replace(tmp, path)
+        except BaseException:
+            discard(tmp)
+            raise
+        if self.durability != "batch":
+            if self.durability == "strict":
+                fsync_directory(folder)
+            return size
+        self.pending.append((tmp, path))
+        if len(self.pending) >= self.sync_files or time.monotonic() - self.synced_at >= self.sync_interval:
+            self.sync()
+        return size
+
+    def make_directory(self, folder):
+        """Create `folder` and its missing parents, each synced in its parent
+        unless durability is none"""
+        parent = os.path.dirname(folder)
+        if parent not in self.directories:
+            self.make_directory(parent)
+        try:
+            os.mkdir(folder)
+        except FileExistsError:
+            pass
+        else:
+            if self.durability != "none":
+                fsync_directory(parent)
+        self.directories.add(folder)
+
+    def sync(self):
+        """Sync and rename the pending files, then sync their directories once"""
+        for tmp, _ in self.pending:
+            fdatasync_path(tmp)
+        for tmp, path in self.pending:
+            os.replace(tmp, path)
+        for folder in {os.path.dirname(path) for _, path in self.pending}:
+            fsync_directory(folder)
+        self.pending = []
+        self.synced_at = time.monotonic()
+
+    def close(self):
+        self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # files written before an error are complete, they are kept
+        self.close()
@@ -0,0 +1,2 @@
+class InputError(Exception):
+    """Raised when an input file is missing, malformed or inconsistent."""
@@ -0,0 +1,111 @@
+"""Layout of the `<key>.json` files in the output directory.
+
+Flat, the default, puts every file in the output directory itself. Sharded
+spreads them over `depth` levels of subdirectories named after successive
+pairs of hex digits of the key, lower case:
+
+    output/1f/f8/1ff8c2a4-....json          depth 2
+
+Each level divides the size of a directory by 256: at depth 2, 1M files
+make 256 directories of 256 shards each, 65536 leaf directories of about
+15 files. Repeated ids `<id>_<n>` go to
+the shard of `<id>`. Keys are UUIDs (R06), longer than MAX_DEPTH pairs.
+
+OutputLayout finds and lists the files of either layout.
+"""
+
+import os
+
+LAYOUTS = ("flat", "sharded")
+DEFAULT_DEPTH = 2
+MAX_DEPTH = 4
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def output_name(key, depth=0):
+    """Path of the file of `key`, relative to the output directory"""
+    if not depth:
+        return f"{key}.json"
+    prefix = key[:2 * depth].lower()
+    return "/".join([prefix[i:i + 2] for i in range(0, 2 * depth, 2)] + [f"{key}.json"])
+
+
+def is_shard(name):
+    return len(name) == 2 and HEX_DIGITS.issuperset(name)
+
+
+class OutputLayout:
+    """The `<key>.json` files of `output_dir`, under `depth` levels of shards"""
+
+    def __init__(self, output_dir, depth=0):
+        self.output_dir = output_dir
+        self.depth = depth
+
+    @classmethod
+    def detect(cls, output_dir):
+        """Return the layout of `output_dir`, found from its first shard directories"""
+        depth = 0
+        directory = output_dir
+        while depth < MAX_DEPTH:
+            shard = next((entry.path for entry in scan(directory) if entry.is_dir() and is_shard(entry.name)), None)
+            if shard is None:
+                break
+            directory = shard
+            depth += 1
+        return cls(output_dir, depth)
+
+    def path(self, key):
+        return os.path.join(self.output_dir, output_name(key, self.depth))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def find(self, key):
+        """Return the path of the file of `key`, or None if it was not written"""
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def levels(self):
+        """Return the shard directories of each level, the output directory first"""
+        levels = [[self.output_dir]]
+        for _ in range(self.depth):
+            levels.append([entry.path for directory in levels[-1] for entry in scan(directory)
+                           if entry.is_dir() and is_shard(entry.name)])
+        return levels
+
+    def directories(self):
+        """Yield the directories holding output files"""
+        yield from self.levels()[-1]
+
+    def prune(self):
+        """Remove the empty shard directories, deepest first"""
+        for level in reversed(self.levels()[1:]):
+            for directory in level:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+    def __iter__(self):
+        """Yield (key, path) for every output file, in no particular order"""
+        for directory in self.directories():
+            for entry in scan(directory):
+                name = entry.name
+                # hidden: manifest and files being written
+                if name.endswith(".json") and not name.startswith(".") and entry.is_file():
+                    yield name[:-5], entry.path
+
+    def keys(self):
+        return [key for key, _ in self]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def scan(directory):
+    """Yield the entries of `directory`, none if it does not exist"""
+    try:
+        with os.scandir(directory) as entries:
+            yield from entries
+    except FileNotFoundError:
+        return
@@ -0,0 +1,99 @@
+"""Incremental re-processing: skip messages whose output is up to date.
+
+The manifest, stored as `.manifest.json` in the output directory, maps the
+output key of every message written by the last run to a digest of the
+fields its document is built from, contact name included. A rerun only
+encodes and writes messages that are new, changed or whose contact was
+renamed, and removes the files of messages that are gone from the input.
+A rerun with another layout (see msgproc.layout) rewrites every message
+and removes the files of the previous one.
+"""
+
+import hashlib
+import json
+import os
+
+from msgproc.durability import commit, temporary_path
+from msgproc.layout import OutputLayout
+from msgproc.spool import SpooledField
+
+MANIFEST_NAME = ".manifest.json"
+# Bump when the output document or the digest changes, older manifests are then ignored.
+MANIFEST_VERSION = 2
+
+
+def message_digest(message):
+    """Digest of the fields of a message whose contact has been resolved"""
+    digest = hashlib.blake2b(digest_size=16)
+    fields = (message.key, message.id, str(message.datetime), message.direction, message.contact)
+    digest.update("\x1f".join(fields).encode("utf-8"))
+    digest.update(b"\x1f")
+    if isinstance(message.content, SpooledField):
+        for chunk in message.content.iter_bytes(1 << 20):
+            digest.update(chunk)
+    else:
+        digest.update(message.content.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Digests of the previous run, and of the current one as it goes"""
+
+    def __init__(self, output_dir, previous=None, shard_depth=0, previous_layout=None):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.output_dir = output_dir
+        self.layout = OutputLayout(output_dir, shard_depth)
+        # where the files of `previous` are, the layout of this run by default
+        self.previous_layout = previous_layout or self.layout
+        self.previous = previous or {}
+        self.current = {}
+
+    @classmethod
+    def load(cls, output_dir, shard_depth=0):
+        """Read the manifest of `output_dir`, an unreadable one counts as empty
+
+        Output files are looked up under `shard_depth` levels of shards (see
+        msgproc.layout), those of the previous run where they are found.
+        """
+        previous = {}
+        try:
+            with open(os.path.join(output_dir, MANIFEST_NAME), encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                previous = data["messages"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+        return cls(output_dir, previous, shard_depth, OutputLayout.detect(output_dir) if previous else None)
+
+    def is_current(self, message):
+        """Record `message` and tell whether its output file is up to date"""
+        digest = message_digest(message)
+        self.current[message.key] = digest
+        return (
+            self.previous.get(message.key) == digest
+            and self.layout.exists(message.key)
+        )
+
+    def remove_stale(self):
+        """Delete the output files of messages absent from this run, and
+        every file of the previous run if the layout changed"""
+        moved = self.previous_layout.depth != self.layout.depth
+        stale = self.previous.keys() if moved else self.previous.keys() - self.current.keys()
+        removed = 0
+        for key in stale:
+            try:
+                os.remove(self.previous_layout.path(key))
+            except FileNotFoundError:
+                continue
+            if key not in self.current:
+                removed += 1
+        if moved:
+            self.previous_layout.prune()
+        return removed
+
+    def save(self, durability="none"):
+        data = {"version": MANIFEST_VERSION, "messages": self.current}
+        tmp = temporary_path(self.path)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        commit(tmp, self.path, durability)
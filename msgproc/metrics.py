@@ -0,0 +1,296 @@
+"""Live metrics of a processing run.
+
+Metrics counts the rows parsed and rejected, the messages and bytes
+written, and keeps a latency histogram per pipeline stage:
+
+- load: what is done before the first message, each step timed once
+  (timed()): contact index, Bloom filter pass, incremental manifest;
+- parse: reading and validating messages.csv;
+- duplicates, contacts, incremental, encode, datetime: the stages of
+  msgproc.pipeline, in that order;
+- write: the output writer, from the handing of a message to the request
+  of the next one (submission only with several workers).
+
+Each stage is metered by wrapping the stream it yields (meter()): the time
+spent getting a message out of it, less the time spent in the metered
+stages upstream, is the latency of that stage for that message. The
+datetime stage formats a batch at once, the cost shows on the first
+message of each batch. breakdown() tells the share of the run spent in
+each stage, the rest ("other") being startup, output directory creation
+and the final sync.
+
+With a `path`, a thread rewrites the metrics to that file every `interval`
+milliseconds and once more at the end of the run, atomically: a JSON
+document if the path ends in `.json`, the Prometheus text exposition
+format otherwise (e.g. a `.prom` file read by the node exporter).
+Bulk formats only count the bytes written once their file is complete.
+"""
+
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from msgproc.durability import commit, temporary_path
+
+METRICS_INTERVAL = 1000
+COUNTERS = ("rows_parsed", "rows_rejected", "messages_written", "bytes_written")
+STAGES = ("load", "parse", "duplicates", "contacts", "incremental", "encode", "datetime", "write")
+# Upper bounds of the histogram buckets, in seconds, the last one is +Inf.
+BUCKETS = (
+    1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+    1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0,
+)
+
+HELP = {
+    "rows_parsed": "Rows of messages.csv parsed and validated",
+    "rows_rejected": "Invalid rows of messages.csv",
+    "messages_written": "Output documents written",
+    "bytes_written": "Bytes of output written",
+}
+
+
+class Histogram:
+    """Count of observations per bucket of BUCKETS, and their sum"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        """(upper bound, observations up to it), the last bound is inf"""
+        total = 0
+        pairs = []
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile, None if empty"""
+        pairs = self.cumulative()
+        rank = q * pairs[-1][1]
+        if not rank:
+            return None
+        return next(bound for bound, total in pairs if total >= rank)
+
+
+class Metrics:
+    """Counters and stage latencies of a run, see the module docstring"""
+
+    def __init__(self, path=None, interval=METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval / 1000
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.stages = {stage: Histogram() for stage in STAGES}
+        # time spent in the metered stages below the one being timed
+        self.inner = 0.0
+        self.started = self.finished = None
+        # written count and time of the previous snapshot, for the current rate
+        self.last = (0, None)
+        self.stop = threading.Event()
+        self.thread = None
+
+    def add(self, counter, value=1):
+        self.counters[counter] += value
+
+    def wrote(self, files, size):
+        self.counters["messages_written"] += files
+        self.counters["bytes_written"] += size
+
+    def meter(self, messages, stage, downstream=None):
+        """Yield `messages`, timing `stage` for each, and the `downstream`
+        consumer between two of them"""
+        histogram = self.stages[stage]
+        consumer = None if downstream is None else self.stages[downstream]
+        clock = time.perf_counter
+        messages = iter(messages)
+        while True:
+            outer = self.inner
+            self.inner = 0.0
+            start = clock()
+            try:
+                message = next(messages)
+            except StopIteration:
+                self.inner = outer + clock() - start
+                return
+            elapsed = clock() - start
+            histogram.observe(elapsed - self.inner)
+            self.inner = outer + elapsed
+            if consumer is None:
+                yield message
+            else:
+                start = clock()
+                yield message
+                consumer.observe(clock() - start)
+
+    @contextmanager
+    def timed(self, stage):
+        """Time the block as one call of `stage`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage].observe(time.perf_counter() - start)
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def snapshot(self):
+        """Current metrics as a JSON-serializable dict"""
+        now = time.monotonic()
+        elapsed = self.elapsed()
+        counters = dict(self.counters, rows_parsed=self.stages["parse"].count)
+        # messages reaching the writer, counted live in every format
+        handed = self.stages["write"].count
+        count, at = self.last
+        if self.finished is not None or at is None:
+            rate = handed / elapsed if elapsed else 0.0
+        else:
+            rate = (handed - count) / (now - at) if now > at else 0.0
+        self.last = (handed, now)
+        return {
+            "elapsed_seconds": elapsed,
+            "done": self.finished is not None,
+            "counters": counters,
+            "messages_per_second": rate,
+            "average_messages_per_second": handed / elapsed if elapsed else 0.0,
+            "stages": {
+                stage: {
+                    "count": histogram.count,
+                    "seconds": histogram.sum,
+                    "buckets": [[bound, total] for bound, total in histogram.cumulative()[:-1]],
+                }
+                for stage, histogram in self.stages.items()
+                if histogram.count
+            },
+        }
+
+    def render(self, snapshot):
+        """Text of the metrics file for `snapshot`"""
+        if self.path.endswith(".json"):
+            return json.dumps(snapshot) + "\n"
+        return prometheus_text(snapshot)
+
+    def flush(self):
+        if self.path is None:
+            return
+        tmp = temporary_path(self.path)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render(self.snapshot()))
+        commit(tmp, self.path)
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        """Start the clock, and the thread rewriting the metrics file"""
+        self.started = time.monotonic()
+        self.last = (0, None)
+        if self.path is not None:
+            self.flush()
+            self.thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+            self.thread.start()
+
+    def close(self):
+        """Stop the clock and write the final metrics"""
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+        self.finished = time.monotonic()
+        self.flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def report(self):
+        """Summary printed by --stats"""
+        snapshot = self.snapshot()
+        counters = snapshot["counters"]
+        lines = [f"{name.replace('_', ' '):<17} {counters[name]}" for name in COUNTERS]
+        lines.append(f"{'elapsed':<17} {snapshot['elapsed_seconds']:.3f} s, "
+                     f"{snapshot['average_messages_per_second']:.0f} messages/s")
+        lines.append(f"{'stage':<12} {'calls':>9} {'seconds':>9} {'share':>7} {'mean':>9} {'p50 <=':>9} "
+                     f"{'p99 <=':>9}")
+        for stage, row in breakdown(snapshot).items():
+            line = f"{stage:<12} {row['calls']:>9} {row['seconds']:>9.3f} {row['share']:>7.1%}"
+            histogram = self.stages.get(stage)
+            if histogram is not None:
+                line += (f" {format_seconds(row['seconds'] / row['calls']):>9}"
+                         f" {format_seconds(histogram.quantile(0.5)):>9} {format_seconds(histogram.quantile(0.99)):>9}")
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def breakdown(snapshot):
+    """{stage: {"calls", "seconds", "share"}} of a Metrics.snapshot(), in
+    pipeline order, "other" last: the share of the elapsed time spent
+    in each stage, and outside of them"""
+    elapsed = snapshot["elapsed_seconds"]
+    rows = {
+        stage: {
+            "calls": stats["count"],
+            "seconds": stats["seconds"],
+            "share": stats["seconds"] / elapsed if elapsed else 0.0,
+        }
+        for stage, stats in snapshot["stages"].items()
+    }
+    other = max(elapsed - sum(row["seconds"] for row in rows.values()), 0.0)
+    rows["other"] = {"calls": 0, "seconds": other, "share": other / elapsed if elapsed else 0.0}
+    return rows
+
+
+def format_seconds(seconds):
+    if seconds == float("inf"):
+        return "inf"
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f}ms"
+    return f"{seconds:.2f}s"
+
+
+def prometheus_text(snapshot):
+    """Prometheus text exposition of a Metrics.snapshot()"""
+    lines = []
+    for name, value in snapshot["counters"].items():
+        lines += [
+            f"# HELP msgproc_{name}_total {HELP[name]}",
+            f"# TYPE msgproc_{name}_total counter",
+            f"msgproc_{name}_total {value}",
+        ]
+    for name, text in (
+        ("messages_per_second", "Messages handed to the writer per second since the previous update"),
+        ("elapsed_seconds", "Duration of the run so far"),
+    ):
+        lines += [f"# HELP msgproc_{name} {text}", f"# TYPE msgproc_{name} gauge", f"msgproc_{name} {snapshot[name]}"]
+    lines += [
+        "# HELP msgproc_stage_seconds Latency of each pipeline stage per message",
+        "# TYPE msgproc_stage_seconds histogram",
+    ]
+    for stage, histogram in snapshot["stages"].items():
+        for bound, total in histogram["buckets"]:
+            lines.append(f'msgproc_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {total}')
+        lines += [
+            f'msgproc_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}',
+            f'msgproc_stage_seconds_sum{{stage="{stage}"}} {histogram["seconds"]}',
+            f'msgproc_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}',
+        ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,233 @@
+"""Generator pipeline: parse, resolve contact, encode, format, write.
+
+Each stage consumes and yields one message at a time so that memory use does
+not grow with the number of rows in messages.csv.
+"""
+
+import os
+import sys
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+
+from msgproc.bulk import write_bulk
+from msgproc.contacts import (
+    DEFAULT_PARTITIONS,
+    load_contacts,
+    merge_join,
+    resolve_contacts,
+    spill_join,
+)
+from msgproc.duplicates import new_detector
+from msgproc.durability import SYNC_FILES, SYNC_INTERVAL
+from msgproc.errors import InputError
+from msgproc.layout import DEFAULT_DEPTH
+from msgproc.manifest import Manifest
+from msgproc.ranges import iter_messages_parallel
+from msgproc.reader import iter_messages
+from msgproc.snapshot import load_cached_contacts
+from msgproc.spool import Spool
+from msgproc.stream import STDIO, PipeFeed, write_stream
+from msgproc.transform import encode_content, format_datetime, format_timestamps
+from msgproc.validation import ValidationError
+from msgproc.writer import iter_batches, write_messages, write_messages_parallel
+
+# Messages whose timestamps are formatted together, fewer when their contents
+# reach msgproc.spool.BATCH_CONTENT (see msgproc.writer.iter_batches).
+DATETIME_BATCH = 1024
+
+
+@dataclass
+class Summary:
+    """Outcome of a processing run"""
+
+    written: int = 0
+    # incremental runs only: messages left untouched, stale files removed
+    skipped: int = 0
+    removed: int = 0
+    # (message id, output key or None if skipped) for every repeated id, in input order
+    duplicates: list = field(default_factory=list)
+
+
+def encode_contents(messages):
+    for message in messages:
+        yield message._replace(content=encode_content(message.content))
+
+
+def format_datetimes(messages, ready=None):
+    for batch in iter_batches(messages, DATETIME_BATCH, ready):
+        try:
+            formatted = format_timestamps([message.datetime for message in batch])
+        except OverflowError:
+            # report the first message of the batch that is out of range
+            for message in batch:
+                try:
+                    format_datetime(message.datetime)
+                except OverflowError:
+                    raise InputError(
+                        f"line {message.line}: datetime out of range: {message.datetime}"
+                    ) from None
+            raise
+        for message, datetime in zip(batch, formatted):
+            yield message._replace(datetime=datetime)
+
+
+def disambiguate_ids(messages, summary, detector, policy="rename"):
+    """Apply `policy` to repeated ids (R17): give them distinct output keys
+    `<id>_<n>`, skip them or fail (see msgproc.duplicates)"""
+    repeats = {}
+    for message in messages:
+        if detector.add(message.id):
+            yield message
+            continue
+        if policy == "fail":
+            raise InputError(f"line {message.line}: duplicate message id {message.id}")
+        if policy == "skip":
+            summary.duplicates.append((message.id, None))
+            continue
+        repeats[message.id] = repeats.get(message.id, 0) + 1
+        message = message._replace(key=f"{message.id}_{repeats[message.id]}")
+        summary.duplicates.append((message.id, message.key))
+        yield message
+
+
+def skip_unchanged(messages, manifest, summary):
+    """Drop messages whose output file is up to date (incremental mode)"""
+    for message in messages:
+        if manifest.is_current(message):
+            summary.skipped += 1
+        else:
+            yield message
+
+
+def metered(messages, metrics, stage, downstream=None):
+    """Stream of `stage` timed by `metrics`, unchanged without metrics"""
+    if metrics is None:
+        return messages
+    return metrics.meter(messages, stage, downstream)
+
+
+def timed(metrics, stage):
+    """Context timing a step of `stage` in `metrics`, if given"""
+    return nullcontext() if metrics is None else metrics.timed(stage)
+
+
+def join_contacts(messages, contacts_path, join="index", partitions=DEFAULT_PARTITIONS, contacts=None,
+                  contacts_cache=None):
+    """Apply the contact resolution stage selected by `join` (see msgproc.contacts)
+
+    The index join uses `contacts`, a ContactIndex, when given, or the
+    snapshot of contacts.csv in the `contacts_cache` directory (see
+    msgproc.snapshot).
+    """
+    if join == "merge":
+        return merge_join(messages, contacts_path)
+    if join == "spill":
+        return spill_join(messages, contacts_path, partitions)
+    if contacts is None and contacts_cache is not None:
+        contacts = load_cached_contacts(contacts_path, contacts_cache)
+    elif contacts is None:
+        contacts = load_contacts(contacts_path)
+    return resolve_contacts(messages, contacts)
+
+
+def process(
+    messages_path,
+    contacts_path,
+    output_dir,
+    workers=1,
+    pool="thread",
+    join="index",
+    partitions=DEFAULT_PARTITIONS,
+    fmt="json",
+    compression="none",
+    incremental=False,
+    validation="fail-fast",
+    contacts=None,
+    contacts_cache=None,
+    durability="none",
+    sync_files=SYNC_FILES,
+    sync_interval=SYNC_INTERVAL,
+    duplicates="rename",
+    detector="table",
+    parse_workers=1,
+    layout="flat",
+    shard_depth=DEFAULT_DEPTH,
+    metrics=None,
+):
+    """Convert messages.csv into one JSON file per message in `output_dir`
+
+    With `workers` > 1, serialization and file writes run on a thread or
+    process `pool` while parsing and contact resolution stay on the caller.
+    Any other `fmt` than "json" writes a single stream or archive instead
+    (see msgproc.bulk). With `incremental`, messages already written with
+    the same content by the previous run are skipped (see msgproc.manifest).
+    `validation` tells whether to stop at the first invalid row or to report
+    all of them (see msgproc.validation). `contacts`, a ContactIndex of
+    `contacts_path` loaded beforehand, saves reading it again (see
+    msgproc.daemon). Otherwise, with a `contacts_cache` directory, the
+    index join maps a snapshot of contacts.csv kept there across runs (see
+    msgproc.snapshot). Output files are written atomically and synced to disk
+    as per `durability`, every `sync_files` files or `sync_interval`
+    milliseconds in batch mode (see msgproc.durability). Repeated ids are
+    found by `detector` and handled as per the `duplicates` policy (see
+    msgproc.duplicates). With `parse_workers` > 1, messages.csv is parsed
+    on that many processes (see msgproc.ranges). A "sharded" `layout`
+    spreads the JSON files over `shard_depth` levels of subdirectories (see
+    msgproc.layout). Counters and the time spent in each stage are
+    recorded in `metrics`, a msgproc.metrics.Metrics, if given.
+    `messages_path` "-" reads stdin, `output_dir` "-" writes one document
+    per line to stdout (see msgproc.stream).
+    Oversized contents are spooled to disk for the duration of the run
+    (see msgproc.spool).
+    """
+    summary = Summary()
+    depth = shard_depth if layout == "sharded" else 0
+    with nullcontext() if metrics is None else metrics:
+        try:
+            with Spool() as spool:
+                ready = None
+                if messages_path == STDIO:
+                    feed = PipeFeed()
+                    ready = feed.ready
+                    messages = iter_messages(feed.name, spool, validation, feed)
+                elif parse_workers > 1:
+                    messages = iter_messages_parallel(messages_path, parse_workers, spool, validation)
+                else:
+                    messages = iter_messages(messages_path, spool, validation)
+                messages = metered(messages, metrics, "parse")
+                with timed(metrics, "load"):
+                    seen = new_detector(detector, messages_path, spool)
+                messages = metered(disambiguate_ids(messages, summary, seen, duplicates), metrics, "duplicates")
+                with timed(metrics, "load"):
+                    messages = join_contacts(messages, contacts_path, join, partitions, contacts, contacts_cache)
+                messages = metered(messages, metrics, "contacts")
+                if incremental:
+                    with timed(metrics, "load"):
+                        manifest = Manifest.load(output_dir, depth)
+                    messages = metered(skip_unchanged(messages, manifest, summary), metrics, "incremental")
+                messages = metered(encode_contents(messages), metrics, "encode")
+                messages = metered(format_datetimes(messages, ready), metrics, "datetime", "write")
+                if output_dir != STDIO:
+                    os.makedirs(output_dir, exist_ok=True)
+                if output_dir == STDIO:
+                    summary.written = write_stream(messages, sys.stdout.buffer, ready, metrics)
+                elif fmt != "json":
+                    summary.written = write_bulk(messages, output_dir, fmt, compression, durability, metrics)
+                elif workers > 1:
+                    summary.written = write_messages_parallel(
+                        messages, output_dir, workers, pool,
+                        durability=durability, sync_files=sync_files, sync_interval=sync_interval,
+                        shard_depth=depth, metrics=metrics,
+                    )
+                else:
+                    summary.written = write_messages(
+                        messages, output_dir, durability, sync_files, sync_interval, depth, metrics
+                    )
+        except ValidationError as exc:
+            if metrics is not None:
+                metrics.add("rows_rejected", exc.count)
+            raise
+        if incremental:
+            summary.removed = manifest.remove_stale()
+            manifest.save(durability)
+    return summary
@@ -0,0 +1,267 @@
+"""Parallel parsing of messages.csv over byte ranges.
+
+The file is memory-mapped and cut into ranges of about RANGE_SIZE bytes,
+parsed by the csv module on worker processes and merged back in file order.
+
+Quoted fields may hold commas and line breaks (R16) and be arbitrarily long
+(R21), a range can only start at a record boundary. Each range starts at
+the first line start past its nominal offset where the quotes counted since
+the start of the file are even, which is a record boundary as long as
+quotes only enclose whole fields. A worker parses its range up to the end
+of the first record ending at or past the end of the range, and reports
+where that record ends: the next range is kept only if it starts there,
+otherwise it is parsed again from there. The rows are those of a
+sequential pass whatever the split points, stray quotes included.
+
+Files that cannot be mapped (empty files, pipes) are read sequentially.
+"""
+
+import codecs
+import csv
+import io
+import mmap
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from msgproc.errors import InputError
+from msgproc.reader import MESSAGE_COLUMNS, RowError, iter_rows, parse_messages, read_fields, read_header
+from msgproc.spool import LineFeed, Spool
+
+RANGE_SIZE = 4 << 20
+# Joins the values of a column sent back by a worker.
+SEPARATOR = "\0"
+# Ranges submitted ahead of the one being consumed, per worker.
+RANGES_AHEAD = 2
+# Line starts tried after the nominal end of a range before giving up on
+# quote parity.
+RESYNC_LINES = 1000
+
+
+class MappedText:
+    """UTF-8 text of a mapped file from byte `start` on, read as a file
+    opened with newline=""
+
+    The text up to byte `end`, a line start, is decoded at once. `pos`, the
+    offset of the bytes consumed, is only followed past `end`: it stays at
+    `start` until the text up to `end` has been read.
+    """
+
+    def __init__(self, mm, start, end=None):
+        self.mm = mm
+        self.pos = start
+        self.end = start if end is None else end
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.head = None
+        if self.end > start:
+            try:
+                text = mm[start:self.end].decode("utf-8")
+            except UnicodeDecodeError:
+                # decoded line by line, the error is raised at its row
+                self.end = start
+            else:
+                self.head = io.StringIO(text, newline="")
+                self.head_size = len(text)
+
+    def readline(self, limit=-1):
+        if self.head is not None:
+            line = self.head.readline(limit)
+            self.skip_head()
+            if line:
+                return line
+        mm = self.mm
+        newline = mm.find(b"\n", self.pos)
+        stop = len(mm) if newline < 0 else newline + 1
+        # a lone \r ends a line too
+        cr = mm.find(b"\r", self.pos, stop)
+        if cr >= 0 and cr != newline - 1:
+            stop = cr + 1
+        return self.take(stop, limit)
+
+    def read(self, size=-1):
+        if self.head is not None:
+            text = self.head.read(size)
+            self.skip_head()
+            if text:
+                return text
+        return self.take(len(self.mm), size)
+
+    def skip_head(self):
+        """Move `pos` to `end` once the decoded text is read"""
+        if self.head.tell() == self.head_size:
+            self.head = None
+            self.pos = self.end
+
+    def take(self, stop, limit):
+        """Decode the bytes up to `stop`, at most `limit` characters of them"""
+        end = len(self.mm)
+        if limit < 0 or stop - self.pos <= limit:
+            text = self.decoder.decode(self.mm[self.pos:stop], stop == end)
+            self.pos = stop
+            return text
+        # a character takes at least one byte, never more than `limit` are decoded
+        pieces = []
+        size = 0
+        while size < limit and self.pos < stop:
+            chunk_end = min(self.pos + limit - size, stop)
+            piece = self.decoder.decode(self.mm[self.pos:chunk_end], chunk_end == end)
+            self.pos = chunk_end
+            pieces.append(piece)
+            size += len(piece)
+        return "".join(pieces)
+
+
+def iter_ranges(mm, start, range_size):
+    """Yield (start, end) ranges covering `mm` from `start`, split at line
+    starts where the quotes seen since the start of the file are even"""
+    size = len(mm)
+    counted = quotes = 0
+    while start + range_size < size:
+        split = line_start(mm, start + range_size)
+        candidate = split
+        for _ in range(RESYNC_LINES):
+            quotes += mm[counted:split].count(b'"')
+            counted = split
+            if quotes % 2 == 0 or split >= size:
+                break
+            split = line_start(mm, split)
+        else:
+            # a stray quote, or a long quoted field: the workers will tell
+            quotes -= mm[candidate:counted].count(b'"')
+            split = counted = candidate
+        if split >= size:
+            break
+        yield start, split
+        start = split
+    yield start, size
+
+
+def line_start(mm, pos):
+    """Offset of the first line start after `pos`, or the end of `mm`"""
+    newline = mm.find(b"\n", pos)
+    return len(mm) if newline < 0 else newline + 1
+
+
+def parse_mapped(mm, start, end, width, indexes, keep, spool=None):
+    """Parse the records of a mapped messages.csv from byte `start` to the
+    end of the first record ending at or past byte `end`
+
+    Return the (line, fields) of the rows, lines counted from `start`, the
+    offset and line count where parsing stopped, and the RowError that
+    stopped it early if any.
+    """
+    text = MappedText(mm, start, end)
+    spooled = {}
+    feed = LineFeed(text, spool, spooled)
+    reader = csv.reader(feed)
+    rows = []
+    try:
+        for row in read_fields(reader, width, indexes, keep, spooled):
+            rows.append(row)
+            if text.pos >= end:
+                # text read past the end of a large record is not consumed yet
+                stop = text.pos - len(feed.unread().encode("utf-8"))
+                if stop >= end:
+                    break
+        else:
+            stop = len(mm)
+    except RowError as exc:
+        return rows, None, None, exc
+    return rows, stop, reader.line_num, None
+
+
+def parse_range(path, start, end, width, indexes, keep, spool_dir=None):
+    """parse_mapped() on a worker, oversized fields spooled under `spool_dir`,
+    rows packed by pack_rows()"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        spool = None if spool_dir is None else Spool(root=spool_dir)
+        rows, stop, lines, error = parse_mapped(mm, start, end, width, indexes, keep, spool)
+    return pack_rows(rows), stop, lines, error
+
+
+def pack_rows(rows):
+    """Line numbers and columns of `rows`, cheaper to pickle than the rows
+
+    Each column is joined by SEPARATOR unless a value holds one or is a
+    SpooledField.
+    """
+    if not rows:
+        return array("q"), []
+    lines, fields = zip(*rows)
+    columns = []
+    for values in zip(*fields):
+        try:
+            joined = SEPARATOR.join(values)
+        except TypeError:
+            joined = None
+        if joined is None or joined.count(SEPARATOR) != len(values) - 1:
+            columns.append(values)
+        else:
+            columns.append(joined)
+    return array("q", lines), columns
+
+
+def unpack_rows(lines, columns):
+    """Return the line numbers and fields of packed rows"""
+    columns = [values.split(SEPARATOR) if isinstance(values, str) else values for values in columns]
+    return lines, zip(*columns)
+
+
+def iter_rows_parallel(path, required, workers, spool=None, spooled_columns=(), range_size=RANGE_SIZE):
+    """iter_rows() with the ranges of `path` parsed on `workers` processes"""
+    try:
+        f = open(path, "rb")
+    except OSError as exc:
+        raise InputError(f"cannot open {path}: {exc.strerror}") from exc
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            yield from iter_rows(path, required, spool, spooled_columns)
+            return
+        with mm, ProcessPoolExecutor(workers) as executor:
+            text = MappedText(mm, 0)
+            reader = csv.reader(LineFeed(text, None, {}))
+            width, indexes = read_header(reader, path, required)
+            keep = [name in spooled_columns for name in required]
+            spool_dir = None if spool is None else spool.make_directory()
+            # offset and line number where the rows read so far end
+            stop, line = text.pos, reader.line_num
+
+            ranges = iter_ranges(mm, stop, range_size)
+            pending = deque()
+
+            def submit(count):
+                for start, end in islice(ranges, count):
+                    future = executor.submit(parse_range, path, start, end, width, indexes, keep, spool_dir)
+                    pending.append((start, end, future))
+
+            try:
+                submit(workers * RANGES_AHEAD)
+                while pending:
+                    start, end, future = pending.popleft()
+                    submit(1)
+                    if end <= stop:
+                        # within the last record of the previous range
+                        future.cancel()
+                        continue
+                    if start == stop:
+                        packed, next_stop, lines, error = future.result()
+                        row_lines, fields = unpack_rows(*packed)
+                    else:
+                        future.cancel()
+                        rows, next_stop, lines, error = parse_mapped(mm, stop, end, width, indexes, keep, spool)
+                        row_lines, fields = zip(*rows) if rows else ((), ())
+                    yield from zip(map(line.__add__, row_lines), fields)
+                    if error is not None:
+                        raise InputError(f"{path}:{line + error.line}: {error.text}") from error
+                    stop, line = next_stop, line + lines
+            finally:
+                executor.shutdown(cancel_futures=True)
+
+
+def iter_messages_parallel(path, workers, spool=None, validation="fail-fast", range_size=RANGE_SIZE):
+    """iter_messages() with messages.csv parsed on `workers` processes"""
+    rows = iter_rows_parallel(path, MESSAGE_COLUMNS, workers, spool, ("content",), range_size)
+    return parse_messages(rows, path, validation)
@@ -0,0 +1,188 @@
+"""Streaming CSV readers for messages.csv and contacts.csv."""
+
+import csv
+import sys
+from collections import namedtuple
+from itertools import islice
+
+from msgproc.errors import InputError
+from msgproc.spool import BATCH_CONTENT, LineFeed, held_size
+from msgproc.validation import BATCH_SIZE, DEFAULT_DIRECTION, Validator
+
+# Contents can be arbitrarily large (R21), the default limit is 128 KiB.
+csv.field_size_limit(sys.maxsize)
+
+MESSAGE_COLUMNS = ("id", "datetime", "direction", "content", "contact")
+CONTENT = MESSAGE_COLUMNS.index("content")
+CONTACT_COLUMNS = ("id", "name")
+
+# `key` is the output file stem, equal to `id` unless the id is duplicated.
+# `content` is a SpooledField when larger than msgproc.spool.LARGE_FIELD.
+Message = namedtuple("Message", "line id datetime direction content contact key")
+
+
+def open_csv(path):
+    """Open a CSV input file, turning OS errors into InputError"""
+    try:
+        return open(path, newline="", encoding="utf-8")
+    except OSError as exc:
+        raise InputError(f"cannot open {path}: {exc.strerror}") from exc
+
+
+def read_header(reader, path, required):
+    """Return the header width and the index of each required column"""
+    header = next(reader, None)
+    if header is None:
+        raise InputError(f"{path}: missing header row")
+    header = [name.strip() for name in header]
+    missing = [name for name in required if name not in header]
+    if missing:
+        raise InputError(f"{path}: missing column(s): {', '.join(missing)}")
+    return len(header), [header.index(name) for name in required]
+
+
+class RowError(Exception):
+    """Malformed row, `line` counted from where reading started"""
+
+    def __init__(self, line, text):
+        super().__init__(line, text)
+        self.line = line
+        self.text = text
+
+
+def iter_rows(path, required, spool=None, spooled_columns=(), f=None):
+    """Yield (line number, fields) for each data row, fields ordered as `required`
+
+    With a `spool`, oversized fields of `spooled_columns` are yielded as
+    SpooledField, those of other columns are read back into memory, and the
+    spool files of a row not yielded are deleted as it is read. `f`,
+    if given, is read instead of opening `path` (see msgproc.stream).
+    """
+    with open_csv(path) if f is None else f as f:
+        spooled = {}
+        reader = csv.reader(f if spool is None else LineFeed(f, spool, spooled))
+        width, indexes = read_header(reader, path, required)
+        release(spooled, ())
+        try:
+            yield from read_fields(reader, width, indexes, [name in spooled_columns for name in required], spooled)
+        except RowError as exc:
+            raise InputError(f"{path}:{exc.line}: {exc.text}") from exc
+
+
+def read_fields(reader, width, indexes, keep, spooled):
+    """Yield (line number, fields) for the rows of a csv `reader`, see iter_rows"""
+    try:
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                raise RowError(reader.line_num, f"expected {width} fields, got {len(row)}")
+            fields = [row[i] for i in indexes]
+            if spooled:
+                fields = [unspool(value, spooled, k) for value, k in zip(fields, keep)]
+                release(spooled, fields)
+            yield reader.line_num, fields
+    except (csv.Error, UnicodeDecodeError) as exc:
+        raise RowError(reader.line_num, str(exc)) from exc
+
+
+def unspool(value, spooled, keep):
+    field = spooled.get(value)
+    if field is None:
+        return value
+    return field if keep else field.read_text()
+
+
+def release(spooled, fields):
+    """Forget the spooled fields of a row, deleting the files of those not
+    passed on in `fields`: read back, or of a column not required"""
+    for field in spooled.values():
+        if not any(value is field for value in fields):
+            field.discard()
+    spooled.clear()
+
+
+def parse_int(value, field, where):
+    """Parse an integer field, rejecting empty and non-numeric values"""
+    if not value:
+        raise InputError(f"{where}: missing {field}")
+    try:
+        return int(value)
+    except ValueError:
+        raise InputError(f"{where}: {field} must be an integer, got {value!r}") from None
+
+
+def take(items, size, ready=None, weight=None):
+    """Next `size` items, fewer if `ready()` tells that the next one would
+    wait for the input (see msgproc.stream), or once the `weight()` of the
+    items reaches BATCH_CONTENT"""
+    if ready is None and weight is None:
+        return list(islice(items, size))
+    batch = []
+    total = 0
+    for item in items:
+        batch.append(item)
+        if weight is not None:
+            total += weight(item)
+        if len(batch) == size or total >= BATCH_CONTENT or (ready is not None and not ready()):
+            break
+    return batch
+
+
+def row_content(row):
+    """Characters of the content of a (line, fields) row held in memory"""
+    return held_size(row[1][CONTENT])
+
+
+def parse_messages(rows, path, validation="fail-fast", ready=None):
+    """Validate raw message rows batch by batch and yield Message tuples
+
+    See msgproc.validation for the `validation` modes. Either way, the
+    messages before the first invalid row are yielded and none past it. Batches are cut
+    short when `ready()`, if given, is false, and once their contents reach
+    BATCH_CONTENT characters: only a few rows of contents just under
+    LARGE_FIELD are held at once.
+    """
+    validator = Validator(path, validation)
+    errors = []
+    rows = until_error(rows, errors)
+    while batch := take(rows, BATCH_SIZE, ready, row_content):
+        if validator.count:
+            # once a row is invalid, the following ones are only checked
+            validator.check(batch)
+            continue
+        valid = validator.check(batch)
+        for line, (msg_id, timestamp, direction, content, contact) in batch[:valid]:
+            yield Message(
+                line,
+                msg_id,
+                int(timestamp),
+                direction or DEFAULT_DIRECTION,
+                content,
+                int(contact),
+                msg_id,
+            )
+        if validator.count and validator.fail_fast:
+            break
+    if errors:
+        # a malformed line ends the run, after the rows read before it
+        validator.finish(stopped_by=errors[0])
+        raise errors[0]
+    validator.finish()
+
+
+def until_error(rows, errors):
+    """Yield `rows` until one raises InputError, which is appended to `errors`"""
+    try:
+        yield from rows
+    except InputError as exc:
+        errors.append(exc)
+
+
+def iter_messages(path, spool=None, validation="fail-fast", feed=None):
+    """Stream validated messages from messages.csv, oversized contents go to `spool`
+
+    `feed`, a msgproc.stream.PipeFeed, is read instead of `path` if given.
+    """
+    rows = iter_rows(path, MESSAGE_COLUMNS, spool, ("content",), feed)
+    return parse_messages(rows, path, validation, None if feed is None else feed.ready)
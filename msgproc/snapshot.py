@@ -0,0 +1,139 @@
+"""Pre-parsed contact books reused across runs (--contacts-cache).
+
+Parsing contacts.csv is most of the startup cost of a run, and most runs
+read the same contacts.csv again. A snapshot stores the arrays of its
+ContactIndex in a binary file of a cache directory:
+
+    header   MAGIC, then the length and the text of a JSON document: real
+             path, size, mtime and SHA-256 of contacts.csv, byte order,
+             number of contacts and of name bytes
+    ids      int64 per contact, sorted
+    offsets  uint64 per contact, plus one
+    names    UTF-8
+
+in native byte order, each section starting on a multiple of 8 bytes.
+Loading maps the file and casts memoryviews over the sections: lookups
+bisect the mapped pages, nothing is parsed or copied, and the pages are
+shared by concurrent runs.
+
+The snapshot of contacts.csv is `<cache dir>/contacts-<digest of its real
+path>.idx`. It is used as is while the size and mtime of contacts.csv are
+those recorded. If only the mtime changed, contacts.csv is hashed and the
+snapshot is kept, with the new mtime, when the SHA-256 matches. Otherwise,
+or if the snapshot is missing or unreadable, contacts.csv is parsed and
+the snapshot rewritten, atomically (see msgproc.durability). A cache that
+cannot be written only costs the parsing.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from msgproc.contacts import ContactIndex, load_contacts
+from msgproc.durability import commit, temporary_path
+from msgproc.errors import InputError
+
+MAGIC = b"MSGCTX01"
+HEADER = struct.Struct("=8sQ")
+SOURCE_KEYS = {"path", "size", "mtime_ns", "sha256"}
+
+
+def file_fingerprint(path):
+    """Return the size, mtime and SHA-256 of a file"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+    except OSError as exc:
+        raise InputError(f"cannot open {path}: {exc.strerror}") from exc
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+
+
+def snapshot_path(cache_dir, contacts_path):
+    digest = hashlib.blake2b(os.path.realpath(contacts_path).encode("utf-8"), digest_size=8).hexdigest()
+    return os.path.join(cache_dir, f"contacts-{digest}.idx")
+
+
+def aligned(size):
+    return -(-size // 8) * 8
+
+
+def write_snapshot(path, index, source):
+    """Write the snapshot of `index`, built from the file `source` describes
+    (see file_fingerprint)"""
+    header = dict(source, byteorder=sys.byteorder, count=len(index), names=len(index.names))
+    text = json.dumps(header).encode("utf-8")
+    tmp = temporary_path(path)
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(text)) + text)
+        for section in (index.ids, index.offsets, index.names):
+            f.write(bytes(aligned(f.tell()) - f.tell()))
+            f.write(section)
+    commit(tmp, path)
+
+
+def read_snapshot(path):
+    """Return the header and the mapped ContactIndex of a snapshot, None if
+    it is missing or unreadable"""
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, length = HEADER.unpack_from(mm)
+        header = json.loads(mm[HEADER.size:HEADER.size + length])
+        if magic != MAGIC or header["byteorder"] != sys.byteorder or not SOURCE_KEYS <= header.keys():
+            return None
+        count, size = header["count"], header["names"]
+        start = aligned(HEADER.size + length)
+        view = memoryview(mm)
+        ids = view[start:start + 8 * count].cast("q")
+        start = aligned(start + 8 * count)
+        offsets = view[start:start + 8 * (count + 1)].cast("Q")
+        start = aligned(start + 8 * (count + 1))
+        names = view[start:start + size]
+        if len(ids) != count or len(offsets) != count + 1 or len(names) != size or offsets[-1] != size:
+            return None
+    except (struct.error, ValueError, KeyError, TypeError):
+        return None
+    # the views keep the map open as long as the index is used
+    return header, ContactIndex(ids, offsets, names)
+
+
+def load_cached_contacts(path, cache_dir):
+    """ContactIndex of contacts.csv at `path`, from its snapshot in `cache_dir`
+    when it is current, see the module docstring"""
+    try:
+        stat = os.stat(path)
+    except OSError as exc:
+        raise InputError(f"cannot open {path}: {exc.strerror}") from exc
+    realpath = os.path.realpath(path)
+    cached = snapshot_path(cache_dir, realpath)
+    snapshot = read_snapshot(cached)
+    if snapshot is not None:
+        header, index = snapshot
+        if header.get("path") != realpath:
+            snapshot = None
+        elif header["size"] == stat.st_size and header["mtime_ns"] == stat.st_mtime_ns:
+            return index
+    source = dict(file_fingerprint(path), path=realpath)
+    if snapshot is not None and (header["size"], header["sha256"]) == (source["size"], source["sha256"]):
+        save_snapshot(cached, index, source)
+        return index
+    index = load_contacts(path)
+    save_snapshot(cached, index, source)
+    return index
+
+
+def save_snapshot(path, index, source):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_snapshot(path, index, source)
+    except OSError:
+        pass
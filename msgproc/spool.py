@@ -0,0 +1,274 @@
+"""Oversized CSV fields kept on disk instead of in memory (R21).
+
+The csv module materializes every field, in a 4-bytes-per-character
+buffer, before handing it over as a str. A physical line longer than
+LARGE_FIELD characters is therefore tokenized here, chunk by chunk: fields
+longer than LARGE_FIELD are written to a temporary file of the run's Spool
+and replaced, in the record passed on to csv, by a marker that the reader
+swaps for a SpooledField.
+
+Lines are fed to csv as they are otherwise. A long line that starts inside
+a quoted field spanning several lines is passed through whole.
+"""
+
+import io
+import os
+import re
+import shutil
+import tempfile
+
+LARGE_FIELD = 1 << 20
+# Characters of contents held by a batch of rows or messages: a batch is cut
+# short once its contents reach it, whatever its number of rows.
+BATCH_CONTENT = 1 << 20
+# Characters read at a time while tokenizing a long line, less than LARGE_FIELD.
+READ_SIZE = 1 << 16
+MARKER = "\0msgproc-spool:"
+
+UNQUOTED_END = re.compile(r"[,\r\n]")
+QUOTE_OR_COMMA = re.compile(r'[",]')
+NEWLINES = ("\n", "\r")
+
+
+class SpooledField:
+    """UTF-8 text of a field stored in a spool file"""
+
+    __slots__ = ("path", "size")
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def iter_bytes(self, chunk_size):
+        with open(self.path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def read_text(self):
+        with open(self.path, encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def discard(self):
+        """Delete the spool file, once the field is no longer needed"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return f"SpooledField({self.path!r}, {self.size})"
+
+
+def held_size(value):
+    """Characters of a field held in memory, none for a spooled one"""
+    return len(value) if isinstance(value, str) else 0
+
+
+class Spool:
+    """Temporary directory holding the oversized fields of a run, created on first use"""
+
+    def __init__(self, root=None):
+        # parent of the directory, the system temporary directory by default
+        self.root = root
+        self.directory = None
+        self.count = 0
+
+    def make_directory(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="msgproc-spool-", dir=self.root)
+        return self.directory
+
+    def create(self):
+        self.count += 1
+        return os.path.join(self.make_directory(), f"field-{self.count}")
+
+    def cleanup(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+
+class FieldBuffer:
+    """Accumulates a field in memory, moving it to a spool file past LARGE_FIELD"""
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.pieces = []
+        self.length = 0
+        self.file = None
+        self.path = None
+
+    def add(self, text):
+        if self.file is not None:
+            self.file.write(text)
+            return
+        self.pieces.append(text)
+        self.length += len(text)
+        if self.length > LARGE_FIELD:
+            self.path = self.spool.create()
+            self.file = open(self.path, "w", encoding="utf-8", newline="")
+            self.file.writelines(self.pieces)
+            self.pieces = None
+
+    def finish(self):
+        if self.file is None:
+            return "".join(self.pieces)
+        self.file.close()
+        return SpooledField(self.path, os.path.getsize(self.path))
+
+
+def read_large_record(head, f, spool):
+    """Tokenize the record starting with `head`, reading the rest from `f`.
+
+    Return the fields, oversized ones as SpooledField, and the text read
+    past the end of the record.
+    """
+    fields = []
+    field = FieldBuffer(spool)
+    buf, pos = head, 0
+    quoted = False
+    at_start = True
+    # a quote seen inside a quoted field: escaped quote or end of the quotes
+    closing = False
+    while True:
+        if pos >= len(buf):
+            buf, pos = f.read(READ_SIZE), 0
+            if not buf:
+                fields.append(field.finish())
+                return fields, ""
+        if closing:
+            closing = False
+            if buf[pos] == '"':
+                field.add('"')
+                pos += 1
+            else:
+                quoted = False
+            continue
+        if quoted:
+            end = buf.find('"', pos)
+            if end < 0:
+                field.add(buf[pos:])
+                pos = len(buf)
+            else:
+                field.add(buf[pos:end])
+                pos = end + 1
+                closing = True
+            continue
+        if at_start and buf[pos] == '"':
+            quoted = True
+            at_start = False
+            pos += 1
+            continue
+        at_start = False
+        match = UNQUOTED_END.search(buf, pos)
+        if match is None:
+            field.add(buf[pos:])
+            pos = len(buf)
+            continue
+        end = match.start()
+        field.add(buf[pos:end])
+        fields.append(field.finish())
+        pos = end + 1
+        if buf[end] == ",":
+            field = FieldBuffer(spool)
+            at_start = True
+            continue
+        if buf[end] == "\r":
+            if pos >= len(buf):
+                buf, pos = f.read(READ_SIZE), 0
+            if buf[pos:pos + 1] == "\n":
+                pos += 1
+        return fields, buf[pos:]
+
+
+def encode_record(fields, spooled):
+    """Build a CSV line for `fields`, registering SpooledFields under markers"""
+    values = []
+    for value in fields:
+        if isinstance(value, SpooledField):
+            marker = f"{MARKER}{len(spooled)}"
+            spooled[marker] = value
+            value = marker
+        values.append('"' + value.replace('"', '""') + '"')
+    return ",".join(values) + "\n"
+
+
+def ends_quoted(line, quoted):
+    """Tell whether csv is inside a quoted field at the end of `line`,
+    `quoted` telling whether it was at its start"""
+    at_start = not quoted
+    pos = 0
+    while True:
+        if quoted:
+            end = line.find('"', pos)
+            if end < 0:
+                return True
+            if line.startswith('"', end + 1):
+                pos = end + 2
+                continue
+            quoted = at_start = False
+            pos = end + 1
+            continue
+        match = QUOTE_OR_COMMA.search(line, pos)
+        if match is None:
+            return False
+        end = match.start()
+        if line[end] == ",":
+            at_start = True
+        else:
+            # a quote only opens a quoted field at its very start
+            quoted = at_start and end == pos
+            at_start = False
+        pos = end + 1
+
+
+class LineFeed:
+    """Physical lines of `f` for csv.reader, oversized fields spooled
+
+    Without a `spool`, long lines are passed through whole.
+    """
+
+    def __init__(self, f, spool, spooled):
+        self.f = f
+        self.spool = spool
+        self.spooled = spooled
+        # text read past the end of a large record, fed before the rest of `f`
+        self.pending = None
+
+    def unread(self):
+        """Text read from `f` but not yet passed on"""
+        if self.pending is None:
+            return ""
+        return self.pending.getvalue()[self.pending.tell():]
+
+    def __iter__(self):
+        f = self.f
+        quoted = False
+        while True:
+            if self.pending is not None:
+                line = self.pending.readline(LARGE_FIELD)
+                if not line.endswith(NEWLINES):
+                    self.pending = None
+                    line += f.readline(LARGE_FIELD - len(line))
+            else:
+                line = f.readline(LARGE_FIELD)
+            if not line:
+                return
+            if len(line) == LARGE_FIELD and not line.endswith(NEWLINES):
+                if not quoted and self.spool is not None:
+                    fields, rest = read_large_record(line, f, self.spool)
+                    if rest:
+                        self.pending = io.StringIO(rest, newline="")
+                    yield encode_record(fields, self.spooled)
+                    continue
+                # csv ends the record at the end of a line once the quotes close
+                line += f.readline()
+            if '"' in line:
+                quoted = ends_quoted(line, quoted)
+            yield line
@@ -0,0 +1,139 @@
+"""Streaming mode: messages.csv read from stdin, documents written to stdout.
+
+    producer | process_messages - contacts.csv - | consumer
+
+`-` as messages.csv reads the rows from stdin as they arrive, `-` as the
+output directory writes one JSON document per line to stdout (the
+`--format ndjson` documents) instead of files. Either can be used alone.
+contacts.csv is still a file, or its snapshot with --contacts-cache (see
+msgproc.snapshot).
+
+Memory does not grow with the input beyond the ids kept for duplicate
+detection (see msgproc.duplicates): rows are read a chunk at a time,
+writing blocks while the consumer is behind, and batches hold at most
+1024 rows and msgproc.spool.BATCH_CONTENT characters of contents, so a
+fast producer of large contents fills them with a few rows only. Rows are
+validated and their datetimes formatted by batches; a PipeFeed tells the
+batching stages
+whether another line can be read without waiting for the producer
+(ready()), so that a batch is cut instead of waiting for more rows. The
+documents of what has been read are written and flushed the same way.
+A fast producer gets full batches and large writes, a slow one gets each
+document as soon as its row is complete.
+"""
+
+import codecs
+import os
+import select
+
+from msgproc.errors import InputError
+from msgproc.transform import Base64Stream
+from msgproc.writer import iter_document, serialize
+
+STDIO = "-"
+
+READ_SIZE = 1 << 16
+# Documents buffered before a write when the input keeps up.
+BUFFER_SIZE = 1 << 16
+
+
+class PipeFeed:
+    """Text of the file descriptor `fd` (stdin by default), with the
+    readline() and read() of a file opened with newline="" for csv.reader"""
+
+    def __init__(self, fd=0, name="<stdin>"):
+        self.fd = fd
+        self.name = name
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read what the producer has written, waiting for it if nothing"""
+        data = os.read(self.fd, READ_SIZE)
+        self.eof = not data
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(data, final=self.eof)
+        self.pos = 0
+
+    def readline(self, limit=-1):
+        while True:
+            end = self.buffer.find("\n", self.pos)
+            available = len(self.buffer) - self.pos
+            if end >= 0:
+                size = end + 1 - self.pos
+            elif self.eof or 0 <= limit <= available:
+                size = available
+            else:
+                self.fill()
+                continue
+            if 0 <= limit < size:
+                size = limit
+            line = self.buffer[self.pos:self.pos + size]
+            self.pos += size
+            return line
+
+    def read(self, size):
+        if self.pos == len(self.buffer) and not self.eof:
+            self.fill()
+        text = self.buffer[self.pos:self.pos + size]
+        self.pos += len(text)
+        return text
+
+    def ready(self):
+        """True if the next line can be read without waiting for the producer"""
+        if self.eof or self.buffer.find("\n", self.pos) >= 0:
+            return True
+        return bool(select.select([self.fd], [], [], 0)[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # stdin belongs to the process, it is left open
+        pass
+
+
+def write_stream(messages, out, ready=None, metrics=None):
+    """Write one document per line of every message to the binary file
+    `out` and return their number
+
+    Writes are flushed when `ready()` tells that the next message would
+    wait for the input, or every BUFFER_SIZE bytes. Each document is
+    counted in `metrics`, if given. On an InputError of `messages`, the
+    documents before it are written first.
+    """
+    count = 0
+    buffer = bytearray()
+    try:
+        for message in messages:
+            start = len(buffer)
+            if isinstance(message.content, Base64Stream):
+                out.write(buffer)
+                buffer.clear()
+                size = sum(out.write(piece) for piece in iter_document(message)) + out.write(b"\n")
+            else:
+                buffer += serialize(message)
+                buffer += b"\n"
+                size = len(buffer) - start
+            count += 1
+            if metrics is not None:
+                metrics.wrote(1, size)
+            if len(buffer) >= BUFFER_SIZE or (ready is not None and not ready()):
+                out.write(buffer)
+                buffer.clear()
+                out.flush()
+        out.write(buffer)
+        out.flush()
+    except InputError:
+        # the documents of the rows before the error are still written
+        out.write(buffer)
+        out.flush()
+        raise
+    except BrokenPipeError:
+        # the consumer is gone: nothing more can be written, not even at exit
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, out.fileno())
+        os.close(devnull)
+        raise
+    return count
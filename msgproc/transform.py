@@ -0,0 +1,103 @@
+"""Field conversions applied to every message.
+
+Timestamps are formatted a batch at a time. Messages of a file share a few
+thousand distinct days: the `YYYY-MM-DDT` prefix of each day is cached and
+only the time of day is formatted per timestamp, from precomputed tables.
+Large batches go through NumPy `datetime64` instead when it is installed.
+"""
+
+import binascii
+from datetime import date, timedelta
+
+try:
+    import numpy
+except ImportError:  # optional, the pure-Python path gives the same strings
+    numpy = None
+
+from msgproc.spool import SpooledField
+
+EPOCH = date(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+# 0001-01-01T00:00:00 and 9999-12-31T23:59:59, the range of datetime
+MIN_TIMESTAMP = -62135596800
+MAX_TIMESTAMP = 253402300799
+# Day prefixes kept before the cache is reset, enough for 170 years of days.
+DAY_CACHE_SIZE = 1 << 16
+# Smaller batches are faster in pure Python than through NumPy.
+NUMPY_MIN_BATCH = 256
+# Bytes encoded at a time for spooled contents, a multiple of 3 so that the
+# base64 chunks concatenate without padding.
+BASE64_CHUNK = 3 << 16
+
+
+MINUTES = [f"{hour:02d}:{minute:02d}:" for hour in range(24) for minute in range(60)]
+SECONDS = [f"{second:02d}" for second in range(60)]
+day_prefixes = {}
+
+
+def day_prefix(day):
+    """`YYYY-MM-DDT` of the `day`-th day since the epoch, OverflowError out of range"""
+    prefix = day_prefixes.get(day)
+    if prefix is None:
+        prefix = f"{EPOCH + timedelta(days=day)}T"
+        if len(day_prefixes) >= DAY_CACHE_SIZE:
+            day_prefixes.clear()
+        day_prefixes[day] = prefix
+    return prefix
+
+
+def format_datetime(timestamp):
+    """Convert a UNIX timestamp to a UTC `YYYY-MM-DDThh:mm:ss` string (F07, R13)
+
+    Raise OverflowError outside of years 1 to 9999.
+    """
+    day, second = divmod(timestamp, SECONDS_PER_DAY)
+    minute, second = divmod(second, 60)
+    return day_prefix(day) + MINUTES[minute] + SECONDS[second]
+
+
+def format_timestamps_numpy(timestamps):
+    try:
+        epochs = numpy.array(timestamps, dtype=numpy.int64)
+    except OverflowError:
+        raise OverflowError("timestamp out of range") from None
+    if epochs.min() < MIN_TIMESTAMP or epochs.max() > MAX_TIMESTAMP:
+        raise OverflowError("timestamp out of range")
+    return numpy.datetime_as_string(epochs.astype("datetime64[s]")).tolist()
+
+
+def format_timestamps(timestamps):
+    """Format a batch of UNIX timestamps, see format_datetime"""
+    if numpy is not None and len(timestamps) >= NUMPY_MIN_BATCH:
+        return format_timestamps_numpy(timestamps)
+    return [format_datetime(timestamp) for timestamp in timestamps]
+
+
+class Base64Stream:
+    """Base64 encoding of a SpooledField, produced chunk by chunk as it is written"""
+
+    __slots__ = ("field",)
+
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        for chunk in self.field.iter_bytes(BASE64_CHUNK):
+            yield binascii.b2a_base64(chunk, newline=False)
+
+    def __str__(self):
+        return b"".join(self).decode("ascii")
+
+    def __len__(self):
+        # length of the encoding, padded to a multiple of 4
+        return 4 * -(-self.field.size // 3)
+
+
+def encode_content(content):
+    """Base64-encode the UTF-8 bytes of a message content (F08)
+
+    Spooled contents are encoded lazily, see Base64Stream.
+    """
+    if isinstance(content, SpooledField):
+        return Base64Stream(content)
+    return binascii.b2a_base64(content.encode("utf-8"), newline=False).decode("ascii")
@@ -0,0 +1,143 @@
+"""Validation of messages.csv rows (R06-R11, R14, R19, R20).
+
+Rows are checked a batch at a time, column by column: the ids of a batch
+are matched by a single regular expression, the integer columns by
+`str.isdigit` on their concatenation, the directions by a set inclusion.
+Only a batch failing one of these checks is checked again row by row, to
+report every violation with its line number.
+
+In fail-fast mode the first violation ends the run, in collect-all mode
+the remaining rows are still checked (but no longer processed) and every
+violation is reported at once.
+"""
+
+import re
+from collections import namedtuple
+
+from msgproc.errors import InputError
+
+MODES = ("fail-fast", "collect-all")
+# Rows checked together, as in the datetime stage.
+BATCH_SIZE = 1024
+# Violations listed in the report, the others are only counted.
+MAX_REPORTED = 1000
+
+DIRECTIONS = ("originating", "destinating")
+DEFAULT_DIRECTION = "originating"
+# An empty direction stands for DEFAULT_DIRECTION.
+ACCEPTED_DIRECTIONS = frozenset(DIRECTIONS + ("",))
+
+UUID4 = r"[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}"
+UUID4_RE = re.compile(UUID4, re.IGNORECASE)
+# The ids of a batch joined by newlines, none of them containing one.
+UUID4_LINES_RE = re.compile(rf"(?:{UUID4}\n)*{UUID4}", re.IGNORECASE)
+
+Violation = namedtuple("Violation", "line message")
+
+
+class ValidationError(InputError):
+    """Invalid rows of messages.csv, one Violation per error found"""
+
+    def __init__(self, path, violations, count=None, stopped_by=None):
+        self.path = path
+        self.violations = violations
+        self.count = len(violations) if count is None else count
+        # error that prevented reading the remaining rows
+        self.stopped_by = stopped_by
+        super().__init__(self.report())
+
+    def report(self):
+        lines = [f"{self.path}:{line}: {message}" for line, message in self.violations]
+        if self.count > 1:
+            lines.insert(0, f"{self.path}: {self.count} invalid value(s)")
+        if self.count > len(self.violations):
+            lines.append(f"... and {self.count - len(self.violations)} more")
+        if self.stopped_by is not None:
+            lines.append(str(self.stopped_by))
+        return "\n".join(lines)
+
+
+def is_integer(value):
+    try:
+        int(value)
+    except ValueError:
+        return False
+    return True
+
+
+def check_row(line, fields):
+    """Return the violations of one row, fields ordered as MESSAGE_COLUMNS"""
+    msg_id, timestamp, direction, content, contact = fields
+    violations = []
+    if not msg_id:
+        violations.append(Violation(line, "missing id"))
+    elif not UUID4_RE.fullmatch(msg_id):
+        violations.append(Violation(line, f"id must be a UUID v4, got {msg_id!r}"))
+    if direction not in ACCEPTED_DIRECTIONS:
+        violations.append(Violation(line, f"invalid direction {direction!r}"))
+    if not content:
+        violations.append(Violation(line, "missing content"))
+    for name, value in (("datetime", timestamp), ("contact", contact)):
+        if not value:
+            violations.append(Violation(line, f"missing {name}"))
+        elif not is_integer(value):
+            violations.append(Violation(line, f"{name} must be an integer, got {value!r}"))
+    return violations
+
+
+def digits_only(values):
+    joined = "".join(values)
+    return joined.isascii() and joined.isdigit() and all(values)
+
+
+def batch_is_valid(rows):
+    """Columnar check of a batch of (line, fields), False if any row may be invalid"""
+    ids, timestamps, directions, contents, contacts = zip(*[fields for _, fields in rows])
+    joined = "\n".join(ids)
+    return (
+        joined.count("\n") == len(ids) - 1
+        and UUID4_LINES_RE.fullmatch(joined) is not None
+        and ACCEPTED_DIRECTIONS.issuperset(directions)
+        and all(contents)
+        and digits_only(contacts)
+        # negative timestamps (R13) take the row by row path
+        and digits_only(timestamps)
+    )
+
+
+class Validator:
+    """Violations found so far in the rows of `path`"""
+
+    def __init__(self, path, mode="fail-fast"):
+        self.path = path
+        self.fail_fast = mode == "fail-fast"
+        self.violations = []
+        self.count = 0
+
+    def check(self, rows):
+        """Check a batch of (line, fields), return the number of rows before
+        its first invalid one
+
+        In fail-fast mode, the rows past the first violation are not checked.
+        """
+        if batch_is_valid(rows):
+            return len(rows)
+        valid = len(rows)
+        for i, (line, fields) in enumerate(rows):
+            violations = check_row(line, fields)
+            if violations:
+                valid = min(valid, i)
+                if self.fail_fast:
+                    self.add(violations[:1])
+                    break
+            self.add(violations)
+        return valid
+
+    def add(self, violations):
+        self.count += len(violations)
+        self.violations.extend(violations[:MAX_REPORTED - len(self.violations)])
+
+    def finish(self, stopped_by=None):
+        """Raise ValidationError if any violation was collected"""
+        if self.count:
+            raise ValidationError(self.path, self.violations, self.count, stopped_by)
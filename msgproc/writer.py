@@ -0,0 +1,171 @@
+"""Output stage: one `<key>.json` document per message."""
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from json.encoder import encode_basestring_ascii
+
+from msgproc.durability import SYNC_FILES, SYNC_INTERVAL, FileSink
+from msgproc.errors import InputError
+from msgproc.layout import output_name
+from msgproc.spool import BATCH_CONTENT, held_size
+from msgproc.transform import Base64Stream
+
+POOLS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+# Messages handed to a worker per task, amortizes the submit (and pickling) cost.
+BATCH_SIZE = 256
+
+# Output document of json.dumps(to_record(message)), split around the content.
+# Only the id and the contact can need escaping: the datetime is formatted by
+# msgproc.transform, the direction is validated and the content is base64.
+DOCUMENT_HEAD = '{"id": %s, "datetime": "%s", "direction": "%s", "content": "'
+DOCUMENT_TAIL = '", "contact": %s}'
+
+
+def to_record(message):
+    """Build the five-field output document of a fully transformed message"""
+    return {
+        "id": message.id,
+        "datetime": message.datetime,
+        "direction": message.direction,
+        "content": message.content,
+        "contact": message.contact,
+    }
+
+
+def document_head(message):
+    return DOCUMENT_HEAD % (encode_basestring_ascii(message.id), message.datetime, message.direction)
+
+
+def document_tail(message):
+    return DOCUMENT_TAIL % encode_basestring_ascii(message.contact)
+
+
+def serialize(message):
+    """Serialize a message to the bytes of its JSON document.
+
+    Same bytes as json.dumps(to_record(message)), filled into a template.
+    """
+    content = message.content
+    if isinstance(content, Base64Stream):
+        content = str(content)
+    return (document_head(message) + content + document_tail(message)).encode("ascii")
+
+
+def iter_document(message):
+    """Yield the JSON document of a message in pieces, streaming spooled contents
+
+    The pieces concatenate to serialize(message).
+    """
+    if not isinstance(message.content, Base64Stream):
+        yield serialize(message)
+        return
+    yield document_head(message).encode("ascii")
+    yield from message.content
+    yield document_tail(message).encode("ascii")
+
+
+def document_size(message):
+    """Size in bytes of the JSON document of a message, without building it"""
+    return len(document_head(message)) + len(message.content) + len(document_tail(message))
+
+
+def write_message(sink, message, shard_depth=0):
+    """Write one output document, replacing any previous file with the same key,
+    return its size"""
+    return sink.write(output_name(message.key, shard_depth), iter_document(message))
+
+
+def write_batch(output_dir, messages, durability="none", sync_files=SYNC_FILES, sync_interval=SYNC_INTERVAL,
+                shard_depth=0):
+    """Write a batch of messages, return their number and total size"""
+    size = 0
+    with FileSink(output_dir, durability, sync_files, sync_interval) as sink:
+        for message in messages:
+            size += write_message(sink, message, shard_depth)
+    return len(messages), size
+
+
+def write_messages(messages, output_dir, durability="none", sync_files=SYNC_FILES, sync_interval=SYNC_INTERVAL,
+                   shard_depth=0, metrics=None):
+    """Write every message to `output_dir` and return the number of files written
+
+    See msgproc.durability for `durability`, `sync_files` and `sync_interval`,
+    msgproc.layout for `shard_depth`. Each file is counted in `metrics`, a
+    msgproc.metrics.Metrics, if given.
+    """
+    count = 0
+    with FileSink(output_dir, durability, sync_files, sync_interval) as sink:
+        for message in messages:
+            size = write_message(sink, message, shard_depth)
+            count += 1
+            if metrics is not None:
+                metrics.wrote(1, size)
+    return count
+
+
+def iter_batches(messages, size, ready=None):
+    """Batches of `size` messages, cut short when `ready()`, if given, is
+    false, or once their contents reach BATCH_CONTENT characters
+
+    On an InputError of `messages`, the messages read before it are yielded
+    as a last batch, then the error is raised.
+    """
+    batch = []
+    content = 0
+    try:
+        for message in messages:
+            batch.append(message)
+            content += held_size(message.content)
+            if len(batch) == size or content >= BATCH_CONTENT or (ready is not None and not ready()):
+                yield batch
+                batch = []
+                content = 0
+    except InputError:
+        if batch:
+            yield batch
+        raise
+    if batch:
+        yield batch
+
+
+def write_messages_parallel(messages, output_dir, workers, pool="thread", backlog=None, durability="none",
+                            sync_files=SYNC_FILES, sync_interval=SYNC_INTERVAL, shard_depth=0, metrics=None):
+    """Serialize and write messages on a pool of `workers`.
+
+    At most `backlog` batches (default: twice the number of workers) are in
+    flight, so a slow disk throttles the upstream stages instead of letting
+    pending messages pile up in memory. Keys are unique once duplicates have
+    been disambiguated, so the files are identical to the serial writer's.
+    In batch durability, each batch is also synced when done. Batches are
+    counted in `metrics` as they complete.
+    """
+    backlog = backlog or 2 * workers
+    count = 0
+    pending = set()
+
+    def collect(done):
+        nonlocal count
+        for future in done:
+            files, size = future.result()
+            count += files
+            if metrics is not None:
+                metrics.wrote(files, size)
+
+    with POOLS[pool](max_workers=workers) as executor:
+        try:
+            for batch in iter_batches(messages, BATCH_SIZE):
+                if len(pending) >= backlog:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(
+                    write_batch, output_dir, batch, durability, sync_files, sync_interval, shard_depth
+                ))
+        finally:
+            done, pending = wait(pending)
+        collect(done)
+    return count
@@ -0,0 +1,194 @@
+"""Benchmark harness for the performance suite.
+
+A benchmark runs a callable a few times untimed (warm-up), then `repeat`
+times timed with `time.perf_counter_ns`. The results of a session can be
+exported as JSON and compared against a baseline exported the same way:
+a benchmark whose median is more than `tolerance` slower than its baseline
+median is a regression.
+"""
+
+import json
+import math
+import platform
+import statistics
+import time
+from dataclasses import dataclass, field
+
+
+def percentile(values, q):
+    """Linearly interpolated `q`-th percentile (0-100) of `values`"""
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+@dataclass
+class BenchmarkResult:
+    """Timings of one benchmark, in nanoseconds"""
+
+    name: str
+    times_ns: list = field(default_factory=list)
+    # messages processed per run, for throughput
+    messages: int = 0
+    # share of the run time per pipeline stage, from the metrics of the runs:
+    # {stage: {"calls", "seconds", "share"}}, averaged over the runs
+    stages: dict = field(default_factory=dict)
+
+    @property
+    def min(self):
+        return min(self.times_ns)
+
+    @property
+    def median(self):
+        return statistics.median(self.times_ns)
+
+    @property
+    def p95(self):
+        return percentile(self.times_ns, 95)
+
+    @property
+    def p99(self):
+        return percentile(self.times_ns, 99)
+
+    @property
+    def messages_per_sec(self):
+        return self.messages / (self.median / 1e9) if self.messages else 0.0
+
+    def to_dict(self):
+        return {
+            "runs": len(self.times_ns),
+            "messages": self.messages,
+            "min_ns": self.min,
+            "median_ns": self.median,
+            "p95_ns": self.p95,
+            "p99_ns": self.p99,
+            "messages_per_sec": self.messages_per_sec,
+            "times_ns": self.times_ns,
+            "stages": self.stages,
+        }
+
+    def __str__(self):
+        text = (f"{self.name}: min {self.min / 1e9:.3f}s, median {self.median / 1e9:.3f}s, "
+                f"p95 {self.p95 / 1e9:.3f}s, p99 {self.p99 / 1e9:.3f}s over {len(self.times_ns)} runs")
+        if self.messages:
+            text += f" ({self.messages_per_sec:.0f} messages/s)"
+        return text
+
+    def describe_stages(self):
+        return f"{self.name} stages: " + ", ".join(
+            f"{stage} {row['share']:.1%}" for stage, row in self.stages.items()
+        )
+
+
+def measure(name, run, messages=0, warmup=1, repeat=5, setup=None):
+    """Time `run()` `repeat` times after `warmup` untimed calls.
+
+    `setup()`, if given, is called untimed before every call of `run`.
+    """
+    result = BenchmarkResult(name, messages=messages)
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter_ns()
+        run()
+        elapsed = time.perf_counter_ns() - start
+        if i >= warmup:
+            result.times_ns.append(elapsed)
+    return result
+
+
+class BenchmarkSession:
+    """Results of a test session, with an optional baseline to compare to"""
+
+    def __init__(self, baseline=None, tolerance=0.25):
+        self.results = {}
+        self.baseline = baseline or {}
+        self.tolerance = tolerance
+
+    @staticmethod
+    def load_baseline(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)["benchmarks"]
+
+    def add(self, result):
+        self.results[result.name] = result
+
+    def regression(self, result):
+        """Return a description of the slowdown of `result` against the baseline, or None"""
+        reference = self.baseline.get(result.name)
+        if reference is None:
+            return None
+        limit = reference["median_ns"] * (1 + self.tolerance)
+        if result.median <= limit:
+            return None
+        return (f"{result.name}: median {result.median / 1e9:.3f}s is "
+                f"{result.median / reference['median_ns'] - 1:.0%} slower than the baseline "
+                f"{reference['median_ns'] / 1e9:.3f}s (tolerance {self.tolerance:.0%})")
+
+    def to_json(self, path):
+        data = {
+            "machine": {"python": platform.python_version(), "platform": platform.platform()},
+            "benchmarks": {name: result.to_dict() for name, result in sorted(self.results.items())},
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+
+def least_squares(rows, values):
+    """Coefficients minimizing the squared error of `rows` @ coefficients = `values`.
+
+    Columns are scaled to [-1, 1] before solving the normal equations, the
+    terms of a cost model span several orders of magnitude.
+    """
+    width = len(rows[0])
+    scales = [max(abs(row[j]) for row in rows) or 1 for j in range(width)]
+    rows = [[row[j] / scales[j] for j in range(width)] for row in rows]
+    # augmented normal equations [XᵀX | Xᵀy], solved by Gauss-Jordan elimination
+    matrix = [
+        [sum(row[i] * row[j] for row in rows) for j in range(width)]
+        + [sum(row[i] * y for row, y in zip(rows, values))]
+        for i in range(width)
+    ]
+    for col in range(width):
+        pivot = max(range(col, width), key=lambda r: abs(matrix[r][col]))
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        if matrix[col][col] == 0:
+            raise ValueError(f"singular system, column {col} is not determined by the data")
+        for r in range(width):
+            if r != col:
+                factor = matrix[r][col] / matrix[col][col]
+                matrix[r] = [a - factor * b for a, b in zip(matrix[r], matrix[col])]
+    return [matrix[j][width] / matrix[j][j] / scales[j] for j in range(width)]
+
+
+def fit_cost_model(points):
+    """Fit time ≈ a + b·messages + c·contacts on (messages, contacts, seconds) points.
+
+    Each super-linear term (messages·contacts, messages², contacts²) is then
+    fitted on top of the linear model, one at a time so that a small grid can
+    determine it. `superlinear` maps each term to the share of the time at the
+    largest point it accounts for: a quadratic join shows up as a large
+    positive messages·contacts share, linear code as noise around 0.
+    """
+    times = [t for _, _, t in points]
+    startup, per_message, per_contact = least_squares([(1, m, c) for m, c, _ in points], times)
+    m_max, c_max, t_max = max(points, key=lambda point: (point[0] * point[1], point[0], point[1]))
+    terms = {
+        "messages*contacts": lambda m, c: m * c,
+        "messages^2": lambda m, c: m * m,
+        "contacts^2": lambda m, c: c * c,
+    }
+    superlinear = {}
+    for name, term in terms.items():
+        coefficient = least_squares([(1, m, c, term(m, c)) for m, c, _ in points], times)[3]
+        superlinear[name] = coefficient * term(m_max, c_max) / t_max
+    residuals = [t - (startup + per_message * m + per_contact * c) for m, c, t in points]
+    return {
+        "startup_s": startup,
+        "per_message_s": per_message,
+        "per_contact_s": per_contact,
+        "superlinear": superlinear,
+        "max_residual_s": max(residuals, key=abs),
+        "points": [{"messages": m, "contacts": c, "seconds": t} for m, c, t in points],
+    }
@@ -0,0 +1,186 @@
+import os
+import shlex
+import shutil
+import sys
+
+import pytest
+
+from benchmark import BenchmarkSession, measure
+from datasets import DatasetCache
+from soak import Soak
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--runslow", action="store_true", default=False,
+        help="run the slow large-scale tests (1M+ messages)"
+    )
+    group = parser.getgroup("benchmark", "performance benchmark harness")
+    group.addoption(
+        "--benchmark-warmup", type=int, default=1, metavar="N",
+        help="untimed runs before each benchmark (default: 1)"
+    )
+    group.addoption(
+        "--benchmark-repeat", type=int, default=5, metavar="N",
+        help="timed runs per benchmark (default: 5)"
+    )
+    group.addoption(
+        "--benchmark-json", metavar="PATH",
+        help="export the benchmark results as JSON, usable as a later --benchmark-baseline"
+    )
+    group.addoption(
+        "--benchmark-baseline", metavar="PATH",
+        help="fail benchmarks whose median regressed against this JSON export"
+    )
+    group.addoption(
+        "--benchmark-tolerance", type=float, default=0.25, metavar="RATIO",
+        help="allowed median slowdown against the baseline (default: 0.25, i.e. 25%%)"
+    )
+    group.addoption(
+        "--complexity-report", metavar="PATH",
+        help="write the fitted cost model of the P12 complexity sweep as JSON"
+    )
+    group = parser.getgroup("soak", "long-running soak of P26")
+    group.addoption(
+        "--soak-iterations", type=int, metavar="N",
+        help="runs per soak, e.g. thousands to look for slow leaks"
+    )
+    group.addoption(
+        "--soak-duration", type=float, metavar="SECONDS",
+        help=f"duration of each soak (default without --soak-iterations: {SOAK_SHORT_SECONDS}s, "
+             f"at least {SOAK_MIN_RUNS} runs)"
+    )
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_FILES = ("messages.csv", "contacts.csv")
+PERFORMANCE_GROUP = "performance"
+# Short soak, cheap enough for every run of the suite
+SOAK_SHORT_SECONDS = 5.0
+SOAK_MIN_RUNS = 30
+
+# Tests mostly run process_messages as a command, some import msgproc directly
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: large-scale test, only run with --runslow")
+    config.addinivalue_line("markers", "performance: timing test, run on a dedicated worker and core")
+    config.addinivalue_line("markers", "xdist_group(name): tests run on the same pytest-xdist worker")
+    # Tests run in their own directory (see `sandbox`), resolve relative paths now
+    command = shlex.split(os.environ.get("PROCESS_MESSAGES", ""))
+    if command and os.sep in command[0]:
+        command[0] = os.path.abspath(command[0])
+        os.environ["PROCESS_MESSAGES"] = shlex.join(command)
+    for option in ("benchmark_json", "benchmark_baseline", "complexity_report"):
+        path = getattr(config.option, option, None)
+        if path:
+            setattr(config.option, option, os.path.abspath(path))
+
+
+def pytest_collection_modifyitems(config, items):
+    for item in items:
+        if item.module.__name__.endswith("test_performance"):
+            item.add_marker(pytest.mark.performance)
+            item.add_marker(pytest.mark.xdist_group(PERFORMANCE_GROUP))
+    if config.getoption("--runslow"):
+        return
+    skip_slow = pytest.mark.skip(reason="needs --runslow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
+
+
+@pytest.fixture(autouse=True)
+def sandbox(tmp_path, monkeypatch):
+    """Run each test in its own directory holding `data/` (with the sample
+    CSV files) and an empty `output/`, so that tests can run concurrently"""
+    os.makedirs(tmp_path / "data")
+    for name in SAMPLE_FILES:
+        shutil.copy(os.path.join(REPO_ROOT, "data", name), tmp_path / "data" / name)
+    os.makedirs(tmp_path / "output")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def cpu_affinity(request):
+    """Under pytest-xdist, keep the first CPU for performance tests and the
+    other CPUs for everything else. Child processes inherit the affinity."""
+    if "PYTEST_XDIST_WORKER" not in os.environ or not hasattr(os, "sched_setaffinity"):
+        yield
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < 2:
+        yield
+        return
+    dedicated = {cpus[0]} if "performance" in request.keywords else set(cpus[1:])
+    os.sched_setaffinity(0, dedicated)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, cpus)
+
+
+@pytest.fixture(scope="session")
+def benchmark_session(request):
+    config = request.config
+    baseline_path = config.getoption("--benchmark-baseline")
+    session = BenchmarkSession(
+        BenchmarkSession.load_baseline(baseline_path) if baseline_path else None,
+        config.getoption("--benchmark-tolerance"),
+    )
+    yield session
+    json_path = config.getoption("--benchmark-json")
+    if json_path:
+        session.to_json(json_path)
+
+
+@pytest.fixture
+def benchmark(request, benchmark_session):
+    """Measure a callable with the session's warm-up/repeat settings and
+    fail the test if it regressed against the baseline
+
+    With record=False the result is only returned, `benchmark.record(result)`
+    adds it to the session and checks it against the baseline later.
+    """
+    config = request.config
+
+    def add(result):
+        benchmark_session.add(result)
+        print(result)
+        regression = benchmark_session.regression(result)
+        if regression:
+            pytest.fail(regression)
+
+    def run(name, fn, messages=0, setup=None, warmup=None, repeat=None, record=True):
+        result = measure(
+            name, fn, messages,
+            warmup=config.getoption("--benchmark-warmup") if warmup is None else warmup,
+            repeat=config.getoption("--benchmark-repeat") if repeat is None else repeat,
+            setup=setup,
+        )
+        if record:
+            add(result)
+        return result
+
+    run.record = add
+    return run
+
+
+@pytest.fixture(scope="session")
+def datasets(tmp_path_factory):
+    """Generated CSV datasets, shared by every test of the session"""
+    return DatasetCache(str(tmp_path_factory.mktemp("datasets")))
+
+
+@pytest.fixture
+def soak(request):
+    """Soak sized by --soak-iterations and --soak-duration, short by default"""
+    iterations = request.config.getoption("--soak-iterations")
+    seconds = request.config.getoption("--soak-duration")
+    if iterations is None and seconds is None:
+        seconds = SOAK_SHORT_SECONDS
+    return Soak(iterations, seconds, min_runs=SOAK_MIN_RUNS)
@@ -0,0 +1,115 @@
+"""Deterministic large-dataset generator for the performance suite.
+
+Rows are generated from a seeded random.Random and written to disk in
+chunks of `CHUNK_ROWS` rows, so generating 10M+ rows needs neither the
+whole file in memory nor one `uuid.uuid4()` call per row: the random bytes
+of a whole chunk of UUIDs are drawn at once.
+
+Edge cases of the robustness suite can be injected at a given rate:
+contents with quoted commas (R16), large contents (R21) and emojis (R12).
+"""
+
+import hashlib
+import os
+import random
+
+CHUNK_ROWS = 65536
+BUFFER_SIZE = 1 << 20
+FIRST_CONTACT_ID = 1000
+FIRST_TIMESTAMP = 1009839600
+LARGE_CONTENT_SIZE = 1 << 20
+EMOJIS = "😀🚀🎉📱"
+# a prime, see write_contacts_csv
+SHUFFLE_STRIDE = 2654435761
+
+
+def uuid4_strings(rng, count):
+    """Return `count` random UUID v4 strings drawn from `rng`"""
+    ids = []
+    raw = rng.randbytes(16 * count).hex()
+    for i in range(0, 32 * count, 32):
+        h = raw[i:i + 32]
+        ids.append(f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{'89ab'[int(h[16], 16) & 3]}{h[17:20]}-{h[20:]}")
+    return ids
+
+
+def message_rows(start, count, num_contacts, rng, quoted_comma_rate, large_content_rate, emoji_rate,
+                 large_content_size):
+    rows = []
+    for i, msg_id in zip(range(start, start + count), uuid4_strings(rng, count)):
+        content = f"Test message {i}"
+        draw = rng.random()
+        if draw < large_content_rate:
+            content = "x" * large_content_size
+        elif draw < large_content_rate + quoted_comma_rate:
+            content = f'"Test, message, {i}"'
+        elif draw < large_content_rate + quoted_comma_rate + emoji_rate:
+            content = f"Test message {i} {EMOJIS}"
+        direction = "originating" if i % 2 == 0 else "destinating"
+        rows.append(f"{msg_id},{FIRST_TIMESTAMP + i},{direction},{content},{FIRST_CONTACT_ID + i % num_contacts}\n")
+    return rows
+
+
+def write_messages_csv(path, num_messages, num_contacts, seed=0, quoted_comma_rate=0.0, large_content_rate=0.0,
+                       emoji_rate=0.0, large_content_size=LARGE_CONTENT_SIZE):
+    """Write a messages.csv of `num_messages` rows referencing `num_contacts` contacts.
+
+    The same arguments always produce the same file. Message `i` has the
+    timestamp FIRST_TIMESTAMP + i and the contact FIRST_CONTACT_ID + i % num_contacts.
+    """
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8", buffering=BUFFER_SIZE) as f:
+        f.write("id,datetime,direction,content,contact\n")
+        for start in range(0, num_messages, CHUNK_ROWS):
+            count = min(CHUNK_ROWS, num_messages - start)
+            f.write("".join(message_rows(start, count, num_contacts, rng, quoted_comma_rate, large_content_rate,
+                                         emoji_rate, large_content_size)))
+
+
+def write_contacts_csv(path, num_contacts, shuffled=False):
+    """Write a contacts.csv with ids FIRST_CONTACT_ID.. and names `Contact <i>`
+
+    With `shuffled`, the rows are in a fixed pseudo-random order instead of
+    sorted by id.
+    """
+    # coprime with any row count below it: row r holds contact r * stride mod n
+    stride = SHUFFLE_STRIDE if shuffled else 1
+    with open(path, "w", encoding="utf-8", buffering=BUFFER_SIZE) as f:
+        f.write("id,name\n")
+        for start in range(0, num_contacts, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, num_contacts)
+            contacts = (row * stride % num_contacts for row in range(start, stop))
+            f.write("".join(f"{FIRST_CONTACT_ID + i},Contact {i}\n" for i in contacts))
+
+
+class DatasetCache:
+    """Generated CSV files under `root`, keyed by their generation parameters"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, kind, **params):
+        key = ",".join(f"{name}={value!r}" for name, value in sorted(params.items()))
+        digest = hashlib.sha256(f"{kind}:{key}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.root, f"{kind}-{digest}.csv")
+
+    def get(self, kind, write, **params):
+        path = self.path(kind, **params)
+        if not os.path.exists(path):
+            tmp = f"{path}.tmp"
+            write(tmp, **params)
+            os.replace(tmp, path)
+        return path
+
+    def messages(self, num_messages, num_contacts, **params):
+        """Path of a cached messages.csv, see write_messages_csv for the parameters"""
+        return self.get("messages", write_messages_csv, num_messages=num_messages, num_contacts=num_contacts,
+                        **params)
+
+    def contacts(self, num_contacts, **params):
+        """Path of a cached contacts.csv, see write_contacts_csv for the parameters"""
+        return self.get("contacts", write_contacts_csv, num_contacts=num_contacts, **params)
+
+    def pair(self, num_messages, num_contacts, **params):
+        """Paths of a cached (messages.csv, contacts.csv) pair"""
+        return self.messages(num_messages, num_contacts, **params), self.contacts(num_contacts)
@@ -0,0 +1,141 @@
+"""Resource usage of a child process and of the output it produced.
+
+`run_with_usage` replaces `subprocess.run`: the command is reaped with
+`os.wait4`, which returns its rusage (CPU time, peak RSS, context switches,
+block I/O).
+
+On Linux the peak RSS survives fork and exec, a command started from the
+test process would report at least the RSS of pytest. The command is
+therefore forked by a minimal Python launcher, which reports the rusage of
+its child as JSON on a pipe. Its stdout and stderr go to temporary files.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass
+
+LAUNCHER = """
+import json, os, sys, time
+report = int(sys.argv[1])
+start = time.perf_counter_ns()
+pid = os.fork()
+if pid == 0:
+    os.close(report)
+    try:
+        os.execvp(sys.argv[2], sys.argv[2:])
+    finally:
+        os._exit(127)
+_, status, usage = os.wait4(pid, 0)
+wall_ns = time.perf_counter_ns() - start
+fields = ("ru_utime", "ru_stime", "ru_maxrss", "ru_nvcsw", "ru_nivcsw", "ru_inblock", "ru_oublock")
+data = dict({name: getattr(usage, name) for name in fields}, wall_ns=wall_ns)
+os.write(report, json.dumps(data).encode())
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+
+@dataclass
+class ResourceUsage:
+    """What a process_messages run cost, as reported by wait4 and the output directory"""
+
+    wall_s: float = 0.0
+    user_s: float = 0.0
+    system_s: float = 0.0
+    # ru_maxrss is in KiB on Linux
+    max_rss_bytes: int = 0
+    voluntary_switches: int = 0
+    involuntary_switches: int = 0
+    # 512-byte blocks read and written by the filesystem
+    block_inputs: int = 0
+    block_outputs: int = 0
+    output_files: int = 0
+    output_bytes: int = 0
+
+    @property
+    def cpu_s(self):
+        return self.user_s + self.system_s
+
+    def __str__(self):
+        return (f"wall {self.wall_s:.3f}s, user {self.user_s:.3f}s, system {self.system_s:.3f}s, "
+                f"peak RSS {self.max_rss_bytes / 2**20:.1f} MiB, "
+                f"context switches {self.voluntary_switches}/{self.involuntary_switches}, "
+                f"blocks in/out {self.block_inputs}/{self.block_outputs}, "
+                f"output {self.output_files} files, {self.output_bytes} bytes")
+
+
+def directory_usage(path):
+    """Return the number of files under `path` and their total size"""
+    files = size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.stat(os.path.join(root, name)).st_size
+    return files, size
+
+
+def run_with_usage(command, output_dir=None, stdin=None):
+    """Run `command` and return its CompletedProcess (text output) and ResourceUsage
+
+    `stdin`, a file object, is read by the command instead of the test's stdin.
+    """
+    read_end, write_end = os.pipe()
+    try:
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                [sys.executable, "-I", "-S", "-c", LAUNCHER, str(write_end), *command],
+                stdin=stdin, stdout=stdout, stderr=stderr, pass_fds=(write_end,),
+            )
+            os.close(write_end)
+            write_end = None
+            with os.fdopen(read_end, "rb") as report:
+                read_end = None
+                data = json.loads(report.read())
+            process.wait()
+            stdout.seek(0)
+            stderr.seek(0)
+            result = subprocess.CompletedProcess(
+                command, process.returncode,
+                stdout.read().decode("utf-8", "replace"), stderr.read().decode("utf-8", "replace"),
+            )
+    finally:
+        for fd in (read_end, write_end):
+            if fd is not None:
+                os.close(fd)
+    usage = ResourceUsage(
+        wall_s=data["wall_ns"] / 1e9,
+        user_s=data["ru_utime"],
+        system_s=data["ru_stime"],
+        max_rss_bytes=data["ru_maxrss"] * 1024,
+        voluntary_switches=data["ru_nvcsw"],
+        involuntary_switches=data["ru_nivcsw"],
+        block_inputs=data["ru_inblock"],
+        block_outputs=data["ru_oublock"],
+    )
+    if output_dir is not None and os.path.isdir(output_dir):
+        usage.output_files, usage.output_bytes = directory_usage(output_dir)
+    return result, usage
+
+
+def process_cpu_time(pid):
+    """CPU time of the running process `pid` so far, every thread included,
+    from /proc (Linux only), in seconds to the clock tick (usually 10 ms)"""
+    with open(f"/proc/{pid}/stat", encoding="ascii") as f:
+        # the fields after the command name, the state first
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def process_resources(pid):
+    """Current and peak RSS and open file descriptors of the running process
+    `pid`, from /proc (Linux only)"""
+    with open(f"/proc/{pid}/status", encoding="ascii") as f:
+        status = dict(line.split(":", 1) for line in f if ":" in line)
+    # VmRSS and VmHWM are in kB
+    return {
+        "rss_bytes": int(status["VmRSS"].split()[0]) * 1024,
+        "peak_rss_bytes": int(status["VmHWM"].split()[0]) * 1024,
+        "fds": len(os.listdir(f"/proc/{pid}/fd")),
+    }
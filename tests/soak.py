@@ -0,0 +1,147 @@
+"""Soak runs: the same batch processed over and over, watching for drift.
+
+A soak records a few series per run: its latency, the resident and peak
+memory and open file descriptors of the process doing the work, the size
+of the output. Leaks and creeping slowness show up as a trend, which a
+handful of repetitions checked against their mean cannot see.
+`linear_trend` fits a least squares line through a series, in run order,
+and `Soak.drift` reports a series whose slope is both significant (t
+statistic above the Student quantile of the normal quantile SIGNIFICANCE,
+a one-sided p-value of 0.13%) and large (the fitted change over the soak
+exceeds a tolerance, so that a tiny but significant slope over thousands
+of runs does not fail it).
+
+Consecutive runs are not independent: noise comes in bursts (other
+processes, writeback, CPU frequency) and a one-off step, such as an arena
+allocated once, leaves the residuals of the line correlated. The standard
+error of the slope is computed on the effective number of runs
+n (1 - r) / (1 + r), r being the lag-1 autocorrelation of the residuals,
+as for a trend in AR(1) noise: a burst or a step is not a drift, a steady
+leak is.
+
+The first runs warm caches and allocator arenas up, they are recorded but
+left out of the fit: those of the first WARMUP_SECONDS, at least
+MIN_WARMUP_RUNS and at most half of the runs. A warm-up counted in runs
+would depend on the speed of the machine; a long-lived process takes
+about a thousand batches, half a minute, before its RSS levels off.
+"""
+
+import math
+import time
+from dataclasses import dataclass
+
+SIGNIFICANCE = 3.0
+WARMUP_SECONDS = 30.0
+MIN_WARMUP_RUNS = 3
+
+
+@dataclass
+class Trend:
+    """Least squares line `intercept + slope * run` through a series"""
+
+    slope: float
+    intercept: float
+    # slope over its standard error, infinite for a series on a perfect line
+    t: float
+    runs: int
+    # runs worth of independent samples, see the module docstring
+    effective_runs: float
+
+    @property
+    def change(self):
+        """Fitted change from the first run to the last"""
+        return self.slope * (self.runs - 1)
+
+
+def linear_trend(values):
+    """Trend of `values` against their index"""
+    n = len(values)
+    if n < 3:
+        raise ValueError(f"a trend needs at least 3 values, got {n}")
+    mean_x = (n - 1) / 2
+    mean_y = sum(values) / n
+    sxx = sum((x - mean_x) ** 2 for x in range(n))
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+    slope = sxy / sxx
+    intercept = mean_y - slope * mean_x
+    residuals = [y - intercept - slope * x for x, y in enumerate(values)]
+    squares = sum(e * e for e in residuals)
+    if not squares:
+        # on a perfect line
+        t = math.copysign(math.inf, slope) if slope else 0.0
+        return Trend(slope, intercept, t, n, n)
+    lag = sum(a * b for a, b in zip(residuals, residuals[1:])) / squares
+    lag = min(max(lag, 0.0), 1.0)
+    effective = n * (1 - lag) / (1 + lag)
+    if effective <= 2:
+        return Trend(slope, intercept, 0.0, n, effective)
+    error = math.sqrt(squares / (effective - 2) / sxx)
+    return Trend(slope, intercept, slope / error, n, effective)
+
+
+def critical_t(z, dof):
+    """Quantile of Student's t with `dof` degrees of freedom at the normal
+    quantile `z` (Cornish-Fisher expansion, Abramowitz & Stegun 26.7.5)"""
+    return (z + (z ** 3 + z) / 4 / dof + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96 / dof ** 2
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384 / dof ** 3)
+
+
+class Soak:
+    """Series recorded over the runs of a soak, see the module docstring
+
+    The soak lasts `iterations` runs or `seconds`, whichever comes first,
+    and at least `min_runs` runs.
+    """
+
+    def __init__(self, iterations=None, seconds=None, min_runs=30):
+        self.iterations = iterations
+        self.seconds = seconds
+        self.min_runs = min_runs
+        self.series = {}
+        self.elapsed = 0.0
+        # time since the start of the soak of each record
+        self.times = []
+        self.start = None
+
+    def runs(self):
+        """Yield the index of each run until the soak is over"""
+        start = self.start = time.monotonic()
+        run = 0
+        while run < self.min_runs or (
+            (self.iterations is None or run < self.iterations)
+            and (self.seconds is None or self.elapsed < self.seconds)
+        ):
+            yield run
+            run += 1
+            self.elapsed = time.monotonic() - start
+
+    def record(self, **values):
+        self.times.append(0.0 if self.start is None else time.monotonic() - self.start)
+        for name, value in values.items():
+            self.series.setdefault(name, []).append(value)
+
+    def warmup(self):
+        """Number of warm-up runs, see the module docstring"""
+        runs = sum(1 for elapsed in self.times if elapsed < WARMUP_SECONDS)
+        return max(MIN_WARMUP_RUNS, min(runs, len(self.times) // 2))
+
+    def trend(self, name):
+        """Trend of the series `name`, warm-up runs excluded"""
+        return linear_trend(self.series[name][self.warmup():])
+
+    def drift(self, name, tolerance):
+        """Failure message if `name` drifts upwards by more than `tolerance`
+        over the soak, None otherwise"""
+        trend = self.trend(name)
+        if trend.t > critical_t(SIGNIFICANCE, trend.effective_runs - 2) and trend.change > tolerance:
+            return (f"{name} drifts by {trend.change:+.6g} over {trend.runs} runs "
+                    f"(t = {trend.t:.1f} on {trend.effective_runs:.0f} effective runs, tolerance {tolerance:.6g})")
+        return None
+
+    def __str__(self):
+        lines = [f"{len(self.times)} runs in {self.elapsed:.1f}s, {self.warmup()} of warm-up"]
+        for name, values in self.series.items():
+            trend = self.trend(name)
+            lines.append(f"  {name}: first {values[0]:.6g}, last {values[-1]:.6g}, max {max(values):.6g}, "
+                         f"fitted change {trend.change:+.6g} (t = {trend.t:.1f})")
+        return "\n".join(lines)
@@ -1,24 +1,46 @@
 import base64
+import gzip
+import lzma
+import tarfile
+import zipfile
+import shlex
 import subprocess
+import sys
 import os
-import shutil
 import json
 import uuid 
+import random
+import contextlib
+import time
+import select
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import pytest
 
-# Helper functions
-@pytest.fixture(autouse=True)
-def clean_test_artifacts():
-    """Helper to clear and recreate output directory before each test"""
-    if os.path.exists("output"):
-        shutil.rmtree("output")
-    os.makedirs("output")
-
-    yield 
-    for f in ["./data/test_messages.csv", "./data/test_contacts.csv"]:
-        if os.path.exists(f):
-            os.remove(f)
+from msgproc import transform
+from msgproc.client import request
+from msgproc.contacts import load_contacts
+from msgproc.duplicates import IdTable, SuspectSet, suspected_duplicates
+from msgproc.errors import InputError
+from msgproc.layout import OutputLayout
+from msgproc.metrics import Metrics, breakdown
+from msgproc.profiling import Sampler
+from msgproc.ranges import RANGE_SIZE, iter_rows_parallel
+from msgproc.reader import MESSAGE_COLUMNS, Message, iter_rows
+from msgproc.snapshot import read_snapshot, snapshot_path
+from msgproc.spool import Spool
+from msgproc.writer import serialize, to_record
+from verify import verify_output
+
+# Command under test: the in-repo reference implementation by default,
+# set PROCESS_MESSAGES="./process_messages" to run the suite against the binary
+PROCESS_MESSAGES = (
+    shlex.split(os.environ["PROCESS_MESSAGES"])
+    if "PROCESS_MESSAGES" in os.environ
+    else [sys.executable, "-m", "msgproc"]
+)
 
+# Helper functions
 def create_test_csv(filename, content):
     """Helper to create test CSV files"""
     with open(filename, 'w', encoding='utf-8') as f:
@@ -29,10 +51,10 @@ def load_json_file(filepath):
     with open(filepath, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def run_process_messages(messages_file, contacts_file, output_dir="output"):
+def run_process_messages(messages_file, contacts_file, output_dir="output", options=()):
     """Helper to run the process_messages program"""
     result = subprocess.run(
-        ["./process_messages", messages_file, contacts_file, output_dir],
+        PROCESS_MESSAGES + [messages_file, contacts_file, output_dir, *options],
         capture_output=True,
         text=True
     )
@@ -105,16 +127,10 @@ def test_F05_json_structure_integrity():
 
     assert result.returncode == 0   
 
-    required_fields = ["id", "datetime", "direction", "content", "contact"]
-    
-    json_files = os.listdir("output")
-    assert len(json_files) > 0
-    
-    for json_file in json_files:
-        data = load_json_file(f"output/{json_file}")
-        
-        for field in required_fields:
-            assert field in data
+    # the five fields of every file, checked against the inputs (see tests/verify.py)
+    report = verify_output("output", "./data/messages.csv", "./data/contacts.csv")
+    assert report.ok, report
+    assert report.documents > 0
 
 
 def test_F06_id_accuracy():
@@ -131,6 +147,8 @@ def test_F06_id_accuracy():
     data = load_json_file(json_file)
     
     assert data["id"] == expected_id
+    report = verify_output("output", "./data/messages.csv", "./data/contacts.csv")
+    assert report.ok, report
 
 
 def test_F07_date_format_conversion():
@@ -230,6 +248,815 @@ def test_F11_max_output_limit():
 
     result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output")
     
-    generated_files = os.listdir("output")
+    report = verify_output("output", "./data/test_messages.csv", "./data/test_contacts.csv")
     
-    assert len(generated_files) == nb_messages, f"Expected {nb_messages} files created, found {len(generated_files)}"
\ No newline at end of file
+    assert report.documents == nb_messages, f"Expected {nb_messages} files created, found {report.documents}"
+    assert report.ok, report
+
+
+@pytest.mark.parametrize("pool", ["thread", "process"])
+def test_F12_parallel_writer_matches_serial(pool):
+    msg_lines = ["id,datetime,direction,content,contact"]
+    nb_messages = 600
+    for i in range(nb_messages):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},destinating,Message {i},1001")
+    msg_lines.append(msg_lines[1].replace("Message 0", "Duplicate of message 0"))
+
+    contacts_csv = """id,name
+1001,Test Contact"""
+
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", contacts_csv)
+
+    serial = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/serial")
+    parallel = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/parallel",
+                                    options=["--workers", "4", "--pool", pool])
+
+    assert parallel.returncode == serial.returncode
+    assert sorted(os.listdir("output/parallel")) == sorted(os.listdir("output/serial"))
+    assert len(os.listdir("output/parallel")) == nb_messages + 1
+    for filename in os.listdir("output/serial"):
+        with open(f"output/serial/{filename}", "rb") as f1, open(f"output/parallel/{filename}", "rb") as f2:
+            assert f1.read() == f2.read()
+
+
+@pytest.mark.parametrize("join", ["merge", "spill"])
+def test_F13_contact_join_modes_match_index(join):
+    msg_lines = ["id,datetime,direction,content,contact"]
+    nb_messages = 300
+    for i in range(nb_messages):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},originating,Message {i},{1000 + i // 3}")
+
+    contact_lines = ["id,name"] + [f"{1000 + i},Contact {i}" for i in range(nb_messages)]
+
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "\n".join(contact_lines))
+
+    index = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/index")
+    joined = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", f"output/{join}",
+                                  options=["--join", join, "--spill-partitions", "7"])
+
+    assert index.returncode == 0
+    assert joined.returncode == 0
+    assert sorted(os.listdir(f"output/{join}")) == sorted(os.listdir("output/index"))
+    for filename in os.listdir("output/index"):
+        assert load_json_file(f"output/{join}/{filename}") == load_json_file(f"output/index/{filename}")
+
+
+def read_bulk_output(path, fmt, compression):
+    """Helper to return {member name: bytes} of a bulk output file"""
+    if fmt == "zip":
+        with zipfile.ZipFile(path) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+    opener = {"none": open, "gzip": gzip.open, "lzma": lzma.open}[compression]
+    with opener(path, "rb") as f:
+        if fmt == "ndjson":
+            return {f"{json.loads(line)['id']}.json": line.rstrip(b"\n") for line in f}
+        with tarfile.open(fileobj=f, mode="r|") as tar:
+            return {member.name: tar.extractfile(member).read() for member in tar}
+
+
+@pytest.mark.parametrize("fmt,compression,filename", [
+    ("ndjson", "none", "messages.ndjson"),
+    ("ndjson", "gzip", "messages.ndjson.gz"),
+    ("tar", "none", "messages.tar"),
+    ("tar", "lzma", "messages.tar.xz"),
+    ("zip", "gzip", "messages.zip"),
+])
+def test_F14_bulk_formats_match_per_file_output(fmt, compression, filename):
+    msg_lines = ["id,datetime,direction,content,contact"]
+    nb_messages = 50
+    for i in range(nb_messages):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},destinating,\"Message, {i} é\",1001")
+
+    contacts_csv = """id,name
+1001,Test "Contact\""""
+
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", contacts_csv)
+
+    per_file = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/json")
+    bulk = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", f"output/{fmt}",
+                                options=["--format", fmt, "--compression", compression])
+
+    assert per_file.returncode == 0
+    assert bulk.returncode == 0
+    assert os.listdir(f"output/{fmt}") == [filename]
+    members = read_bulk_output(f"output/{fmt}/{filename}", fmt, compression)
+    assert sorted(members) == sorted(os.listdir("output/json"))
+    for name, data in members.items():
+        with open(f"output/json/{name}", "rb") as f:
+            assert f.read() == data
+
+
+def test_F15_incremental_rerun_rewrites_changed_messages_only():
+    ids = [str(uuid.uuid4()) for _ in range(6)]
+    msg_lines = ["id,datetime,direction,content,contact"]
+    for i, msg_id in enumerate(ids):
+        msg_lines.append(f"{msg_id},{1770138198 + i},originating,Message {i},{1001 + i % 2}")
+
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Alice\n1002,Bob")
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  options=["--incremental"])
+    assert result.returncode == 0
+    assert sorted(os.listdir("output")) == sorted([".manifest.json"] + [f"{msg_id}.json" for msg_id in ids])
+    for msg_id in ids:
+        os.utime(f"output/{msg_id}.json", ns=(0, 0))
+
+    # ids[0] changes content, ids[5] is removed, contact 1002 (ids[1], ids[3]) is renamed
+    msg_lines[1] = msg_lines[1].replace("Message 0", "Message 0 edited")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines[:-1]))
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Alice\n1002,Robert")
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  options=["--incremental"])
+    assert result.returncode == 0
+    assert not os.path.exists(f"output/{ids[5]}.json")
+    touched = {msg_id for msg_id in ids[:5] if os.stat(f"output/{msg_id}.json").st_mtime_ns != 0}
+    assert touched == {ids[0], ids[1], ids[3]}
+    assert base64.b64decode(load_json_file(f"output/{ids[0]}.json")["content"]) == b"Message 0 edited"
+    assert load_json_file(f"output/{ids[3]}.json")["contact"] == "Robert"
+
+
+@pytest.mark.parametrize("contact", [
+    "Test Contact",
+    'Quote " and backslash \\',
+    "Tab\tnewline\ncarriage\rreturn\x00\x1f\x7f",
+    "Accents éàü, CJK 漢字, emoji 😀🚀",
+    "Line separators \u2028\u2029",
+    "",
+])
+def test_F16_template_serializer_matches_json_dumps(contact):
+    message = Message(2, "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "2026-02-02T16:34:59", "destinating",
+                      base64.b64encode("Test message F16".encode("utf-8")).decode("ascii"), contact,
+                      "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5")
+
+    assert serialize(message) == json.dumps(to_record(message)).encode("utf-8")
+    assert json.loads(serialize(message))["contact"] == contact
+
+
+def utc_isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+# Every second of days around the epoch, leap days and the ends of the datetime range
+F17_DAYS = ["0001-01-01", "1899-12-31", "1900-02-28", "1900-03-01", "1969-12-31", "1970-01-01",
+            "2000-02-29", "2024-02-29", "2026-02-02", "9999-12-31"]
+
+
+@pytest.mark.parametrize("day", F17_DAYS)
+def test_F17_batch_datetime_matches_fromtimestamp(day):
+    start = int(datetime.fromisoformat(day).replace(tzinfo=timezone.utc).timestamp())
+    timestamps = list(range(start, start + 86400))
+    expected = [utc_isoformat(timestamp) for timestamp in timestamps]
+
+    assert transform.format_timestamps(timestamps) == expected
+    assert [transform.format_datetime(timestamp) for timestamp in timestamps] == expected
+    if transform.numpy is not None:
+        assert transform.format_timestamps_numpy(timestamps) == expected
+
+
+def test_F17_batch_datetime_random_timestamps():
+    rng = random.Random(17)
+    timestamps = [rng.randint(transform.MIN_TIMESTAMP, transform.MAX_TIMESTAMP) for _ in range(100000)]
+    timestamps += [transform.MIN_TIMESTAMP, transform.MAX_TIMESTAMP, -1, 0, 1]
+
+    assert transform.format_timestamps(timestamps) == [utc_isoformat(timestamp) for timestamp in timestamps]
+    # one day per timestamp: the day prefix cache is reset along the way
+    assert len(transform.day_prefixes) <= transform.DAY_CACHE_SIZE
+
+
+@pytest.mark.parametrize("timestamp", [transform.MIN_TIMESTAMP - 1, transform.MAX_TIMESTAMP + 1, 2**63, -2**63 - 1])
+def test_F17_batch_datetime_out_of_range(timestamp):
+    with pytest.raises(OverflowError):
+        transform.format_timestamps([0, timestamp])
+    if transform.numpy is not None:
+        with pytest.raises(OverflowError):
+            transform.format_timestamps_numpy([0, timestamp])
+
+
+@contextlib.contextmanager
+def running_daemon(socket_path, contacts_file):
+    """Helper to run msgproc.daemon for the duration of a with block"""
+    daemon = subprocess.Popen(
+        [sys.executable, "-m", "msgproc.daemon", socket_path, contacts_file, "--watch-interval", "0.1"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+    try:
+        assert daemon.stdout.readline(), daemon.stderr.read()
+        yield daemon
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=10)
+
+
+def read_output_files(output_dir):
+    files = {}
+    for filename in os.listdir(output_dir):
+        with open(os.path.join(output_dir, filename), "rb") as f:
+            files[filename] = f.read()
+    return files
+
+
+def test_F18_daemon_matches_cli():
+    msg_lines = ["id,datetime,direction,content,contact"]
+    for i in range(200):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},originating,Message {i},{1000 + i % 10}")
+    contacts_lines = ["id,name"] + [f"{1000 + i},Contact {i}" for i in range(10)]
+
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "\n".join(contacts_lines))
+
+    cold = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/cold")
+    assert cold.returncode == 0
+    with running_daemon("daemon.sock", "./data/test_contacts.csv") as daemon:
+        result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/daemon",
+                                      options=["--daemon", "daemon.sock"])
+        assert result.returncode == 0, result.stderr
+        assert read_output_files("output/daemon") == read_output_files("output/cold")
+
+        # concurrent clients
+        with ThreadPoolExecutor(4) as executor:
+            statuses = list(executor.map(
+                lambda i: request("daemon.sock", ["./data/test_messages.csv", "./data/test_contacts.csv",
+                                                  f"output/concurrent{i}"]),
+                range(4),
+            ))
+        assert statuses == [(0, [])] * 4
+        for i in range(4):
+            assert read_output_files(f"output/concurrent{i}") == read_output_files("output/cold")
+
+        # contacts.csv is reloaded once changed
+        create_test_csv("./data/test_contacts.csv", "\n".join(contacts_lines).replace("Contact 3", "Renamed contact 3"))
+        result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/renamed",
+                                      options=["--daemon", "daemon.sock"])
+        assert result.returncode == 0, result.stderr
+        msg_id = msg_lines[4].split(",")[0]
+        assert load_json_file(f"output/renamed/{msg_id}.json")["contact"] == "Renamed contact 3"
+
+        # errors are reported by the client, the daemon keeps running
+        create_test_csv("./data/test_invalid.csv", "id,datetime,direction,content,contact\n12345,1,originating,x,1000")
+        result = run_process_messages("./data/test_invalid.csv", "./data/test_contacts.csv", "output/invalid",
+                                      options=["--daemon", "daemon.sock"])
+        assert result.returncode == 1
+        assert "id must be a UUID v4" in result.stderr
+        result = run_process_messages("./data/test_messages.csv", "./data/other_contacts.csv", "output/other",
+                                      options=["--daemon", "daemon.sock"])
+        assert result.returncode == 1
+        assert request("daemon.sock", ["./data/test_messages.csv"]) == (2, [
+            "the following arguments are required: contacts, output_dir"])
+        assert daemon.poll() is None
+    assert not os.path.exists("daemon.sock")
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/stopped",
+                                  options=["--daemon", "daemon.sock"])
+    assert result.returncode == 1
+    assert "cannot reach daemon" in result.stderr
+
+
+@pytest.mark.parametrize("options", [
+    ["--durability", "none"],
+    ["--durability", "batch", "--sync-files", "7"],
+    ["--durability", "strict"],
+    ["--durability", "batch", "--workers", "3"],
+    ["--durability", "strict", "--format", "ndjson"],
+])
+def test_F19_durability_modes_match_default(options):
+    msg_lines = ["id,datetime,direction,content,contact"]
+    for i in range(100):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},originating,Message {i},1001")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Test Contact")
+    fmt = options[options.index("--format") + 1:][:1] if "--format" in options else []
+
+    default = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/default",
+                                   options=["--format", *fmt] if fmt else ())
+    durable = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/durable",
+                                   options=options)
+
+    assert default.returncode == durable.returncode == 0, durable.stderr
+    # no temporary file is left behind
+    assert read_output_files("output/durable") == read_output_files("output/default")
+
+
+def test_F20_duplicate_detectors_match_a_set():
+    rng = random.Random(20)
+    ids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(20000)]
+    # repeats, upper case variants (distinct ids) and non-UUID strings
+    ids += rng.sample(ids, 500) + [msg_id.upper() for msg_id in rng.sample(ids, 50)] + ["12345", "12345", ""]
+    rng.shuffle(ids)
+    create_test_csv("./data/test_messages.csv", "id,datetime,direction,content,contact\n"
+                    + "".join(f"{msg_id},1770138198,originating,Message,1001\n" for msg_id in ids))
+
+    table = IdTable(slots=8)
+    suspects = SuspectSet(suspected_duplicates("./data/test_messages.csv"))
+    seen = set()
+    for msg_id in ids:
+        expected = msg_id not in seen
+        seen.add(msg_id)
+        assert table.add(msg_id) == expected
+        assert suspects.add(msg_id) == expected
+    assert len(table) == len(seen)
+    # the table grew from 8 slots and stays at most 3/4 full
+    assert 4 * table.size <= 3 * table.memory() // 16
+    # a 10 bits per row Bloom filter has about 1% false positives
+    assert len(suspects.suspects) < 500 + 3 + 0.05 * len(ids)
+
+
+def adversarial_messages_csv(rng, nb_messages):
+    """messages.csv text whose records are hard to split: quoted commas and
+    line breaks, escaped and stray quotes, CRLF then LF line endings, blank
+    lines, and a field over LARGE_FIELD characters holding line breaks"""
+    contents = ['plain', '"with, comma"', '"multi\nline\n""quoted""\n"', 'stray"quote', '"ends with newline\n"',
+                '"\r\ncrlf\r\n"', 'émoji 😀', '""""""', '"a ""b"", c"', '"' + "x\n" * 300 + '"']
+    lines = ["id,datetime,direction,content,contact"]
+    for i in range(nb_messages):
+        lines.append(f"{uuid.UUID(int=rng.getrandbits(128), version=4)},{1770138198 + i},originating,"
+                     f"{rng.choice(contents)},{1000 + i % 10}")
+        if rng.random() < 0.02:
+            lines.append("")
+    large = '"' + ("y" * 400000 + "\n") * 3 + '"'
+    lines.insert(nb_messages // 2, f"{uuid.UUID(int=rng.getrandbits(128), version=4)},1770138198,originating,"
+                                   f"{large},1000")
+    half = len(lines) // 2
+    return "\r\n".join(lines[:half]) + "\r\n" + "\n".join(lines[half:]) + "\n"
+
+
+def read_all_rows(rows):
+    """(line, fields) of `rows` with spooled fields read back, and the error that stopped them"""
+    result = []
+    try:
+        for line, fields in rows:
+            result.append((line, [value if isinstance(value, str) else value.read_text() for value in fields]))
+    except InputError as exc:
+        return result, str(exc)
+    return result, None
+
+
+def test_F21_parallel_parsing_matches_sequential():
+    text = adversarial_messages_csv(random.Random(21), 600)
+    # a malformed row after many others, the rows before it are still read
+    at = text.index("\n", text.index(",plain,", len(text) * 3 // 4)) + 1
+    broken = text[:at] + "bad,row\n" + text[at:]
+    for name, content in [("messages", text), ("broken", broken)]:
+        with open(f"./data/{name}.csv", "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+
+    with Spool() as spool:
+        for name in ("messages", "broken"):
+            path = f"./data/{name}.csv"
+            expected = read_all_rows(iter_rows(path, MESSAGE_COLUMNS, spool, ("content",)))
+            assert len(expected[0]) > 300
+            assert (expected[1] is None) == (name == "messages")
+            # tiny ranges put split points everywhere, inside quoted fields too
+            for range_size in (1, 61, 4096, RANGE_SIZE):
+                rows = iter_rows_parallel(path, MESSAGE_COLUMNS, 3, spool, ("content",), range_size)
+                assert read_all_rows(rows) == expected, range_size
+
+    create_test_csv("./data/test_contacts.csv", "id,name\n" + "".join(f"{1000 + i},Contact {i}\n" for i in range(10)))
+    serial = run_process_messages("./data/messages.csv", "./data/test_contacts.csv", "output/serial")
+    parallel = run_process_messages("./data/messages.csv", "./data/test_contacts.csv", "output/parallel",
+                                    options=["--parse-workers", "3"])
+    assert serial.returncode == parallel.returncode == 0, parallel.stderr
+    assert read_output_files("output/parallel") == read_output_files("output/serial")
+
+
+def test_F22_sharded_layout_matches_flat():
+    msg_lines = ["id,datetime,direction,content,contact"]
+    ids = [str(uuid.uuid4()) for _ in range(300)]
+    for i, msg_id in enumerate(ids):
+        msg_lines.append(f"{msg_id},{1770138198 + i},originating,Message {i},{1000 + i % 10}")
+    # a repeated id goes to the shard of the id, an upper case one to the lower case shard
+    msg_lines.append(f"{ids[0]},1770138198,destinating,Repeated,1000")
+    msg_lines.append(f"{ids[1].upper()},1770138198,destinating,Upper,1000")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n" + "".join(f"{1000 + i},Contact {i}\n" for i in range(10)))
+
+    flat = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/flat")
+    assert flat.returncode == 1  # the repeated id is reported
+    expected = read_output_files("output/flat")
+    assert len(expected) == 302
+    for options, depth in [(["--layout", "sharded"], 2), (["--layout", "sharded", "--shard-depth", "1"], 1),
+                           (["--layout", "sharded", "--shard-depth", "4", "--workers", "3",
+                             "--durability", "strict"], 4)]:
+        output_dir = f"output/sharded-{depth}"
+        result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", output_dir,
+                                      options=options)
+        assert result.returncode == 1
+        layout = OutputLayout.detect(output_dir)
+        assert layout.depth == depth
+        files = {}
+        for key, path in layout:
+            prefix = key[:2 * depth].lower()
+            assert os.path.relpath(path, output_dir).split(os.sep) == (
+                [prefix[i:i + 2] for i in range(0, 2 * depth, 2)] + [f"{key}.json"])
+            with open(path, "rb") as f:
+                files[f"{key}.json"] = f.read()
+        assert files == expected
+        assert layout.find(f"{ids[0]}_1") is not None
+        assert layout.find(str(uuid.uuid4())) is None
+    assert OutputLayout.detect("output/flat").depth == 0
+    assert len(OutputLayout.detect("output/flat")) == 302
+
+    # incremental reruns look files up in their shard
+    for _ in range(2):
+        result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/incremental",
+                                      options=["--layout", "sharded", "--incremental"])
+        assert result.returncode == 1
+    os.remove(OutputLayout("output/incremental", 2).path(ids[5]))
+    # drops the repeated ids and the last 8 messages
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines[:-10]))
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/incremental",
+                                  options=["--layout", "sharded", "--incremental"])
+    assert result.returncode == 0
+    layout = OutputLayout("output/incremental", 2)
+    assert layout.exists(ids[5])
+    assert not layout.exists(ids[-1])
+    assert len(layout) == 300 - 8
+
+    # an incremental rerun with another layout moves every file, none is left where the previous run put it
+    for options, depth in [([], 0), (["--layout", "sharded", "--shard-depth", "1"], 1),
+                           (["--layout", "sharded"], 2)]:
+        result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/incremental",
+                                      options=["--incremental", *options])
+        assert result.returncode == 0
+        layout = OutputLayout.detect("output/incremental")
+        assert layout.depth == depth
+        assert len(layout) == 300 - 8
+        tree = list(os.walk("output/incremental"))
+        assert sum(len(names) for _, _, names in tree) == 300 - 8 + 1  # and the manifest
+        assert all(os.listdir(directory) for directory, _, _ in tree)
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/ndjson",
+                                  options=["--layout", "sharded", "--format", "ndjson"])
+    assert result.returncode == 2
+    assert "--layout sharded requires --format json" in result.stderr
+
+
+def read_prometheus(path):
+    """Samples of a Prometheus text file, {name with labels: value}"""
+    samples = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+    return samples
+
+
+def test_F23_metrics_file_and_stats():
+    msg_lines = ["id,datetime,direction,content,contact"]
+    for i in range(3000):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},originating,Message {i},{1000 + i % 10}")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n" + "".join(f"{1000 + i},Contact {i}\n" for i in range(10)))
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/json",
+                                  options=["--metrics-file", "metrics.json", "--stats"])
+    assert result.returncode == 0
+    size = sum(os.path.getsize(os.path.join("output/json", name)) for name in os.listdir("output/json"))
+    metrics = load_json_file("metrics.json")
+    assert metrics["done"]
+    assert metrics["counters"] == {"rows_parsed": 3000, "rows_rejected": 0, "messages_written": 3000,
+                                   "bytes_written": size}
+    assert set(metrics["stages"]) == {"load", "parse", "duplicates", "contacts", "encode", "datetime", "write"}
+    assert sum(stage["seconds"] for stage in metrics["stages"].values()) <= metrics["elapsed_seconds"]
+    for name, stage in metrics["stages"].items():
+        assert stage["count"] == (2 if name == "load" else 3000)
+        totals = [total for _, total in stage["buckets"]]
+        assert totals == sorted(totals) and totals[-1] <= 3000
+    assert metrics["average_messages_per_second"] == pytest.approx(3000 / metrics["elapsed_seconds"])
+    # the report goes to stderr
+    assert result.stdout == ""
+    assert "messages written  3000" in result.stderr
+    assert f"bytes written     {size}" in result.stderr
+    assert [line.split()[0] for line in result.stderr.splitlines()[-8:]] == [
+        "load", "parse", "duplicates", "contacts", "encode", "datetime", "write", "other"]
+
+    # Prometheus text, with several workers, a bulk format and the incremental stage
+    for output_dir, options in [("output/workers", ["--workers", "3", "--pool", "process"]),
+                                ("output/ndjson", ["--format", "ndjson"]),
+                                ("output/incremental", ["--incremental"])]:
+        result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", output_dir,
+                                      options=["--metrics-file", "metrics.prom", *options])
+        assert result.returncode == 0
+        assert result.stderr == ""
+        samples = read_prometheus("metrics.prom")
+        assert samples["msgproc_rows_parsed_total"] == 3000
+        assert samples["msgproc_messages_written_total"] == 3000
+        assert samples['msgproc_stage_seconds_count{stage="write"}'] == 3000
+        assert samples['msgproc_stage_seconds_bucket{stage="write",le="+Inf"}'] == 3000
+        if output_dir == "output/ndjson":
+            assert samples["msgproc_bytes_written_total"] == os.path.getsize("output/ndjson/messages.ndjson")
+    assert samples['msgproc_stage_seconds_count{stage="incremental"}'] == 3000
+
+    # rejected rows are counted, the metrics file is still written, and only
+    # the messages before the first rejected row are
+    msg_lines[10] = msg_lines[10].replace("originating", "sideways")
+    msg_lines[20] = msg_lines[20].rsplit(",", 1)[0] + ",abc"
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/invalid",
+                                  options=["--metrics-file", "metrics.json", "--validation", "collect-all"])
+    assert result.returncode == 1
+    metrics = load_json_file("metrics.json")
+    assert metrics["done"]
+    assert metrics["counters"]["rows_rejected"] == 2
+    assert metrics["counters"]["messages_written"] == 9
+    assert len(os.listdir("output/invalid")) == 9
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  options=["--stats", "--daemon", "daemon.sock"])
+    assert result.returncode == 2
+    assert "--stats cannot be used with --daemon" in result.stderr
+
+
+def test_F28_metrics_file_rewritten_while_running():
+    metrics = Metrics("metrics.json", interval=10)
+    with metrics:
+        for _ in metrics.meter(range(5), "parse", "write"):
+            pass
+        metrics.wrote(5, 100)
+        time.sleep(0.1)
+        live = load_json_file("metrics.json")
+        assert not live["done"]
+        assert live["counters"]["messages_written"] == 5
+        assert live["stages"]["parse"]["count"] == 5
+        assert live["elapsed_seconds"] > 0
+    final = load_json_file("metrics.json")
+    assert final["done"]
+    assert final["elapsed_seconds"] >= live["elapsed_seconds"]
+    assert not [name for name in os.listdir(".") if name.endswith(".tmp")]
+
+
+def read_collapsed_stacks(path):
+    """{stack: samples} of a collapsed stack file, frames root first"""
+    stacks = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            stack, count = line.rstrip("\n").rsplit(" ", 1)
+            stacks[tuple(stack.split(";"))] = int(count)
+    return stacks
+
+
+def busy_loop(seconds):
+    deadline = time.monotonic() + seconds
+    total = 0
+    while time.monotonic() < deadline:
+        total += sum(range(100))
+    return total
+
+
+def test_F24_stage_breakdown_and_profile():
+    msg_lines = ["id,datetime,direction,content,contact"]
+    for i in range(3000):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},originating,Message {i},{1000 + i % 10}")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n" + "".join(f"{1000 + i},Contact {i}\n" for i in range(10)))
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  options=["--metrics-file", "metrics.json", "--stats",
+                                           "--profile", "profile.txt", "--profile-interval", "1"])
+    assert result.returncode == 0
+    stages = breakdown(load_json_file("metrics.json"))
+    assert list(stages) == ["load", "parse", "duplicates", "contacts", "encode", "datetime", "write", "other"]
+    assert stages["load"]["calls"] == 2  # duplicate detector and contact index
+    assert all(stages[stage]["calls"] == 3000 for stage in ["parse", "duplicates", "contacts", "encode", "datetime"])
+    assert sum(row["share"] for row in stages.values()) == pytest.approx(1)
+    assert "share" in result.stderr
+    assert [line.split()[0] for line in result.stderr.splitlines()[-8:]] == list(stages)
+
+    stacks = read_collapsed_stacks("profile.txt")
+    assert stacks and all(count > 0 for count in stacks.values())
+    frames = {frame for stack in stacks for frame in stack}
+    assert any(frame.startswith("process (msgproc/pipeline.py:") for frame in frames)
+    # the stack of the pipeline only, the sampler thread is not in it
+    assert not any(frame.startswith("run (msgproc/profiling.py:") for frame in frames)
+
+    # samples follow the stack of the thread that started the sampler, root first
+    with Sampler("busy.txt", interval=1):
+        busy_loop(0.2)
+    stacks = read_collapsed_stacks("busy.txt")
+    busy = [stack for stack in stacks if any(frame.startswith("busy_loop (") for frame in stack)]
+    assert busy
+    for stack in busy:
+        labels = [frame.split(" (")[0] for frame in stack]
+        assert labels.index("test_F24_stage_breakdown_and_profile") < labels.index("busy_loop")
+    assert sum(stacks[stack] for stack in busy) >= sum(stacks.values()) / 2
+
+    # other threads, as in the daemon, are sampled from a thread
+    def profiled():
+        with Sampler("thread.txt", interval=1):
+            busy_loop(0.2)
+
+    with ThreadPoolExecutor(1) as executor:
+        executor.submit(profiled).result()
+    stacks = read_collapsed_stacks("thread.txt")
+    assert any(frame.startswith("busy_loop (") for stack in stacks for frame in stack)
+
+
+def test_F25_contacts_snapshot_cache():
+    msg_lines = ["id,datetime,direction,content,contact"]
+    for i in range(50):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},originating,Message {i},{1000 + i % 10}")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    # repeated id (the last one wins), names out of order, non-ASCII
+    contacts = ["id,name", "1009,Zoé", "1001,Old name"] + [f"{1000 + i},Contact {i} 😀" for i in range(9)]
+    create_test_csv("./data/test_contacts.csv", "\n".join(contacts))
+
+    assert run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/plain").returncode == 0
+    expected = read_output_files("output/plain")
+
+    def run_cached(output_dir):
+        result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", output_dir,
+                                      options=["--contacts-cache", "cache"])
+        assert result.returncode == 0, result.stderr
+        return read_output_files(output_dir)
+
+    assert run_cached("output/cold") == expected
+    snapshot = snapshot_path("cache", "./data/test_contacts.csv")
+    assert os.listdir("cache") == [os.path.basename(snapshot)]
+    stat = os.stat(snapshot)
+    assert run_cached("output/warm") == expected
+    assert os.stat(snapshot).st_mtime_ns == stat.st_mtime_ns
+
+    index = load_contacts("./data/test_contacts.csv")
+    header, mapped = read_snapshot(snapshot)
+    assert header["path"] == os.path.realpath("./data/test_contacts.csv")
+    assert len(mapped) == len(index) == 11
+    for contact_id in [999, 1000, 1001, 1005, 1009, 1010, -1, 2 ** 62]:
+        assert mapped.get(contact_id) == index.get(contact_id)
+    assert mapped.get(1009) == "Zoé"
+
+    # a newer mtime with the same content keeps the snapshot, with the new mtime
+    os.utime("./data/test_contacts.csv", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert run_cached("output/touched") == expected
+    assert read_snapshot(snapshot)[0]["mtime_ns"] == stat.st_mtime_ns + 10 ** 9
+
+    # a renamed contact rebuilds it
+    contacts[5] = contacts[5].replace("Contact", "Renamed")
+    create_test_csv("./data/test_contacts.csv", "\n".join(contacts))
+    files = run_cached("output/renamed")
+    renamed = {name for name, data in files.items() if json.loads(data)["contact"].startswith("Renamed")}
+    assert len(renamed) == 5
+    assert read_snapshot(snapshot)[1].get(1002) == "Renamed 2 😀"
+
+    # so does a damaged one
+    with open(snapshot, "r+b") as f:
+        f.truncate(os.path.getsize(snapshot) // 2)
+    assert read_snapshot(snapshot) is None
+    assert run_cached("output/damaged") == files
+    assert read_snapshot(snapshot)[1].get(1002) == "Renamed 2 😀"
+
+    # unknown contacts are still reported
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines + [f"{uuid.uuid4()},1770138198,,Unknown,4242"]))
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/unknown",
+                                  options=["--contacts-cache", "cache"])
+    assert result.returncode == 1
+    assert "unknown contact 4242" in result.stderr
+
+
+def read_line(stream, timeout=10):
+    """Helper to read one line of a subprocess pipe, failing after `timeout` seconds"""
+    ready, _, _ = select.select([stream], [], [], timeout)
+    assert ready, "no output line"
+    return stream.readline()
+
+
+def test_F26_stdin_stdout_streaming():
+    msg_lines = ["id,datetime,direction,content,contact"]
+    for i in range(3000):
+        msg_lines.append(f"{str(uuid.uuid4())},{1770138198 + i},originating,\"Message, {i} 😀\",{1000 + i % 10}")
+    # a content spooled to disk, read from the pipe past the first MB of its line
+    msg_lines.append(f"{str(uuid.uuid4())},1770138198,destinating,{'x' * (3 << 19)},1001")
+    messages_csv = "\r\n".join(msg_lines) + "\r\n"
+    create_test_csv("./data/test_messages.csv", messages_csv)
+    create_test_csv("./data/test_contacts.csv", "\n".join(["id,name"] + [f"{1000 + i},Contact {i}" for i in range(10)]))
+    assert run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output/files").returncode == 0
+    expected = read_output_files("output/files")
+
+    def documents(text):
+        return {f"{json.loads(line)['id']}.json": line.encode() for line in text.splitlines()}
+
+    # stdin to stdout, in input order
+    result = subprocess.run(PROCESS_MESSAGES + ["-", "./data/test_contacts.csv", "-"], input=messages_csv,
+                            capture_output=True, text=True, encoding="utf-8")
+    assert result.returncode == 0, result.stderr
+    assert documents(result.stdout) == expected
+    assert [json.loads(line)["id"] for line in result.stdout.splitlines()] == [
+        line.split(",")[0] for line in msg_lines[1:]]
+    # either end alone
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "-")
+    assert result.returncode == 0, result.stderr
+    assert documents(result.stdout) == expected
+    with open("./data/test_messages.csv", encoding="utf-8") as f:
+        result = subprocess.run(PROCESS_MESSAGES + ["-", "./data/test_contacts.csv", "output/stdin"], stdin=f,
+                                capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert read_output_files("output/stdin") == expected
+
+    # each document comes out as soon as its row is in, before the end of the input
+    process = subprocess.Popen(PROCESS_MESSAGES + ["-", "./data/test_contacts.csv", "-", "--contacts-cache", "cache"],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        process.stdin.write(b"id,datetime,direction,content,contact\n")
+        for line in msg_lines[1:6]:
+            process.stdin.write(line.encode() + b"\n")
+            process.stdin.flush()
+            document = json.loads(read_line(process.stdout))
+            assert document["id"] == line.split(",")[0]
+        process.stdin.close()
+        assert process.stdout.read() == b""
+        assert process.wait(timeout=10) == 0
+    finally:
+        process.kill()
+        process.wait()
+
+    # errors name stdin
+    result = subprocess.run(PROCESS_MESSAGES + ["-", "./data/test_contacts.csv", "-"],
+                            input="id,datetime,direction,content,contact\nnot-a-uuid,1,,x,1001\n",
+                            capture_output=True, text=True)
+    assert result.returncode == 1
+    assert "<stdin>:2: id must be a UUID v4" in result.stderr
+
+    for messages, output_dir, options in [
+        ("-", "output", ["--parse-workers", "2"]),
+        ("-", "output", ["--duplicate-detector", "bloom"]),
+        ("./data/test_messages.csv", "-", ["--format", "ndjson"]),
+        ("./data/test_messages.csv", "-", ["--workers", "2"]),
+        ("./data/test_messages.csv", "-", ["--durability", "batch"]),
+        ("-", "-", ["--daemon", "daemon.sock"]),
+    ]:
+        result = run_process_messages(messages, "./data/test_contacts.csv", output_dir, options)
+        assert result.returncode == 2, options
+        assert "stdin" in result.stderr or "stdout" in result.stderr, result.stderr
+    with running_daemon("daemon.sock", "./data/test_contacts.csv"):
+        assert request("daemon.sock", ["-", "./data/test_contacts.csv", "-"]) == (
+            2, ["the daemon cannot read stdin or write stdout"])
+
+
+def test_F27_bulk_output_verifier():
+    msg_lines = ["id,datetime,direction,content,contact"]
+    ids = [str(uuid.uuid4()) for _ in range(1200)]
+    for i, msg_id in enumerate(ids):
+        msg_lines.append(f"{msg_id},{1770138198 + i},{['originating', 'destinating', ''][i % 3]},"
+                         f"\"Message, {i} é 😀\",{1000 + i % 10}")
+    msg_lines.append(f"{ids[0]},-86400,destinating,Repeated,1001")
+    msg_lines.append(f"{ids[0]},0,destinating,Repeated again,1002")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n" + "".join(f"{1000 + i},Contact \"{i}\"\n" for i in range(10)))
+    messages, contacts = "./data/test_messages.csv", "./data/test_contacts.csv"
+
+    # every layout and format, on the caller and on a pool
+    for output_dir, options in [("output/flat", []),
+                                ("output/sharded", ["--layout", "sharded"]),
+                                ("output/ndjson", ["--format", "ndjson", "--compression", "gzip"]),
+                                ("output/tar", ["--format", "tar", "--compression", "lzma"]),
+                                ("output/zip", ["--format", "zip"])]:
+        result = run_process_messages(messages, contacts, output_dir, options=options)
+        assert result.returncode == 1, result.stderr  # the repeated ids are reported
+        for workers in [1, 2]:
+            report = verify_output(output_dir, messages, contacts, workers=workers)
+            assert report.ok, report
+            assert (report.documents, report.valid) == (1202, 1202)
+
+    # broken outputs: one failure of each kind
+    def rewrite(path, **changes):
+        document = load_json_file(path)
+        document.update(changes)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(document, f)
+
+    os.remove(f"output/flat/{ids[1]}.json")
+    rewrite(f"output/flat/{ids[2]}.json", contact="Contact \"9\"")
+    rewrite(f"output/flat/{ids[3]}.json", content="TWVzc2FnZQ")
+    rewrite(f"output/flat/{ids[4]}.json", datetime="2026-02-03 16:36:41")
+    rewrite(f"output/flat/{ids[5]}.json", direction="incoming")
+    rewrite(f"output/flat/{ids[6]}.json", extra="field")
+    rewrite(f"output/flat/{ids[7]}.json", id=ids[8])
+    rewrite(f"output/flat/{ids[9]}.json", datetime="2026-02-30T00:00:00")
+    with open(f"output/flat/{ids[10]}.json", "w", encoding="utf-8") as f:
+        f.write('{"id": ')
+    with open(f"output/flat/{uuid.uuid4()}.json", "wb") as f, open(f"output/flat/{ids[11]}.json", "rb") as source:
+        f.write(source.read())
+    create_test_csv("output/flat/notes.txt", "not an output file")
+    report = verify_output("output/flat", messages, contacts, workers=2, max_failures=5)
+    assert report.counts == {"missing": 1, "mismatch": 1, "base64": 1, "datetime": 2, "direction": 1, "schema": 1,
+                             "name": 2, "json": 1, "unexpected": 2}, report
+    assert len(report.failures) == 5
+    assert (report.documents, report.valid) == (1202, 1193)
+    report = verify_output("output/flat", messages, contacts, workers=1, max_failures=100)
+    assert sum(report.counts.values()) == len(report.failures) == 12
+    assert (f"output/flat/{ids[2]}.json", "mismatch", "contact differ from messages.csv") in report.failures
+    assert (ids[1], "missing", "no output for this row of messages.csv") in report.failures
+
+    # files at the wrong depth or in the shard of another key
+    key = ids[12]
+    wrong = "ff/ff" if not key.startswith("ffff") else "00/00"
+    os.makedirs(f"output/sharded/{wrong}", exist_ok=True)
+    os.rename(f"output/sharded/{key[:2]}/{key[2:4]}/{key}.json", f"output/sharded/{wrong}/{key}.json")
+    os.rename(f"output/sharded/{ids[13][:2]}/{ids[13][2:4]}/{ids[13]}.json", f"output/sharded/{ids[13]}.json")
+    report = verify_output("output/sharded", messages, contacts)
+    assert report.counts == {"layout": 2}, report
+    assert report.valid == 1202
@@ -1,32 +1,44 @@
 import base64
+import errno
+import shlex
 import subprocess
+import sys
 import os
-import shutil
 import json 
+import signal
+import tarfile
+import time
+import uuid
+import zipfile
 import pytest
 
-# Helper functions
-@pytest.fixture(autouse=True)
-def clean_test_artifacts():
-    """Helper to clear and recreate output directory before each test"""
-    if os.path.exists("output"):
-        shutil.rmtree("output")
-    os.makedirs("output")
-
-    yield 
-    for f in ["./data/test_messages.csv", "./data/test_contacts.csv"]:
-        if os.path.exists(f):
-            os.remove(f)
+from resources import run_with_usage
+from msgproc import contacts
+from msgproc.duplicates import suspected_duplicates
+from msgproc.durability import FileSink
+from msgproc.pipeline import DATETIME_BATCH, format_datetimes
+from msgproc.reader import Message
+from msgproc.spool import BATCH_CONTENT, LARGE_FIELD, Spool
+from msgproc.validation import batch_is_valid, check_row
+
+# Command under test: the in-repo reference implementation by default,
+# set PROCESS_MESSAGES="./process_messages" to run the suite against the binary
+PROCESS_MESSAGES = (
+    shlex.split(os.environ["PROCESS_MESSAGES"])
+    if "PROCESS_MESSAGES" in os.environ
+    else [sys.executable, "-m", "msgproc"]
+)
 
+# Helper functions
 def create_test_csv(filename, content):
     """Helper to create test CSV files"""
     with open(filename, 'w', encoding='utf-8') as f:
         f.write(content)
 
-def run_process_messages(messages_file, contacts_file, output_dir="output"):
+def run_process_messages(messages_file, contacts_file, output_dir="output", options=()):
     """Helper to run the process_messages program"""
     result = subprocess.run(
-        ["./process_messages", messages_file, contacts_file, output_dir],
+        PROCESS_MESSAGES + [messages_file, contacts_file, output_dir, *options],
         capture_output=True,
         text=True
     )
@@ -46,7 +58,7 @@ def test_R02_missing_contacts_file():
 
 def test_R03_missing_argument():
     result = subprocess.run(
-        ["./process_messages", "./data/messages.csv", "./data/contacts.csv"],
+        PROCESS_MESSAGES + ["./data/messages.csv", "./data/contacts.csv"],
         capture_output=True
     )
     assert result.returncode != 0
@@ -246,3 +258,345 @@ d2f5c3e1-3c4b-4f5a-b6e1-2f3c4d5e6f7a,1770121450,originating,{large_content},1001
     create_test_csv("./data/test_contacts.csv", contacts_csv)
     result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output")
     assert result.returncode == 0
+
+
+def test_R22_large_quoted_content_round_trip():
+    content = ('Line 1, with "quotes"\r\nand emojis 😀🚀\n' * 100000)
+    messages_csv = ("id,datetime,direction,content,contact,extra\n"
+                    f'cd19a0a2-b73c-4ba1-82ae-89d06dc457c5,1770050099,originating,"{content.replace(chr(34), 2 * chr(34))}",1001,x\n'
+                    "b2a3dde1-9a13-41e5-9abd-f1140ae5ed66,1770050100,destinating,Small message,1001,y\n")
+    contacts_csv = """id,name
+1001,Test Contact"""
+
+    create_test_csv("./data/test_messages.csv", messages_csv)
+    create_test_csv("./data/test_contacts.csv", contacts_csv)
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output")
+    assert result.returncode == 0
+    with open("output/cd19a0a2-b73c-4ba1-82ae-89d06dc457c5.json", 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    assert base64.b64decode(data["content"]).decode("utf-8") == content
+    assert data["contact"] == "Test Contact"
+    with open("output/b2a3dde1-9a13-41e5-9abd-f1140ae5ed66.json", 'r', encoding='utf-8') as f:
+        assert base64.b64decode(json.load(f)["content"]) == b"Small message"
+
+
+
+def test_R25_collect_all_reports_every_invalid_row():
+    messages_csv = """id,datetime,direction,content,contact
+cd19a0a2-b73c-4ba1-82ae-89d06dc457c5,1770050099,originating,Valid message,1001
+12345,not_a_timestamp,invalid_direction,,
+b2a3dde1-9a13-41e5-9abd-f1140ae5ed66,-86400,,Valid message before epoch,1001
+a0a8ef8e-534c-4202-aa79-5950d2cc6c60,1770120830,originating,Invalid contact,not_a_valid_contact_id"""
+    contacts_csv = """id,name
+1001,Test Contact"""
+    create_test_csv("./data/test_messages.csv", messages_csv)
+    create_test_csv("./data/test_contacts.csv", contacts_csv)
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  ["--validation", "collect-all"])
+    assert result.returncode != 0
+    assert "6 invalid value(s)" in result.stderr
+    for error in ["test_messages.csv:3: id must be a UUID v4", "test_messages.csv:3: datetime must be an integer",
+                  "test_messages.csv:3: invalid direction", "test_messages.csv:3: missing content",
+                  "test_messages.csv:3: missing contact", "test_messages.csv:5: contact must be an integer"]:
+        assert error in result.stderr
+    assert "test_messages.csv:4" not in result.stderr
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output")
+    assert result.returncode != 0
+    assert "test_messages.csv:3: id must be a UUID v4" in result.stderr
+    assert "test_messages.csv:5" not in result.stderr
+
+
+def test_R30_collect_all_writes_nothing_past_an_invalid_row():
+    # the invalid row is in the first batch of rows, the valid ones fill several more
+    msg_lines = ["id,datetime,direction,content,contact",
+                 "12345,1770050099,originating,Invalid id,1001"]
+    for i in range(3000):
+        msg_lines.append(f"{uuid.uuid4()},{1770050100 + i},originating,Valid message {i},1001")
+    msg_lines.append("b2a3dde1-9a13-41e5-9abd-f1140ae5ed66,1770050099,sideways,Invalid direction,1001")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Test Contact")
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  ["--validation", "collect-all"])
+    assert result.returncode != 0
+    assert "test_messages.csv:2: id must be a UUID v4" in result.stderr
+    assert "test_messages.csv:3003: invalid direction" in result.stderr
+    assert os.listdir("output") == []
+
+
+
+@pytest.mark.parametrize("validation", ["fail-fast", "collect-all"])
+def test_R37_rows_before_an_invalid_row_are_written(validation):
+    # the invalid row is in the middle of the second batch of rows: the valid ones before it are all written
+    msg_lines = ["id,datetime,direction,content,contact"]
+    ids = [str(uuid.uuid4()) for _ in range(1200)]
+    for i, msg_id in enumerate(ids):
+        msg_lines.append(f"{msg_id},{1770050100 + i},originating,Valid message {i},1001")
+    msg_lines.append("12345,1770050099,originating,Invalid id,1001")
+    for i in range(300):
+        msg_lines.append(f"{uuid.uuid4()},{1770050100 + i},originating,Valid message {i},1001")
+    msg_lines.append("b2a3dde1-9a13-41e5-9abd-f1140ae5ed66,1770050099,sideways,Invalid direction,1001")
+    create_test_csv("./data/test_messages.csv", "\n".join(msg_lines))
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Test Contact")
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  ["--validation", validation])
+    assert result.returncode == 1
+    assert "test_messages.csv:1202: id must be a UUID v4" in result.stderr
+    assert ("test_messages.csv:1503: invalid direction" in result.stderr) == (validation == "collect-all")
+    assert sorted(os.listdir("output")) == sorted(f"{msg_id}.json" for msg_id in ids)
+
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "-",
+                                  ["--validation", validation])
+    assert result.returncode == 1
+    assert [json.loads(line)["id"] for line in result.stdout.splitlines()] == ids
+@pytest.mark.parametrize("fields", [
+    ["cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "1770050099", "originating", "Valid", "1001"],
+    ["CD19A0A2-B73C-4BA1-82AE-89D06DC457C5", "1770050099", "", "Valid", "1001"],
+    ["cd19a0a2-b73c-4ba1-82ae-89d06dc457c5\ncd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "1", "originating", "x", "1"],
+    ["cd19a0a2-b73c-3ba1-82ae-89d06dc457c5", "1770050099", "originating", "Valid", "1001"],
+    ["cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "-86400", "destinating", "Valid", "+1001"],
+    ["cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "1770050099", "Originating", "Valid", "1001"],
+    ["cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "1770050099", "originating", "Valid", "١٢"],
+    ["cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "", "originating", "Valid", "1001"],
+    ["cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "1770050099", "originating", "", "1001"],
+])
+def test_R26_columnar_checks_agree_with_row_checks(fields):
+    valid = ["b2a3dde1-9a13-41e5-9abd-f1140ae5ed66", "1770050100", "destinating", "Valid", "1001"]
+    rows = [(2, valid), (3, fields), (4, valid)]
+    if batch_is_valid(rows):
+        assert check_row(3, fields) == []
+    assert batch_is_valid([(2, valid), (4, valid)])
+
+# Peak RSS allowed whatever the size of the content, which is streamed through disk
+LARGE_CONTENT_RSS_BUDGET = 128 * 2**20
+
+def run_large_content(size, fmt="json"):
+    """Helper to run process_messages on one message with a `size` bytes content, written in `fmt`"""
+    with open("./data/test_messages.csv", 'w', encoding='utf-8') as f:
+        f.write("id,datetime,direction,content,contact\n")
+        f.write("cd19a0a2-b73c-4ba1-82ae-89d06dc457c5,1770050099,originating,")
+        for _ in range(size // 2**20):
+            f.write("A" * 2**20)
+        f.write(",1001\n")
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Test Contact")
+
+    result, usage = run_with_usage(PROCESS_MESSAGES + ["./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                                       "--format", fmt], "output")
+    print(f"{size // 2**20}MB content, {fmt}: {usage}")
+    assert result.returncode == 0, result.stderr
+    assert usage.max_rss_bytes < LARGE_CONTENT_RSS_BUDGET
+    header = json.dumps({"id": "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "datetime": "2026-02-02T16:34:59",
+                         "direction": "originating", "content": "", "contact": "Test Contact"})
+    prefix = header[:header.index('"content": "') + len('"content": "')]
+    name = "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5.json"
+    if fmt == "tar":
+        with tarfile.open("output/messages.tar") as archive:
+            info = archive.getmember(name)
+            document_size, f = info.size, archive.extractfile(info)
+            check_document_prefix(f, prefix)
+    elif fmt == "zip":
+        with zipfile.ZipFile("output/messages.zip") as archive:
+            document_size = archive.getinfo(name).file_size
+            with archive.open(name) as f:
+                check_document_prefix(f, prefix)
+    else:
+        document_size = os.path.getsize(f"output/{name}")
+        with open(f"output/{name}", 'rb') as f:
+            check_document_prefix(f, prefix)
+    assert document_size == len(header) + 4 * -(-size // 3)
+
+
+def check_document_prefix(f, prefix):
+    assert f.read(len(prefix)) == prefix.encode()
+    assert f.read(8) == b"QUFBQUFB"
+
+
+def write_large_contents(path, count, size=LARGE_FIELD - 1):
+    """Helper to write a messages.csv of `count` messages with `size` characters contents"""
+    content = "A" * size
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("id,datetime,direction,content,contact\n")
+        for i in range(count):
+            f.write(f"{uuid.uuid4()},{1770050099 + i},originating,{content},1001\n")
+
+
+@pytest.mark.parametrize("fmt", ["json", "tar", "zip"])
+def test_R23_100MB_content_bounded_memory(fmt):
+    run_large_content(100 * 2**20, fmt)
+
+
+@pytest.mark.slow
+def test_R24_1GB_content_bounded_memory():
+    run_large_content(2**30)
+
+
+@pytest.mark.parametrize("options", [[], ["--workers", "4"]])
+def test_R32_many_contents_under_spool_threshold_bounded_memory(options):
+    # contents just under LARGE_FIELD stay in memory: batches are cut by their size, not only their rows
+    nb_messages = 120
+    write_large_contents("./data/test_messages.csv", nb_messages)
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Test Contact")
+
+    result, usage = run_with_usage(PROCESS_MESSAGES + ["./data/test_messages.csv", "./data/test_contacts.csv",
+                                                       "output", *options], "output")
+    print(f"{nb_messages} contents of {LARGE_FIELD - 1} characters: {usage}")
+    assert result.returncode == 0, result.stderr
+    assert usage.output_files == nb_messages
+    assert usage.max_rss_bytes < LARGE_CONTENT_RSS_BUDGET
+
+
+def test_R33_stdin_stream_of_large_contents_bounded_memory():
+    # a fast producer: stdin always has the next row, batches are only cut by their size
+    nb_messages = 120
+    write_large_contents("./data/test_messages.csv", nb_messages)
+    create_test_csv("./data/test_contacts.csv", "id,name\n1001,Test Contact")
+
+    with open("./data/test_messages.csv", 'rb') as f:
+        result, usage = run_with_usage(PROCESS_MESSAGES + ["-", "./data/test_contacts.csv", "-"], stdin=f)
+    print(f"{nb_messages} contents of {LARGE_FIELD - 1} characters from stdin: {usage}")
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.count("\n") == nb_messages
+    assert usage.max_rss_bytes < LARGE_CONTENT_RSS_BUDGET
+
+
+@pytest.mark.parametrize("durability", ["none", "batch", "strict"])
+def test_R27_killed_run_leaves_only_complete_files(durability, datasets):
+    # 1% of 1MB contents: files take long enough to write for the kill to land mid-file
+    messages_file, contacts_file = datasets.pair(5000, 100, large_content_rate=0.01)
+    command = PROCESS_MESSAGES + [messages_file, contacts_file, "output", "--durability", durability]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while len(os.listdir("output")) < 500 and process.poll() is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+
+    names = [name for name in os.listdir("output") if not name.startswith(".")]
+    assert names
+    for name in names:
+        assert name.endswith(".json")
+        with open(f"output/{name}", 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        assert set(data) == {"id", "datetime", "direction", "content", "contact"}
+        base64.b64decode(data["content"], validate=True)
+
+    # a rerun completes the output and replaces the temporary files of the killed one
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    with open(messages_file, 'r', encoding='utf-8') as f:
+        ids = [line.split(",")[0] for line in f.readlines()[1:]]
+    assert sorted(os.listdir("output")) == sorted(f"{msg_id}.json" for msg_id in ids)
+
+
+@pytest.mark.parametrize("durability", ["none", "batch", "strict"])
+def test_R34_failed_write_leaves_no_temporary_file(durability):
+    def failing_pieces():
+        yield b'{"id": "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", "content": "'
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    with pytest.raises(OSError):
+        with FileSink("output", durability) as sink:
+            sink.write("b2a3dde1-9a13-41e5-9abd-f1140ae5ed66.json", [b"{}"])
+            sink.write("cd19a0a2-b73c-4ba1-82ae-89d06dc457c5.json", failing_pieces())
+    # the file written before the failure is kept, complete
+    assert os.listdir("output") == ["b2a3dde1-9a13-41e5-9abd-f1140ae5ed66.json"]
+
+
+@pytest.mark.parametrize("detector", ["table", "bloom"])
+@pytest.mark.parametrize("policy", ["rename", "skip", "fail"])
+def test_R28_duplicate_id_policies(policy, detector):
+    messages_csv = """id,datetime,direction,content,contact
+1841efe3-6703-4450-8372-deeec6624350,1770119260,originating,First message with duplicate ID,1001
+cd19a0a2-b73c-4ba1-82ae-89d06dc457c5,1770119262,originating,Unique message,1001
+1841efe3-6703-4450-8372-deeec6624350,1770119265,originating,Second message with duplicate ID,1001
+1841EFE3-6703-4450-8372-DEEEC6624350,1770119266,originating,Same id in upper case,1001
+1841efe3-6703-4450-8372-deeec6624350,1770119268,originating,Third message with duplicate ID,1001"""
+    contacts_csv = """id,name
+1001,Test Contact"""
+    create_test_csv("./data/test_messages.csv", messages_csv)
+    create_test_csv("./data/test_contacts.csv", contacts_csv)
+    result = run_process_messages("./data/test_messages.csv", "./data/test_contacts.csv", "output",
+                                  ["--duplicates", policy, "--duplicate-detector", detector])
+    assert result.returncode == 1
+    expected = {"1841efe3-6703-4450-8372-deeec6624350.json", "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5.json",
+                "1841EFE3-6703-4450-8372-DEEEC6624350.json"}
+    if policy == "rename":
+        expected |= {"1841efe3-6703-4450-8372-deeec6624350_1.json", "1841efe3-6703-4450-8372-deeec6624350_2.json"}
+        assert result.stderr.count("duplicate message id") == 2
+    elif policy == "skip":
+        assert result.stderr.count("duplicate message id 1841efe3-6703-4450-8372-deeec6624350, skipped") == 2
+    else:
+        # the run stops, messages read before may or may not have been written
+        assert "line 4: duplicate message id 1841efe3-6703-4450-8372-deeec6624350" in result.stderr
+        assert set(os.listdir("output")) <= expected
+        return
+    assert set(os.listdir("output")) == expected
+    with open("output/1841efe3-6703-4450-8372-deeec6624350.json", 'r', encoding='utf-8') as f:
+        assert base64.b64decode(json.load(f)["content"]) == b"First message with duplicate ID"
+
+
+def test_R35_bloom_pass_does_not_keep_spooled_contents():
+    # the first pass of the Bloom detector only needs ids, oversized contents are not kept on disk
+    write_large_contents("./data/test_messages.csv", 3, LARGE_FIELD + 1)
+    with open("./data/test_messages.csv", 'a', encoding='utf-8') as f:
+        f.write("cd19a0a2-b73c-4ba1-82ae-89d06dc457c5,1770119262,originating,Short,1001\n" * 2)
+
+    with Spool() as spool:
+        suspects = suspected_duplicates("./data/test_messages.csv", spool)
+        assert spool.count == 3
+        assert os.listdir(spool.directory) == []
+    assert "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5" in suspects
+
+
+def test_R29_stdout_closed_by_consumer():
+    messages_csv = "id,datetime,direction,content,contact\n" + "".join(
+        f"5006f8c8-52b2-4d5b-9820-{i:012x},1770108032,originating,Message {i},1001\n" for i in range(200000))
+    contacts_csv = """id,name
+1001,Test Contact"""
+    create_test_csv("./data/test_messages.csv", messages_csv)
+    create_test_csv("./data/test_contacts.csv", contacts_csv)
+
+    # as `process_messages ... - | head -1`
+    process = subprocess.Popen(PROCESS_MESSAGES + ["./data/test_messages.csv", "./data/test_contacts.csv", "-"],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert json.loads(process.stdout.readline())["contact"] == "Test Contact"
+    process.stdout.close()
+    assert process.wait(timeout=30) == 1
+    assert process.stderr.read() == b""
+
+
+@pytest.mark.parametrize("content_size,lookahead", [
+    (20, DATETIME_BATCH),
+    (LARGE_FIELD - 1, -(-BATCH_CONTENT // (LARGE_FIELD - 1))),
+])
+def test_R31_datetime_batches_bounded_by_content(content_size, lookahead):
+    # contents just under LARGE_FIELD stay in memory: a batch of them is cut short
+    content = "A" * content_size
+    consumed = []
+
+    def messages():
+        for i in range(3 * DATETIME_BATCH):
+            consumed.append(i)
+            yield Message(i + 2, "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5", 1770050099 + i, "originating", content,
+                          "Test Contact", "cd19a0a2-b73c-4ba1-82ae-89d06dc457c5")
+
+    formatted = format_datetimes(messages())
+    assert next(formatted).datetime == "2026-02-02T16:34:59"
+    assert len(consumed) == lookahead
+    assert [message.datetime for message in formatted][-1] == "2026-02-02T17:26:10"
+
+
+
+def test_R36_unsorted_contacts_sorted_in_runs(monkeypatch):
+    # a contact book larger than a sort run is sorted in spilled runs, repeated ids keep the last name
+    monkeypatch.setattr(contacts, "SORT_RUN", 7)
+    monkeypatch.setattr(contacts, "RUN_CHUNK", 3)
+    pairs = [((i * 37) % 50, f"Contact {i} 😀") for i in range(200)]
+
+    index = contacts.ContactIndex.from_pairs(pairs)
+    assert list(index.ids) == sorted(contact_id for contact_id, _ in pairs)
+    assert {contact_id: index.get(contact_id) for contact_id, _ in pairs} == dict(pairs)
@@ -0,0 +1,371 @@
+"""Bulk verification of an output directory against its inputs.
+
+At a million files, listing the output and loading each JSON file in turn
+takes longer than producing it. `verify_output` walks the output once with
+os.scandir, flat or sharded, and reads the bulk archives it finds
+(messages.ndjson, messages.tar, compressed or not, messages.zip). Files
+and archive members are checked by batches of BATCH_SIZE on a pool of
+worker processes, a bounded number of batches in flight, and their results
+are matched against the inputs as they come back.
+
+Each document must have exactly the five string fields, be named after its
+id (`<id>.json`, `<id>_<n>.json` for repeated ids) in the shard of its id,
+have a `YYYY-MM-DDThh:mm:ss` datetime, a known direction, and a content
+that is canonical base64 of UTF-8 text. A worker sends back a fingerprint
+of each valid document, the CRC-32 of each field, content decoded: the
+fingerprint expected for each key is computed from messages.csv and
+contacts.csv, UTC datetime and contact name included, so that a wrong
+field is found without sending documents back. Keys follow the default
+`--duplicates rename` policy.
+
+The result is one VerificationReport: documents read, failures per kind
+and the first `max_failures` of them. This module does not use msgproc, the
+output may come from the binary under test.
+"""
+
+import binascii
+import csv
+import gzip
+import json
+import lzma
+import os
+import re
+import resource
+import struct
+import sys
+import tarfile
+import time
+import zipfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from itertools import islice
+
+FIELDS = ("id", "datetime", "direction", "content", "contact")
+FIELD_SET = frozenset(FIELDS)
+DIRECTIONS = ("originating", "destinating")
+DEFAULT_DIRECTION = "originating"
+DATETIME_RE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}", re.ASCII)
+ARCHIVE_RE = re.compile(r"messages\.(ndjson|tar)(\.gz|\.xz)?|messages\.zip")
+OPENERS = {".gz": gzip.open, ".xz": lzma.open}
+EPOCH = datetime(1970, 1, 1)
+HEX_DIGITS = frozenset("0123456789abcdef")
+FINGERPRINT = struct.Struct(f"<{len(FIELDS)}I")
+
+# Documents per batch sent to a worker
+BATCH_SIZE = 512
+MAX_FAILURES = 20
+
+# `name` is a file path or `<archive>:<member or line>`
+Failure = namedtuple("Failure", "name kind detail")
+
+
+@dataclass
+class VerificationReport:
+    """Outcome of verify_output"""
+
+    documents: int = 0
+    # documents matching their row of messages.csv
+    valid: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    # CPU time of the caller and of its worker processes
+    cpu_seconds: float = 0.0
+    # {kind: failures}, every failure counted
+    counts: dict = field(default_factory=dict)
+    # the first `max_failures` failures
+    failures: list = field(default_factory=list)
+    max_failures: int = MAX_FAILURES
+
+    @property
+    def ok(self):
+        return not self.counts
+
+    def fail(self, name, kind, detail):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if len(self.failures) < self.max_failures:
+            self.failures.append(Failure(name, kind, detail))
+
+    def __str__(self):
+        text = (f"{self.documents} documents, {self.valid} valid, {self.bytes / 2**20:.1f} MiB "
+                f"verified in {self.seconds:.2f}s")
+        if self.counts:
+            text += "; failures: " + ", ".join(f"{kind} {count}" for kind, count in sorted(self.counts.items()))
+            text += "".join(f"\n  {failure.name}: {failure.kind}: {failure.detail}" for failure in self.failures)
+        return text
+
+
+def fingerprint(msg_id, timestamp, direction, content, contact):
+    """CRC-32 of each field of a document, `content` as decoded bytes"""
+    crc32 = zlib.crc32
+    return FINGERPRINT.pack(crc32(msg_id.encode("utf-8")), crc32(timestamp.encode("ascii")),
+                            crc32(direction.encode("ascii")), crc32(content), crc32(contact.encode("utf-8")))
+
+
+def check_document(key, data):
+    """Return the id of a document, its fingerprint (None if invalid) and
+    the (kind, detail) of its failures
+
+    `key` is the stem of its file name, None for an ndjson line.
+    """
+    try:
+        # decoded first: json.loads would detect the encoding of each document
+        document = json.loads(data.decode("utf-8"))
+    except ValueError as exc:
+        return key, None, [("json", str(exc))]
+    if not isinstance(document, dict) or document.keys() != FIELD_SET:
+        keys = sorted(document) if isinstance(document, dict) else type(document).__name__
+        return key, None, [("schema", f"expected the fields {', '.join(FIELDS)}, got {keys}")]
+    not_strings = [name for name in FIELDS if not isinstance(document[name], str)]
+    if not_strings:
+        return key, None, [("schema", f"not a string: {', '.join(not_strings)}")]
+    msg_id, timestamp, direction, content, contact = (document[name] for name in FIELDS)
+    failures = []
+    if key is not None and key != msg_id and re.fullmatch(re.escape(msg_id) + r"_\d+", key) is None:
+        failures.append(("name", f"file of {key!r} holds the id {msg_id!r}"))
+    if DATETIME_RE.fullmatch(timestamp) is None:
+        failures.append(("datetime", f"expected YYYY-MM-DDThh:mm:ss, got {timestamp!r}"))
+    else:
+        try:
+            datetime.fromisoformat(timestamp)
+        except ValueError as exc:
+            failures.append(("datetime", f"{timestamp!r}: {exc}"))
+    if direction not in DIRECTIONS:
+        failures.append(("direction", f"invalid direction {direction!r}"))
+    try:
+        encoded = content.encode("ascii")
+        raw = binascii.a2b_base64(encoded, strict_mode=True)
+        if binascii.b2a_base64(raw, newline=False) != encoded:
+            failures.append(("base64", "not canonical base64, re-encoding differs"))
+        raw.decode("utf-8")
+    except (binascii.Error, ValueError) as exc:
+        failures.append(("base64", f"{type(exc).__name__}: {exc}"))
+    if not contact:
+        failures.append(("contact", "empty contact"))
+    if failures:
+        return key if key is not None else msg_id, None, failures
+    return key if key is not None else msg_id, fingerprint(msg_id, timestamp, direction, raw, contact), []
+
+
+def check_batch(items):
+    """Check (name, key, path or bytes) documents on a worker
+
+    Return the (name, key, id, fingerprint) of each document, the key
+    None for an ndjson line, the failures found and the bytes read.
+    """
+    results = []
+    failures = []
+    size = 0
+    for name, key, source in items:
+        if isinstance(source, bytes):
+            data = source
+        else:
+            try:
+                with open(source, "rb") as f:
+                    data = f.read()
+            except OSError as exc:
+                failures.append((name, "unreadable", str(exc)))
+                results.append((name, key, key, None))
+                continue
+        size += len(data)
+        ident, digest, found = check_document(key, data)
+        results.append((name, key, ident, digest))
+        failures.extend((name, kind, detail) for kind, detail in found)
+    return results, failures, size
+
+
+def expected_fingerprints(messages_path, contacts_path):
+    """Return {output key: fingerprint} of the rows of messages.csv, None
+    for an unknown contact, and {id: repeats} of the repeated ids"""
+    # contents may exceed the default field size limit, restored on return
+    limit = csv.field_size_limit(sys.maxsize)
+    try:
+        return read_expected(messages_path, contacts_path)
+    finally:
+        csv.field_size_limit(limit)
+
+
+def read_expected(messages_path, contacts_path):
+    contacts = {}
+    with open(contacts_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        id_index, name_index = header.index("id"), header.index("name")
+        for row in reader:
+            if row:
+                # the last of repeated ids wins
+                contacts[int(row[id_index])] = row[name_index]
+    expected = {}
+    repeats = {}
+    with open(messages_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        indexes = [header.index(name) for name in FIELDS]
+        for row in reader:
+            if not row:
+                continue
+            msg_id, timestamp, direction, content, contact_id = (row[i] for i in indexes)
+            key = msg_id
+            if msg_id in expected:
+                repeats[msg_id] = repeats.get(msg_id, 0) + 1
+                key = f"{msg_id}_{repeats[msg_id]}"
+            contact = contacts.get(int(contact_id))
+            formatted = (EPOCH + timedelta(seconds=int(timestamp))).isoformat()
+            expected[key] = None if contact is None else fingerprint(
+                msg_id, formatted, direction or DEFAULT_DIRECTION, content.encode("utf-8"), contact)
+    return expected, repeats
+
+
+def walk(output, report):
+    """Yield (name, key, path or bytes) of every document under `output`
+
+    The shard depth is found from the first shard directories, files at
+    another depth or in the shard of another key and unexpected files are
+    reported in `report`.
+    """
+    depth = 0
+    directory = output
+    while shard := next((entry.path for entry in scan(directory) if entry.is_dir() and is_shard(entry.name)), None):
+        directory = shard
+        depth += 1
+    directories = [(output, ())]
+    while directories:
+        directory, prefix = directories.pop()
+        for entry in scan(directory):
+            name = entry.name
+            if name.startswith("."):
+                # manifest and files being written
+                continue
+            if entry.is_dir():
+                directories.append((entry.path, prefix + (name,)))
+            elif ARCHIVE_RE.fullmatch(name):
+                yield from read_archive(entry.path)
+            elif not name.endswith(".json"):
+                report.fail(entry.path, "unexpected", "not a JSON file")
+            else:
+                key = name[:-5]
+                shards = key[:2 * depth].lower()
+                if prefix != tuple(shards[i:i + 2] for i in range(0, 2 * depth, 2)):
+                    report.fail(entry.path, "layout", f"found in {'/'.join(prefix) or 'the top directory'}, "
+                                f"shard depth {depth}")
+                yield entry.path, key, entry.path
+
+
+def is_shard(name):
+    return len(name) == 2 and HEX_DIGITS.issuperset(name)
+
+
+def read_archive(path):
+    """Yield (name, key, bytes) of the documents of a bulk output file"""
+    name = os.path.basename(path)
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.namelist():
+                yield f"{path}:{member}", member_key(member), archive.read(member)
+        return
+    suffix = os.path.splitext(name)[1]
+    with OPENERS.get(suffix, open)(path, "rb") as f:
+        if ".ndjson" in name:
+            for number, line in enumerate(f, 1):
+                yield f"{path}:{number}", None, line.rstrip(b"\n")
+            return
+        with tarfile.open(fileobj=f, mode="r|") as tar:
+            for member in tar:
+                yield f"{path}:{member.name}", member_key(member.name), tar.extractfile(member).read()
+
+
+def scan(directory):
+    with os.scandir(directory) as entries:
+        yield from entries
+
+
+def member_key(member):
+    """Stem of a `<key>.json` archive member, the whole name otherwise"""
+    return member[:-5] if member.endswith(".json") else member
+
+
+def batched(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+def check_batches(batches, workers):
+    """Yield the check_batch() results of `batches` as they complete on
+    `workers` processes, in order on the caller if `workers` is 1"""
+    if workers <= 1:
+        for batch in batches:
+            yield check_batch(batch)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        for batch in batches:
+            # a bounded backlog: documents are read ahead by a few batches only
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(check_batch, batch))
+        for future in pending:
+            yield future.result()
+
+
+def match_id(msg_id, digest, expected, repeats):
+    """Key of an ndjson document: its id, or `<id>_<n>` of the repeated
+    id it matches"""
+    keys = [msg_id] + [f"{msg_id}_{n}" for n in range(1, repeats.get(msg_id, 0) + 1)]
+    left = [key for key in keys if key in expected]
+    return next((key for key in left if expected[key] == digest), left[0] if left else msg_id)
+
+
+def verify_output(output, messages_path, contacts_path, workers=None, max_failures=MAX_FAILURES):
+    """Check every document of the `output` directory (or bulk output file)
+    against messages.csv and contacts.csv, see the module docstring
+
+    Documents are checked on `workers` processes, one per CPU this process
+    may run on by default.
+    """
+    start = time.perf_counter()
+    start_cpu = cpu_time()
+    workers = len(os.sched_getaffinity(0)) if workers is None else workers
+    report = VerificationReport(max_failures=max_failures)
+    expected, repeats = expected_fingerprints(messages_path, contacts_path)
+    documents = read_archive(output) if os.path.isfile(output) else walk(output, report)
+    for results, failures, size in check_batches(batched(documents, BATCH_SIZE), workers):
+        report.bytes += size
+        for name, kind, detail in failures:
+            report.fail(name, kind, detail)
+        for name, key, ident, digest in results:
+            report.documents += 1
+            if ident is None:
+                # not a document
+                continue
+            if key is None:
+                key = match_id(ident, digest, expected, repeats)
+            if key not in expected:
+                report.fail(name, "unexpected", f"no row of messages.csv for {key!r}, or written twice")
+                continue
+            want = expected.pop(key)
+            if digest is None:
+                continue
+            if want is None:
+                report.fail(name, "contact", "unknown contact in messages.csv")
+            elif want != digest:
+                fields = [column for column, got, row in zip(FIELDS, FINGERPRINT.unpack(digest),
+                                                            FINGERPRINT.unpack(want)) if got != row]
+                report.fail(name, "mismatch", f"{', '.join(fields)} differ from messages.csv")
+            else:
+                report.valid += 1
+    for key in expected:
+        report.fail(key, "missing", "no output for this row of messages.csv")
+    report.seconds = time.perf_counter() - start
+    report.cpu_seconds = cpu_time() - start_cpu
+    return report
+
+
+def cpu_time():
+    """CPU time of this process and of its waited-for children"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime